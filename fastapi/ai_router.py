@@ -1,69 +1,311 @@
-from fastapi import APIRouter, UploadFile, File, Form
-from PIL import Image
-import io, base64
-import sys, os
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+from fastapi.responses import JSONResponse, StreamingResponse
+import asyncio
+import json
+import os
+import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'typersonal')))
 
-from shared.initializer import init_args_and_pipe
-from shared.core import generate_image, blend_styles_latent
+# 這裡只 import 輕量模組；torch、diffusers、cv2 等由 shared.core 帶入的模組在背景載入 (load_ai_model) 時才 import，
+# 端點中的 `from shared.core import ...` 在就緒後只是查表
+from shared.worker_pool import configured_num_workers
+from batch_scheduler import create_scheduler_from_env
+from inference_executor import create_executor_from_env, decode_image, encode_png_base64
+from model_loader import ModelLoader
+from style_registry import create_style_registry_from_env
 
 router = APIRouter()
 
-args, pipe = init_args_and_pipe()
+# 由 load_ai_model 在背景設定
+args = pipe = worker_pool = None
 
+# AI_WORKERS > 0 時，generate / blend 交給共用權重的多程序 worker pool；否則在本程序推論
+num_backends = configured_num_workers() or 1
 
-@router.post("/ai/generate")
+# 所有 torch 推論都在這個大小固定的 pool 上執行，不佔用 event loop
+# (使用 worker pool 時，這些 thread 只負責等待 worker 的結果)
+inference_executor = create_executor_from_env(prefix="AI", name="ai-inference", default_workers=num_backends)
+
+
+def run_inference(fn, *fn_args, progress=None):
+    """在 worker pool (若有) 或本程序執行 fn(*fn_args, args, pipe)
+
+    指定 progress 時改為 fn(*fn_args, args, pipe, progress=...)，fn 回報的進度在本程序交給 progress
+    """
+    kwargs = {} if progress is None else {"progress": progress}
+    if worker_pool is not None:
+        return worker_pool.run(fn, *fn_args, **kwargs)
+    return fn(*fn_args, args, pipe, **kwargs)
+
+
+def run_generate_batch(key, payloads):
+    """同一組取樣參數 (steps, order, guidance) 的請求一次批次取樣"""
+    from shared.core import generate_images
+
+    sampling_step, _, _ = key
+    characters = [character for character, _ in payloads]
+    images = [image for _, image in payloads]
+    results = run_inference(generate_images, characters, sampling_step, images)
+    return [result if result is not None else ValueError("Character not in TTF font")
+            for result in results]
+
+
+generate_scheduler = create_scheduler_from_env(run_generate_batch, executor=inference_executor.pool,
+                                               max_concurrency=num_backends)
+
+# POST /ai/styles 登記的參考圖與其編碼結果，之後的請求只送 style_id
+style_registry = create_style_registry_from_env()
+
+
+def warmup_batch_sizes(args):
+    """預熱的批次大小：微批次可能送出的每個 2 的次方 (不超過 max_batch_size 與 sampling_batch 的 chunk 大小)；
+    AI_COMPILE_UNET=1 時改為編譯過的 UNet batch (classifier-free guidance 下一個字佔兩個)"""
+    max_batch_size = min(generate_scheduler.max_batch_size, getattr(args, "chunk_size", 8))
+    if args.compile_unet:
+        sizes = {max(1, int(size) // 2) for size in args.compile_batch_sizes.split(",")}
+    else:
+        sizes = {2 ** power for power in range(max_batch_size.bit_length())}
+    return sorted(size for size in sizes if size <= max_batch_size)
+
+
+def load_ai_model(report):
+    """背景載入：import 推論模組、載入模型、啟動 worker pool，再對每個批次大小各跑一次預熱生成
+
+    AI_WARMUP=0 時略過預熱；AI_WARMUP_STEPS 為預熱的取樣步數
+    """
+    global args, pipe, worker_pool
+
+    report("importing")
+    from shared.initializer import init_args_and_pipe
+    from shared.worker_pool import create_worker_pool_from_env
+    from shared.core import warm_up_batch
+
+    report("loading")
+    args, pipe = init_args_and_pipe()
+    if configured_num_workers() > 0:
+        report("starting_workers")
+        worker_pool = create_worker_pool_from_env(args, pipe)
+
+    if os.environ.get("AI_WARMUP", "1") != "1":
+        return
+    sampling_step = int(os.environ.get("AI_WARMUP_STEPS", "2"))
+    batch_sizes = warmup_batch_sizes(args)
+    for index, batch_size in enumerate(batch_sizes):
+        report("warming_up", index, len(batch_sizes))
+        # 每個 worker 各自預熱：同時送出 num_backends 份，worker 各取一份
+        seconds = list(inference_executor.pool.map(
+            lambda _: run_inference(warm_up_batch, batch_size, sampling_step), range(num_backends)))
+        print(f"[ai] 預熱批次大小 {batch_size}：{max(seconds):.2f}s")
+    report("warming_up", len(batch_sizes), len(batch_sizes))
+
+
+ai_model = ModelLoader(load_ai_model, name="ai")
+# 推論端點在模型就緒前回 503
+model_ready = [Depends(ai_model.require_ready)]
+
+
+async def load_style_image(upload, style_id):
+    """上傳檔與 style_id 擇一；有 style_id 時直接取登記的 EncodedStyle (含編碼結果)，不必重新上傳、解碼與編碼"""
+    if style_id:
+        return style_registry.resolve(style_id)
+    if upload is None:
+        raise HTTPException(status_code=400, detail="請上傳參考圖或提供 style_id")
+    # 🔥 解碼時自動將 RGBA 轉成 RGB
+    return await decode_image(await upload.read())
+
+
+@router.on_event("startup")
+def start_loading_model():
+    # 不等模型載入完成，uvicorn 立刻開始接受連線
+    ai_model.start()
+
+
+@router.get("/live")
+async def live():
+    """存活檢查：程序還在回應即為 200；模型載入失敗時回 503，讓編排器重啟"""
+    stats = ai_model.stats()
+    return JSONResponse(status_code=503 if ai_model.failed else 200,
+                        content={"alive": not ai_model.failed, "uptime_seconds": stats["uptime_seconds"]})
+
+
+@router.get("/ready")
+async def ready():
+    """就緒檢查：模型載入並預熱完成才回 200；之前回 503 並附上目前階段與進度"""
+    return JSONResponse(status_code=200 if ai_model.ready else 503, content=ai_model.stats())
+
+
+@router.on_event("shutdown")
+def close_worker_pool():
+    if worker_pool is not None:
+        worker_pool.close()
+
+
+@router.post("/ai/generate", dependencies=model_ready)
 async def ai_generate(
     character: str = Form(...),
     sampling_step: int = Form(...),
-    reference_image: UploadFile = File(...)
+    reference_image: UploadFile = File(None),
+    style_id: str = Form(None)
 ):
     print(f"[generate] 字: {character}, Sampling Step: {sampling_step}")
-    image = Image.open(io.BytesIO(await reference_image.read()))
-    print(f"[generate] 上傳圖片大小: {image.size}, 模式: {image.mode}")
-
-    # 🔥 新增：自動將 RGBA 轉成 RGB
-    if image.mode == 'RGBA':
-        print("[generate] 偵測到 RGBA，轉換成 RGB")
-        image = image.convert('RGB')
+    # 佇列已滿時直接回 429
+    async with inference_executor.slot():
+        image = await load_style_image(reference_image, style_id)
+        print(f"[generate] 上傳圖片大小: {image.size}, 模式: {image.mode}")
 
-    result_img = generate_image(character, sampling_step, image, args, pipe)
+        # 交給排程器，與時間窗內的其他請求合併成一批
+        result_img = await generate_scheduler.submit(
+            (sampling_step, args.order, pipe.guidance_scale),
+            (character, image)
+        )
 
-    buf = io.BytesIO()
-    result_img.save(buf, format="PNG")
-    base64_img = base64.b64encode(buf.getvalue()).decode()
+    base64_img = await encode_png_base64(result_img)
     print(f"[generate] Base64 回傳預覽: {base64_img[:50]}... (共 {len(base64_img)} 字)")
 
     return {"image": f"data:image/png;base64,{base64_img}"}
 
 
-@router.post("/ai/blend")
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.post("/ai/generate/stream", dependencies=model_ready)
+async def ai_generate_stream(
+    character: str = Form(...),
+    sampling_step: int = Form(...),
+    reference_image: UploadFile = File(None),
+    preview_every: int = Form(2),
+    preview_size: int = Form(64),
+    style_id: str = Form(None)
+):
+    """以 Server-Sent Events 串流取樣過程
+
+    每 preview_every 步送出一張預測 x0 的灰階預覽 (event: preview)，最後送出完整字圖 (event: done)
+    與其他推論一樣經由 run_inference 在 worker pool (若有) 執行，預覽經由 worker 的結果 queue 傳回
+    """
+    from shared.core import generate_image_previews
+
+    print(f"[generate/stream] 字: {character}, Sampling Step: {sampling_step}, 每 {preview_every} 步預覽")
+    image = await load_style_image(reference_image, style_id)
+
+    loop = asyncio.get_running_loop()
+    previews = asyncio.Queue()
+
+    def on_progress(item):
+        # 在推論 thread (或 worker pool 的結果 thread) 上執行：編碼與送出交回 event loop
+        loop.call_soon_threadsafe(previews.put_nowait, item)
+
+    # 佇列已滿時在開始串流前就回 429
+    task = inference_executor.submit(
+        run_inference, generate_image_previews, character, sampling_step, image, max(1, preview_every),
+        preview_size, progress=on_progress)
+    task.add_done_callback(lambda _: loop.call_soon_threadsafe(previews.put_nowait, None))
+
+    async def events():
+        while True:
+            item = await previews.get()
+            if item is None:
+                break
+            step, total, preview = item
+            preview_b64 = await encode_png_base64(preview)
+            yield sse_event("preview", {"step": step, "total": total,
+                                        "image": f"data:image/png;base64,{preview_b64}"})
+        try:
+            result_img = await task
+        except Exception as e:
+            print(f"[generate/stream] ❌ 生成失敗: {e}")
+            yield sse_event("error", {"error": str(e)})
+            return
+        if result_img is None:
+            yield sse_event("error", {"error": "Character not in TTF font"})
+            return
+        base64_img = await encode_png_base64(result_img)
+        yield sse_event("done", {"image": f"data:image/png;base64,{base64_img}"})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/ai/scheduler/stats")
+async def ai_scheduler_stats():
+    """微批次排程器的佇列深度與批次大小統計"""
+    return {**generate_scheduler.stats(), "executor": inference_executor.stats(),
+            "workers": worker_pool.stats() if worker_pool is not None else None}
+
+
+@router.get("/ai/cache/stats", dependencies=model_ready)
+async def ai_cache_stats():
+    """參考風格圖編碼快取與混合結果快取的命中統計
+
+    使用 worker pool 時推論在 worker 中執行、每個 worker 各有一份快取：經由 pool 向每個 worker 收集，
+    style / blend 為所有 worker 的合計，workers 為各 worker 的統計；否則為 API 程序的快取 (workers 為 None)
+    """
+    from shared.core import cache_stats
+    from tiered_cache import merge_cache_stats
+
+    if worker_pool is None:
+        return {**cache_stats(args, pipe), "workers": None, "registry": style_registry.stats()}
+    futures = worker_pool.submit_to_each(cache_stats)
+    results = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures.values()))
+    workers = [{"rank": rank, **stats} for rank, stats in zip(futures, results)]
+    return {"style": merge_cache_stats([stats["style"] for stats in workers]),
+            "blend": merge_cache_stats([stats["blend"] for stats in workers]),
+            "workers": workers, "registry": style_registry.stats()}
+
+
+@router.post("/ai/styles", dependencies=model_ready)
+async def ai_register_style(reference_image: UploadFile = File(...)):
+    """登記一張參考圖並預先編碼，回傳 style_id；之後的 generate / blend 以 style_id 取代上傳檔
+
+    編碼結果與 style_id 一起保留，之後在任何 worker 上都直接使用，不再重跑編碼器
+    """
+    from shared.core import encode_style_image
+
+    image = await decode_image(await reference_image.read())
+    print(f"[styles] 登記參考圖，大小: {image.size}")
+    style = await inference_executor.run(run_inference, encode_style_image, image)
+    style_id = style_registry.register(style)
+    return {"style_id": style_id, "ttl_seconds": style_registry.ttl_seconds}
+
+
+@router.delete("/ai/styles/{style_id}")
+async def ai_remove_style(style_id: str):
+    if not style_registry.remove(style_id):
+        raise HTTPException(status_code=404, detail="style_id 不存在或已過期")
+    return {"removed": style_id}
+
+
+@router.post("/ai/blend", dependencies=model_ready)
 async def ai_blend(
     character: str = Form(...),
     style_option: str = Form(...),
     alpha: float = Form(...),
     thickness: float = Form(...),
-    image_a: UploadFile = File(...)
+    image_a: UploadFile = File(None),
+    lattice_size: int = Form(0),
+    style_id: str = Form(None)
 ):
+    """lattice_size > 1 時 (例如 11)，第一次請求一次批次生成 alpha = 0..1 的 lattice，
+    之後拖動滑桿的請求直接由快取的 lattice 取得或內插"""
+    from shared.core import blend_styles_latent, blend_styles_lattice
+
     print(f"[blend] 字: {character}, 風格: {style_option}, alpha: {alpha}, thickness: {thickness}")
-    image = Image.open(io.BytesIO(await image_a.read()))
+    image = await load_style_image(image_a, style_id)
     print(f"[blend] 上傳 image_a 大小: {image.size}, 模式: {image.mode}")
 
-    # 🔥 新增：自動將 RGBA 轉成 RGB
-    if image.mode == 'RGBA':
-        print("[blend] 偵測到 RGBA，轉換成 RGB")
-        image = image.convert('RGB')
-
-    result_img = blend_styles_latent(character, image, style_option, alpha, thickness, args, pipe)
+    if lattice_size > 1:
+        result_img = await inference_executor.run(
+            run_inference, blend_styles_lattice, character, image, style_option, alpha, thickness, lattice_size)
+    else:
+        result_img = await inference_executor.run(
+            run_inference, blend_styles_latent, character, image, style_option, alpha, thickness)
 
     if result_img is None:
         print("[blend] ❌ 無法處理，回傳 None")
         return {"error": "字元無法處理，請確認輸入。"}
 
-    buf = io.BytesIO()
-    result_img.save(buf, format="PNG")
-    base64_img = base64.b64encode(buf.getvalue()).decode()
+    base64_img = await encode_png_base64(result_img)
     print(f"[blend] ✅ Base64 回傳預覽: {base64_img[:50]}... (共 {len(base64_img)} 字)")
 
     return {"image": f"data:image/png;base64,{base64_img}"}
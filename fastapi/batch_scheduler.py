@@ -0,0 +1,149 @@
+"""
+/ai/generate 的動態微批次排程器
+在一個時間窗內收集同時到達的請求，依取樣參數分組後一次跑完批次取樣，再把結果分回各請求
+"""
+
+import asyncio
+import os
+import time
+from collections import Counter
+
+
+class MicroBatchScheduler:
+    """把時間窗內到達的請求合併成批次執行
+
+    Args:
+        run_batch: 同步函式 run_batch(key, payloads) -> list，回傳與 payloads 對齊的結果
+                   (元素為 Exception 時只讓該請求失敗)
+        window_ms: 第一個請求到達後，最多等待多久收集同批請求
+        max_batch_size: 單一批次的最大請求數
+        executor: 執行 run_batch 的 executor，None 表示使用 event loop 預設的 executor
+        max_concurrency: 同時執行的批次數，後端是多程序 worker pool 時可設為 worker 數
+    """
+
+    def __init__(self, run_batch, window_ms=20.0, max_batch_size=8, executor=None, max_concurrency=1):
+        self.run_batch = run_batch
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+
+        self._queue = None
+        self._worker_task = None
+        self._slots = None
+        self.running_batches = 0
+
+        # 監控指標，用來調整 window_ms / max_batch_size
+        self.requests_total = 0
+        self.batches_total = 0
+        self.max_queue_depth = 0
+        self.batch_size_histogram = Counter()
+        self.last_batch_size = 0
+        self.last_batch_seconds = 0.0
+
+    def _ensure_worker(self):
+        # 第一次 submit 時才在目前的 event loop 上建立 queue 與背景工作
+        if self._worker_task is None or self._worker_task.done():
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._worker_task = asyncio.get_running_loop().create_task(self._worker())
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, key, payload):
+        """送出一個請求並等待結果；key 相同的請求才會被合併成同一批"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((key, payload, future))
+        self.requests_total += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        return await future
+
+    async def _collect(self):
+        """等第一個請求到達，接著在時間窗內盡量收集到 max_batch_size 個"""
+        items = [await self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self._collect()
+
+            # 依相容的取樣參數分組
+            groups = {}
+            for key, payload, future in items:
+                groups.setdefault(key, []).append((payload, future))
+
+            for key, group in groups.items():
+                # 同時執行的批次數已滿時在此等待，期間新請求繼續排隊、累積成下一批
+                await self._slots.acquire()
+                loop.create_task(self._run_group(loop, key, group))
+
+    async def _run_group(self, loop, key, group):
+        payloads = [payload for payload, _ in group]
+        futures = [future for _, future in group]
+        self.running_batches += 1
+        start = time.monotonic()
+        try:
+            results = await loop.run_in_executor(self.executor, self.run_batch, key, payloads)
+        except Exception as e:
+            print(f"[scheduler] ❌ 批次執行失敗: {e}")
+            results = [e] * len(futures)
+        finally:
+            self.running_batches -= 1
+            self._slots.release()
+
+        self.batches_total += 1
+        self.batch_size_histogram[len(payloads)] += 1
+        self.last_batch_size = len(payloads)
+        self.last_batch_seconds = time.monotonic() - start
+        print(f"[scheduler] 批次大小 {len(payloads)}，參數 {key}，耗時 {self.last_batch_seconds:.2f}s，"
+              f"佇列剩餘 {self.queue_depth}")
+
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        avg_batch_size = (sum(size * count for size, count in self.batch_size_histogram.items())
+                          / self.batches_total) if self.batches_total else 0.0
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_batch_size": self.max_batch_size,
+            "max_concurrency": self.max_concurrency,
+            "running_batches": self.running_batches,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "requests_total": self.requests_total,
+            "batches_total": self.batches_total,
+            "avg_batch_size": avg_batch_size,
+            "last_batch_size": self.last_batch_size,
+            "last_batch_seconds": self.last_batch_seconds,
+            "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_size_histogram.items())},
+        }
+
+
+def create_scheduler_from_env(run_batch, executor=None, max_concurrency=1):
+    """從環境變數讀取設定：AI_BATCH_WINDOW_MS、AI_MAX_BATCH_SIZE"""
+    return MicroBatchScheduler(
+        run_batch=run_batch,
+        window_ms=float(os.environ.get("AI_BATCH_WINDOW_MS", "20")),
+        max_batch_size=int(os.environ.get("AI_MAX_BATCH_SIZE", "8")),
+        executor=executor,
+        max_concurrency=max_concurrency,
+    )
@@ -0,0 +1,136 @@
+"""
+推論工作的執行器
+把秒級、CPU 密集的 torch / ONNX 推論移出 asyncio event loop，放到大小固定的 thread pool，
+並在排隊過多時直接回 429 (Retry-After)，避免一次生成卡住 /health、/users 等其他請求
+"""
+
+import asyncio
+import base64
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from fastapi import HTTPException
+from PIL import Image
+
+
+class InferenceExecutor:
+    """大小固定的推論 executor，附帶排隊上限 (admission control)
+
+    Args:
+        max_workers: 同時執行的推論數，模型共用同一份權重時建議為 1
+        max_pending: 執行中加上排隊中的請求上限，超過即回 429
+        retry_after: 429 回應的 Retry-After 秒數
+        name: thread 名稱前綴，方便除錯
+    """
+
+    def __init__(self, max_workers=1, max_pending=16, retry_after=5, name="inference"):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.rejected_total = 0
+        self.completed_total = 0
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _admit(self):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected_total += 1
+                raise HTTPException(
+                    status_code=429,
+                    detail="推論佇列已滿，請稍後再試",
+                    headers={"Retry-After": str(self.retry_after)},
+                )
+            self._pending += 1
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+            self.completed_total += 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """佔用一個排隊名額；給自行排程 (例如微批次) 的請求使用"""
+        self._admit()
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def run(self, fn, *args, **kwargs):
+        """在推論 pool 上執行 fn，佇列已滿時拋出 429"""
+        async with self.slot():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, partial(fn, *args, **kwargs))
+
+    def submit(self, fn, *args, **kwargs):
+        """立即佔用名額並排入推論 pool，回傳 asyncio future
+
+        與 run 不同，429 會在呼叫當下同步拋出，適合需要先決定回應 (例如串流) 的端點
+        """
+        self._admit()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, partial(fn, *args, **kwargs))
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "rejected_total": self.rejected_total,
+            "completed_total": self.completed_total,
+        }
+
+
+def create_executor_from_env(prefix="AI", name="inference", default_workers=1):
+    """從環境變數讀取設定，例如 AI_INFERENCE_WORKERS、AI_MAX_PENDING、AI_RETRY_AFTER"""
+    return InferenceExecutor(
+        max_workers=int(os.environ.get(f"{prefix}_INFERENCE_WORKERS", str(default_workers))),
+        max_pending=int(os.environ.get(f"{prefix}_MAX_PENDING", "16")),
+        retry_after=int(os.environ.get(f"{prefix}_RETRY_AFTER", "5")),
+        name=name,
+    )
+
+
+# 圖片解碼與 PNG/base64 編碼也不在 event loop 上做，但與推論分開，避免排在長時間推論後面
+codec_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("CODEC_WORKERS", "2")),
+                                thread_name_prefix="codec")
+
+
+def _decode_image(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode == 'RGBA':
+        image = image.convert('RGB')
+    return image
+
+
+def _encode_png_base64(image):
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+async def decode_image(data):
+    """bytes -> PIL 圖片 (RGBA 自動轉 RGB)"""
+    return await asyncio.get_running_loop().run_in_executor(codec_pool, _decode_image, data)
+
+
+async def encode_png_base64(image):
+    """PIL 圖片 -> PNG 的 base64 字串"""
+    return await asyncio.get_running_loop().run_in_executor(codec_pool, _encode_png_base64, image)
@@ -0,0 +1,128 @@
+"""
+模型的背景載入與就緒狀態
+uvicorn 啟動時只 import 輕量的路由模組就開始接受連線；torch / diffusers 等重量級模組的 import、
+模型載入與預熱都在背景 thread 進行，進度由 /ready、/live 回報。
+負載平衡器以 /ready 判斷何時導入流量，推論端點在就緒前回 503 (Retry-After)。
+"""
+
+import threading
+import time
+
+from fastapi import HTTPException
+
+
+class ModelLoader:
+    """在背景 thread 執行 load(report) 並記錄進度
+
+    load 依序呼叫 report(stage, done, total) 回報目前的階段 (例如 "importing"、"loading"、"warming_up")
+    與階段內的完成數；load 正常結束即為就緒，拋出例外則記錄為失敗。
+
+    Args:
+        load: 載入函式 load(report)
+        name: thread 名稱與日誌前綴
+        retry_after: 尚未就緒時 503 回應的 Retry-After 秒數
+    """
+
+    def __init__(self, load, name="model", retry_after=5):
+        self.load = load
+        self.name = name
+        self.retry_after = retry_after
+        self.created_at = time.monotonic()
+
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self.status = "pending"
+        self.stage = None
+        self.done = 0
+        self.total = 0
+        self.stage_seconds = {}
+        self._stage_started = None
+        self.started_at = None
+        self.ready_seconds = None
+        self.error = None
+
+    def start(self):
+        """啟動背景載入 (只會執行一次)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.status = "loading"
+            self.started_at = time.monotonic()
+            self._thread = threading.Thread(target=self._run, daemon=True, name=f"{self.name}-loader")
+        self._thread.start()
+
+    def report(self, stage, done=0, total=0):
+        with self._lock:
+            now = time.monotonic()
+            if stage != self.stage:
+                self._finish_stage(now)
+                print(f"[{self.name}] {stage} ...")
+                self.stage = stage
+                self._stage_started = now
+            self.done = done
+            self.total = total
+
+    def _finish_stage(self, now):
+        if self.stage is not None:
+            self.stage_seconds[self.stage] = round(now - self._stage_started, 3)
+
+    def _run(self):
+        try:
+            self.load(self.report)
+        except Exception as e:
+            with self._lock:
+                self._finish_stage(time.monotonic())
+                self.status = "failed"
+                self.error = f"{type(e).__name__}: {e}"
+            print(f"[{self.name}] ❌ 載入失敗: {self.error}")
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._finish_stage(now)
+            self.stage = None
+            self.status = "ready"
+            self.ready_seconds = round(now - self.started_at, 3)
+        self._ready.set()
+        print(f"[{self.name}] ✅ 就緒，共 {self.ready_seconds:.1f}s")
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def failed(self):
+        return self.status == "failed"
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def require_ready(self):
+        """給推論端點的 FastAPI dependency：尚未就緒時回 503"""
+        if self.ready:
+            return
+        if self.failed:
+            raise HTTPException(status_code=503, detail=f"模型載入失敗: {self.error}")
+        raise HTTPException(
+            status_code=503,
+            detail="模型載入中，請稍後再試",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            stage_seconds = dict(self.stage_seconds)
+            if self.stage is not None:
+                stage_seconds[self.stage] = round(now - self._stage_started, 3)
+            return {
+                "status": self.status,
+                "stage": self.stage,
+                "done": self.done,
+                "total": self.total,
+                "stage_seconds": stage_seconds,
+                "elapsed_seconds": round(now - self.started_at, 3) if self.started_at is not None else 0.0,
+                "ready_seconds": self.ready_seconds,
+                "uptime_seconds": round(now - self.created_at, 3),
+                "error": self.error,
+            }
@@ -0,0 +1,93 @@
+"""
+參考風格圖的伺服器端登記
+前端只上傳一次手寫圖 (POST /ai/styles) 並取得 style_id，之後 generate / blend 只送 style_id，
+不必每個字、每次拖動滑桿都重新上傳與解碼同一張圖。
+登記時就把圖送進編碼器，編碼結果 (style_cache.EncodedStyle：原圖、像素雜湊、style 特徵與融合用的 latent)
+與 style_id 一起保留到 TTL 過期；之後的請求把 EncodedStyle 連同編碼結果交給推論端 (或 worker 程序)，
+不會再算像素雜湊或重跑編碼器，也不受各程序風格快取的 LRU 淘汰影響。
+"""
+
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+
+class StyleRegistry:
+    """style_id -> 登記的參考風格 (EncodedStyle)，附 TTL (每次使用都會延長) 與數量上限
+
+    Args:
+        ttl_seconds: 多久沒使用就過期
+        max_styles: 同時保留的登記數，超過時淘汰最久沒用的
+    """
+
+    def __init__(self, ttl_seconds=1800, max_styles=256):
+        self.ttl_seconds = ttl_seconds
+        self.max_styles = max_styles
+        self._styles = OrderedDict()
+        self._lock = threading.Lock()
+        self.registered_total = 0
+        self.expired_total = 0
+
+    def _purge(self, now):
+        while self._styles:
+            style_id, (_, expires_at) = next(iter(self._styles.items()))
+            if expires_at > now and len(self._styles) <= self.max_styles:
+                break
+            del self._styles[style_id]
+            self.expired_total += 1
+
+    def register(self, style):
+        """登記一個參考風格，回傳新的 style_id"""
+        style_id = secrets.token_urlsafe(12)
+        now = time.monotonic()
+        with self._lock:
+            self._styles[style_id] = (style, now + self.ttl_seconds)
+            self.registered_total += 1
+            self._purge(now)
+        return style_id
+
+    def get(self, style_id):
+        """取得參考風格並延長 TTL，不存在或已過期時回傳 None"""
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            entry = self._styles.get(style_id)
+            if entry is None:
+                return None
+            self._styles[style_id] = (entry[0], now + self.ttl_seconds)
+            self._styles.move_to_end(style_id)
+            return entry[0]
+
+    def remove(self, style_id):
+        with self._lock:
+            return self._styles.pop(style_id, None) is not None
+
+    def resolve(self, style_id):
+        """get 的端點版本：找不到時拋出 404"""
+        style = self.get(style_id)
+        if style is None:
+            raise HTTPException(status_code=404, detail="style_id 不存在或已過期，請重新上傳參考圖")
+        return style
+
+    def stats(self):
+        with self._lock:
+            self._purge(time.monotonic())
+            return {
+                "styles": len(self._styles),
+                "max_styles": self.max_styles,
+                "ttl_seconds": self.ttl_seconds,
+                "registered_total": self.registered_total,
+                "expired_total": self.expired_total,
+            }
+
+
+def create_style_registry_from_env(prefix="AI"):
+    """從環境變數讀取設定，例如 AI_STYLE_TTL (秒)、AI_MAX_STYLES"""
+    return StyleRegistry(
+        ttl_seconds=float(os.environ.get(f"{prefix}_STYLE_TTL", "1800")),
+        max_styles=int(os.environ.get(f"{prefix}_MAX_STYLES", "256")),
+    )
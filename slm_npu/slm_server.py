@@ -5,12 +5,11 @@ SLM NPU 獨立後端服務器
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
-import io
-import base64
 import sys
 import os
 import time
+import asyncio
+import threading
 from typing import Optional
 import uvicorn
 
@@ -19,6 +18,10 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from slm_generator import create_slm_generator, SLMFontGenerator
 
+# 共用 fastapi/ 的推論 executor (固定大小 thread pool + 429 admission control)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'fastapi')))
+from inference_executor import create_executor_from_env, decode_image, encode_png_base64
+
 # 創建獨立的FastAPI應用
 app = FastAPI(
     title="SLM NPU Font Generator",
@@ -38,22 +41,52 @@ app.add_middleware(
 # 全局SLM生成器實例
 slm_generator: Optional[SLMFontGenerator] = None
 
+# ONNX 推論不在 event loop 上執行
+slm_executor = create_executor_from_env(prefix="SLM", name="slm-inference")
+# 生成器的建立與清理互斥，同時到達的第一批請求只會建立一次
+slm_generator_lock = threading.Lock()
+
 def get_slm_generator() -> SLMFontGenerator:
-    """獲取或創建SLM生成器實例"""
+    """獲取或創建SLM生成器實例
+
+    第一次呼叫會建立 ONNX Runtime session (阻塞的模型載入)，只能在 thread 上呼叫，不能在 event loop 上
+    """
     global slm_generator
-    if slm_generator is None:
-        # 檢查是否有真實的SLM模型
-        model_path = "./models/slm_font_model.onnx"
-        use_npu = os.path.exists(model_path)
-        
-        slm_generator = create_slm_generator(
-            model_path=model_path if use_npu else None,
-            use_npu=use_npu
-        )
-        
-        print(f"🔧 SLM生成器已初始化: {'NPU模式' if use_npu else '模擬模式'}")
-    
-    return slm_generator
+    with slm_generator_lock:
+        if slm_generator is None:
+            # 檢查是否有真實的SLM模型
+            model_path = "./models/slm_font_model.onnx"
+            use_npu = os.path.exists(model_path)
+
+            slm_generator = create_slm_generator(
+                model_path=model_path if use_npu else None,
+                use_npu=use_npu
+            )
+
+            print(f"🔧 SLM生成器已初始化: {'NPU模式' if use_npu else '模擬模式'}")
+
+        return slm_generator
+
+async def get_slm_generator_async() -> SLMFontGenerator:
+    """給不經過 slm_executor 的端點 (status / health)：在預設 thread pool 上取得生成器，不阻塞 event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, get_slm_generator)
+
+def _generate_font(**kwargs):
+    """在 slm_executor 上執行：取得 (必要時建立) 生成器並生成，回傳 (圖片, 模型資訊)"""
+    generator = get_slm_generator()
+    return generator.generate_font(**kwargs), generator.get_model_info()
+
+def _batch_generate_fonts(**kwargs):
+    """在 slm_executor 上執行：取得 (必要時建立) 生成器並批量生成，回傳 (結果, 模型資訊)"""
+    generator = get_slm_generator()
+    return generator.batch_generate_fonts(**kwargs), generator.get_model_info()
+
+def _cleanup_slm_generator():
+    global slm_generator
+    with slm_generator_lock:
+        if slm_generator:
+            slm_generator.cleanup()
+            slm_generator = None
 
 def _generate_slm_response(characters: str, context: str) -> str:
     """生成SLM回應（使用真正的語言模型）"""
@@ -456,23 +489,16 @@ async def slm_generate_font(
         if style_strength < 0.0 or style_strength > 1.0:
             raise HTTPException(status_code=400, detail="風格強度必須在0.0-1.0之間")
         
-        # 讀取並處理圖片
+        # 讀取並處理圖片 (解碼時 RGBA 會轉成 RGB)
         image_data = await reference_image.read()
-        image = Image.open(io.BytesIO(image_data))
-        
-        # 檢查圖片格式
-        if image.mode == 'RGBA':
-            print("[SLM] 偵測到RGBA，轉換成RGB")
-            image = image.convert('RGB')
+        image = await decode_image(image_data)
         
         print(f"[SLM] 上傳圖片大小: {image.size}, 模式: {image.mode}")
         
-        # 獲取SLM生成器
-        generator = get_slm_generator()
-        
-        # 生成字型
+        # 生成字型 (生成器在 slm_executor 上取得，第一次的模型載入也不佔用 event loop)
         start_time = time.time()
-        result_img = generator.generate_font(
+        result_img, model_info = await slm_executor.run(
+            _generate_font,
             character=character,
             reference_image=image,
             sampling_steps=sampling_steps,
@@ -484,9 +510,7 @@ async def slm_generate_font(
             raise HTTPException(status_code=500, detail="字型生成失敗")
         
         # 轉換為base64
-        buf = io.BytesIO()
-        result_img.save(buf, format="PNG")
-        base64_img = base64.b64encode(buf.getvalue()).decode()
+        base64_img = await encode_png_base64(result_img)
         
         print(f"[SLM] ✅ 字型生成完成: {character}")
         print(f"[SLM] 生成時間: {generation_time:.2f}ms")
@@ -497,7 +521,7 @@ async def slm_generate_font(
             "character": character,
             "image": f"data:image/png;base64,{base64_img}",
             "generation_time_ms": round(generation_time, 2),
-            "model_info": generator.get_model_info()
+            "model_info": model_info
         }
         
     except HTTPException:
@@ -537,17 +561,12 @@ async def slm_batch_generate_fonts(
         
         # 讀取圖片
         image_data = await reference_image.read()
-        image = Image.open(io.BytesIO(image_data))
-        
-        if image.mode == 'RGBA':
-            image = image.convert('RGB')
+        image = await decode_image(image_data)
         
-        # 獲取生成器
-        generator = get_slm_generator()
-        
-        # 批量生成
+        # 批量生成 (生成器在 slm_executor 上取得)
         start_time = time.time()
-        results = generator.batch_generate_fonts(
+        results, model_info = await slm_executor.run(
+            _batch_generate_fonts,
             characters=char_list,
             reference_image=image,
             sampling_steps=sampling_steps,
@@ -558,9 +577,7 @@ async def slm_batch_generate_fonts(
         # 轉換結果
         font_images = {}
         for char, img in results.items():
-            buf = io.BytesIO()
-            img.save(buf, format="PNG")
-            base64_img = base64.b64encode(buf.getvalue()).decode()
+            base64_img = await encode_png_base64(img)
             font_images[char] = f"data:image/png;base64,{base64_img}"
         
         print(f"[SLM] ✅ 批量生成完成: {len(results)}/{len(char_list)} 成功")
@@ -573,7 +590,7 @@ async def slm_batch_generate_fonts(
             "failed_characters": list(set(char_list) - set(results.keys())),
             "font_images": font_images,
             "total_time_ms": round(total_time, 2),
-            "model_info": generator.get_model_info()
+            "model_info": model_info
         }
         
     except HTTPException:
@@ -586,7 +603,7 @@ async def slm_batch_generate_fonts(
 async def get_slm_status():
     """獲取SLM生成器狀態"""
     try:
-        generator = get_slm_generator()
+        generator = await get_slm_generator_async()
         status = generator.get_model_info()
         
         return {
@@ -606,10 +623,7 @@ async def get_slm_status():
 async def cleanup_slm():
     """清理SLM生成器資源"""
     try:
-        global slm_generator
-        if slm_generator:
-            slm_generator.cleanup()
-            slm_generator = None
+        await asyncio.get_running_loop().run_in_executor(None, _cleanup_slm_generator)
         
         return {
             "success": True,
@@ -642,7 +656,7 @@ async def slm_chat(
         print(f"[SLM] 📝 上下文: {context}")
         
         # 使用真正的SLM功能生成回應
-        ai_response = _generate_slm_response(actual_message, context)
+        ai_response = await slm_executor.run(_generate_slm_response, actual_message, context)
         
         print(f"[SLM] 🤖 AI回應: {ai_response[:100]}...")
         
@@ -654,6 +668,8 @@ async def slm_chat(
             "timestamp": time.time()
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[SLM] ❌ 對話生成錯誤: {e}")
         raise HTTPException(status_code=500, detail=f"對話生成失敗: {str(e)}")
@@ -662,7 +678,7 @@ async def slm_chat(
 async def slm_health_check():
     """SLM健康檢查"""
     try:
-        generator = get_slm_generator()
+        generator = await get_slm_generator_async()
         status = generator.get_model_info()
         
         is_healthy = status.get("status") in ["active", "qnn_htp_active"]
@@ -0,0 +1,108 @@
+"""
+attention 實作的 micro-benchmark：比較 sdpa / chunked / reference (與 auto 的選擇) 的速度與誤差
+
+    python benchmark_attention.py --ckpt_dir ckpt --benchmark_batch_sizes 2,8,16
+
+對每個 UNet batch 大小 (classifier-free guidance 下為字數的兩倍) 先跑一次 UNet，記下每個 CrossAttention
+(SpatialTransformer 的 self / cross attention 與 OffsetRefStrucInter) 的輸入形狀，
+再逐一形狀比較各實作的耗時與相對 reference 的最大誤差，最後比較整個 UNet forward 的耗時。
+選定後以 --attention_backend (或 FastAPI 設定 AI_ATTENTION_BACKEND) 指定。
+"""
+
+import time
+
+import torch
+
+from sample import arg_parse, load_fontdiffuer_model
+from src.modules.attention import ATTENTION_BACKENDS, CrossAttention, set_attention_backend
+
+
+def timed(fn, repeats):
+    with torch.no_grad():
+        output = fn()  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+    return output, (time.perf_counter() - start) / repeats
+
+
+def unet_inputs(args, model, batch_size):
+    """batch_size 張隨機 content / style 圖的 condition 與 x_t"""
+    content_images = torch.rand(batch_size, 3, *args.content_image_size, device=args.device) * 2 - 1
+    style_images = torch.rand(batch_size, 3, *args.style_image_size, device=args.device) * 2 - 1
+    with torch.no_grad():
+        condition = model.encode_condition(content_images, style_images)
+    x_t = torch.randn(batch_size, 3, *args.content_image_size, device=args.device)
+    timesteps = torch.full((batch_size,), 500., device=args.device)
+    return x_t, timesteps, condition
+
+
+def attention_calls(model, unet_forward):
+    """跑一次 UNet，記下每個 CrossAttention 的 (module, hidden_states, context)，相同形狀只留一個"""
+    calls = {}
+
+    def record(module, inputs, kwargs):
+        hidden_states = inputs[0]
+        context = kwargs.get("context", inputs[1] if len(inputs) > 1 else None)
+        key_length = context.shape[1] if context is not None else hidden_states.shape[1]
+        shape = (tuple(hidden_states.shape), key_length, module.heads)
+        calls.setdefault(shape, (module, hidden_states, context))
+
+    handles = [module.register_forward_pre_hook(record, with_kwargs=True)
+               for module in model.unet.modules() if isinstance(module, CrossAttention)]
+    try:
+        with torch.no_grad():
+            unet_forward()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return calls
+
+
+def benchmark(args, model, batch_size, backends, repeats):
+    x_t, timesteps, condition = unet_inputs(args, model, batch_size)
+    unet_forward = lambda: model(x_t, timesteps, condition, args.content_encoder_downsample_size, version=None)
+
+    print(f"\n=== UNet batch {batch_size} ===")
+    header = "".join(f"{backend:>16}" for backend in backends)
+    print(f"{'[batch, query, dim] x key tokens, heads':<44}{'scores MB':>10}{header}")
+    for (shape, key_length, heads), (module, hidden_states, context) in attention_calls(model, unet_forward).items():
+        scores_mb = shape[0] * heads * shape[1] * key_length * hidden_states.element_size() / 2**20
+        cells = []
+        reference = None
+        for backend in backends:
+            set_attention_backend(module, backend)
+            output, seconds = timed(lambda: module(hidden_states, context=context), repeats)
+            if reference is None:
+                reference = output
+            error = (output - reference).abs().max().item()
+            cells.append(f"{seconds * 1000:>8.2f}ms/{error:.0e}")
+        print(f"{str(list(shape)) + f' x {key_length}, {heads}':<44}{scores_mb:>10.1f}" + "".join(f"{c:>16}" for c in cells))
+
+    totals = {}
+    reference = None
+    for backend in backends:
+        set_attention_backend(model, backend)
+        output, totals[backend] = timed(unet_forward, repeats)
+        reference = output if reference is None else reference
+        error = (output - reference).abs().max().item()
+        print(f"UNet forward [{backend}]: {totals[backend] * 1000:.1f} ms (max error {error:.1e})")
+    fastest = min(totals, key=totals.get)
+    print(f"最快: {fastest} ({totals['reference'] / totals[fastest]:.2f}x reference)")
+    return totals
+
+
+if __name__ == "__main__":
+    def add_arguments(parser):
+        parser.add_argument("--benchmark_batch_sizes", type=str, default="2,8,16",
+                            help="The UNet batch sizes to benchmark (twice the glyphs with guidance).")
+        parser.add_argument("--repeats", type=int, default=5)
+
+    args = arg_parse(add_arguments=add_arguments)
+    assert args.ckpt_dir is not None, "The ckpt_dir should not be None."
+    model = load_fontdiffuer_model(args)
+    # reference 排第一，作為誤差的基準
+    backends = ["reference"] + [backend for backend in ATTENTION_BACKENDS if backend != "reference"]
+    for batch_size in [int(size) for size in args.benchmark_batch_sizes.split(",")]:
+        benchmark(args, model, batch_size, backends, args.repeats)
+    set_attention_backend(model, args.attention_backend)
@@ -0,0 +1,92 @@
+"""
+可變形卷積實作的 benchmark 與誤差檢查：比較 torchvision 與 grid_sample 的速度，並以 torchvision 為基準檢查誤差
+
+    python benchmark_deform_conv.py --ckpt_dir ckpt --benchmark_batch_sizes 2,8,16 --check
+
+對每個 UNet batch 大小 (classifier-free guidance 下為字數的兩倍) 先跑一次 UNet，記下每個 StyleRSIUpBlock2D
+的 DeformConv2d 的輸入與 offset，再逐一比較各實作的耗時與最大誤差，最後比較整個 UNet forward 的耗時。
+--check 時任何一層的誤差超過 --tolerance (相對於輸出的最大絕對值) 即失敗。
+選定後以 --deform_conv_backend (或 FastAPI 設定 AI_DEFORM_CONV_BACKEND) 指定。
+"""
+
+import torch
+from torchvision.ops import DeformConv2d
+
+from benchmark_attention import timed, unet_inputs
+from sample import arg_parse, load_fontdiffuer_model
+from src.modules.deform_conv import DEFORM_CONV_BACKENDS, set_deform_conv_backend
+
+
+def deform_conv_calls(model, unet_forward):
+    """跑一次 UNet，記下每個 DeformConv2d 的 (name, input, offset)"""
+    calls = []
+    handles = []
+    for name, module in model.unet.named_modules():
+        if isinstance(module, DeformConv2d):
+            record = lambda module, inputs, name=name: calls.append((name, inputs[0], inputs[1]))
+            handles.append(module.register_forward_pre_hook(record))
+    try:
+        with torch.no_grad():
+            unet_forward()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return calls
+
+
+def benchmark(args, model, batch_size, backends, repeats, tolerance=None):
+    """回傳各實作的 UNet forward 秒數與各層的最大相對誤差"""
+    x_t, timesteps, condition = unet_inputs(args, model, batch_size)
+    unet_forward = lambda: model(x_t, timesteps, condition, args.content_encoder_downsample_size, version=None)
+    set_deform_conv_backend(model, backends[0])
+    calls = deform_conv_calls(model, unet_forward)
+
+    print(f"\n=== UNet batch {batch_size} ===")
+    print(f"{'layer [batch, channels, h, w]':<58}" + "".join(f"{backend:>22}" for backend in backends))
+    max_error = 0.
+    for name, input, offset in calls:
+        cells = []
+        reference = None
+        for backend in backends:
+            set_deform_conv_backend(model, backend)
+            module = dict(model.unet.named_modules())[name]
+            output, seconds = timed(lambda: module(input, offset), repeats)
+            if reference is None:
+                reference = output
+            error = ((output - reference).abs().max() / reference.abs().max().clamp(min=1.)).item()
+            max_error = max(max_error, error)
+            cells.append(f"{seconds * 1000:>10.2f}ms/{error:.1e}")
+        print(f"{name + ' ' + str(list(input.shape)):<58}" + "".join(f"{cell:>22}" for cell in cells))
+
+    totals = {}
+    reference = None
+    for backend in backends:
+        set_deform_conv_backend(model, backend)
+        output, totals[backend] = timed(unet_forward, repeats)
+        reference = output if reference is None else reference
+        error = (output - reference).abs().max().item()
+        print(f"UNet forward [{backend}]: {totals[backend] * 1000:.1f} ms (max error {error:.1e})")
+    fastest = min(totals, key=totals.get)
+    print(f"最快: {fastest} ({totals[backends[0]] / totals[fastest]:.2f}x {backends[0]})")
+    print(f"各層最大相對誤差: {max_error:.1e}")
+    if tolerance is not None:
+        assert max_error <= tolerance, f"The deformable convolution error {max_error:.1e} exceeds {tolerance:.1e}."
+    return totals, max_error
+
+
+if __name__ == "__main__":
+    def add_arguments(parser):
+        parser.add_argument("--benchmark_batch_sizes", type=str, default="2,8,16",
+                            help="The UNet batch sizes to benchmark (twice the glyphs with guidance).")
+        parser.add_argument("--repeats", type=int, default=5)
+        parser.add_argument("--check", action="store_true",
+                            help="Fail if a backend differs from torchvision by more than --tolerance.")
+        parser.add_argument("--tolerance", type=float, default=1e-4)
+
+    args = arg_parse(add_arguments=add_arguments)
+    assert args.ckpt_dir is not None, "The ckpt_dir should not be None."
+    model = load_fontdiffuer_model(args)
+    # torchvision 排第一，作為誤差的基準
+    backends = ["torchvision"] + [backend for backend in DEFORM_CONV_BACKENDS if backend != "torchvision"]
+    for batch_size in [int(size) for size in args.benchmark_batch_sizes.split(",")]:
+        benchmark(args, model, batch_size, backends, args.repeats, tolerance=args.tolerance if args.check else None)
@@ -0,0 +1,196 @@
+"""
+Content-feature store: the ContentEncoder outputs of every glyph of the content font, computed offline.
+
+The content features depend only on the character, the font and the content encoder weights, so they are
+computed once for the whole charset and memory-mapped by the samplers instead of running the encoder per
+request. The store is built with the encoders the samplers run (`--int8`, `--freeze_sn`, `--onnx_dir`) and keyed
+by that variant (`utils.encoder_variant`), so the features of other encoders are never mixed in.
+
+    python content_features.py --ckpt_dir ckpt --ttf_path ttf/KaiXinSongA.ttf
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+import numpy as np
+import torch
+
+from glyphs import get_glyph_service
+from utils import checkpoint_digest, encoder_variant
+
+
+# Bump when the stored layout changes, older stores are then ignored.
+STORE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_feature_store_dir(ckpt_dir, ttf_path, content_size, variant="fp32"):
+    """The store of a content encoder checkpoint, encoder variant, font and content size:
+    `ckpt/content_features/<key>`."""
+    key = hashlib.sha1(repr((
+        STORE_VERSION,
+        checkpoint_digest(ckpt_dir, names=("content_encoder.pth",)),
+        variant,
+        _file_digest(ttf_path),
+        tuple(content_size),
+    )).encode()).hexdigest()[:16]
+    return os.path.join(ckpt_dir, "content_features", key)
+
+
+class ContentFeatureStore:
+    """Memory-mapped `ContentEncoder` outputs of a font.
+
+    Feature `i` of every glyph is one row of `feature_{i}.npy`; the features are the residual features
+    followed by the final feature map, i.e. `content_residual_features` of `encode_condition`.
+
+    Args:
+        store_dir: a directory written by `ContentFeatureStore.build`.
+        variant: if set, the `encoder_variant` the store must have been built with.
+    """
+
+    def __init__(self, store_dir, variant=None):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        assert self.manifest["version"] == STORE_VERSION, \
+            f"The content feature store {store_dir} has version {self.manifest['version']}."
+        assert variant is None or self.manifest["variant"] == variant, \
+            f"The content feature store {store_dir} was built for {self.manifest['variant']}, not {variant}."
+        codepoints = np.load(os.path.join(store_dir, "codepoints.npy"))
+        self.index = {int(codepoint): row for row, codepoint in enumerate(codepoints)}
+        self.features = [np.load(os.path.join(store_dir, f"feature_{i}.npy"), mmap_mode="r")
+                         for i in range(self.manifest["num_features"])]
+
+    def __len__(self):
+        return len(self.index)
+
+    def has_char(self, char):
+        return ord(char) in self.index
+
+    def lookup(self, characters):
+        """The stored features of `characters` as a list of float32 (N, C, H, W) tensors,
+        `None` if any character is not in the store."""
+        rows = [self.index.get(ord(char)) for char in characters]
+        if not rows or any(row is None for row in rows):
+            return None
+        return [torch.from_numpy(np.asarray(feature[rows], dtype=np.float32)) for feature in self.features]
+
+    @classmethod
+    def build(cls, model, glyph_service, store_dir, variant="fp32", batch_size=64, dtype="float32"):
+        """Run `model.encode_content` over every glyph of `glyph_service` and write the store.
+
+        `variant` is the `encoder_variant` of `model`, recorded in the manifest.
+
+        The store is written to a temporary directory and renamed when complete, so an interrupted build
+        never leaves a partial store behind.
+        """
+        characters = [chr(codepoint) for codepoint in sorted(glyph_service.codepoints)]
+        device = model.device
+        tmp_dir = store_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        features, codepoints = None, []
+        with torch.no_grad():
+            for start in range(0, len(characters), batch_size):
+                valid_indices, content_images = glyph_service.content_batch(characters[start:start + batch_size])
+                if content_images is None:
+                    continue
+                outputs = model.encode_content(content_images.to(device))
+                if features is None:
+                    features = [np.lib.format.open_memmap(
+                        os.path.join(tmp_dir, f"feature_{i}.npy"), mode="w+", dtype=dtype,
+                        shape=(len(characters), *output.shape[1:])) for i, output in enumerate(outputs)]
+                row = len(codepoints)
+                for stored, output in zip(features, outputs):
+                    stored[row:row + output.shape[0]] = output.cpu().numpy()
+                codepoints += [ord(characters[start + index]) for index in valid_indices]
+                print(f"Encoded {len(codepoints)}/{len(characters)} content glyphs", end="\r")
+        print()
+        assert features is not None, "No glyph of the font was encoded."
+
+        # Every character comes from the cmap of the font, so each one fills its row.
+        assert len(codepoints) == len(characters)
+        num_features = len(features)
+        for stored in features:
+            stored.flush()
+        del features
+
+        np.save(os.path.join(tmp_dir, "codepoints.npy"), np.asarray(codepoints, dtype=np.int64))
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+            json.dump({"version": STORE_VERSION, "variant": variant, "num_features": num_features, "dtype": dtype,
+                       "ttf_path": glyph_service.ttf_path, "content_size": list(glyph_service.content_size),
+                       "num_glyphs": len(codepoints)}, f, indent=2)
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.replace(tmp_dir, store_dir)
+        return cls(store_dir, variant)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_content_feature_store(args):
+    """The shared store of the checkpoint, encoder variant, font and content size in `args`, `None` if it was
+    not built."""
+    if args.ckpt_dir is None:
+        return None
+    variant = encoder_variant(args)
+    key = (os.path.abspath(args.ckpt_dir), variant, os.path.abspath(args.ttf_path), tuple(args.content_image_size))
+    with _stores_lock:
+        if key not in _stores:
+            store_dir = content_feature_store_dir(args.ckpt_dir, args.ttf_path, args.content_image_size, variant)
+            store = None
+            if os.path.exists(os.path.join(store_dir, MANIFEST_FILE)):
+                store = ContentFeatureStore(store_dir, variant)
+                print(f"Loaded {len(store)} stored content features from {store_dir}")
+            _stores[key] = store
+        return _stores[key]
+
+
+def lookup_content_features(args, characters, device):
+    """The stored content features of `characters` on `device`, `None` to run the content encoder."""
+    store = get_content_feature_store(args)
+    if store is None:
+        return None
+    features = store.lookup(characters)
+    if features is None:
+        return None
+    return [feature.to(device) for feature in features]
+
+
+if __name__ == "__main__":
+    from sample import arg_parse, load_inference_model
+
+    def add_arguments(parser):
+        parser.add_argument("--store_batch_size", type=int, default=64,
+                            help="The number of glyphs encoded together.")
+        parser.add_argument("--store_dtype", type=str, default="float32", choices=["float32", "float16"],
+                            help="float16 halves the store size, at the cost of exact features.")
+
+    args = arg_parse(add_arguments=add_arguments)
+    assert args.ckpt_dir is not None, "The ckpt_dir should not be None."
+    # Built with the encoders of the sampling options (--int8, --freeze_sn, --onnx_dir), which key the store
+    model = load_inference_model(args)
+    variant = encoder_variant(args)
+
+    store_dir = content_feature_store_dir(args.ckpt_dir, args.ttf_path, args.content_image_size, variant)
+    store = ContentFeatureStore.build(
+        model=model,
+        glyph_service=get_glyph_service(args.ttf_path, args.content_image_size),
+        store_dir=store_dir,
+        variant=variant,
+        batch_size=args.store_batch_size,
+        dtype=args.store_dtype)
+    print(f"Saved the {variant} content features of {len(store)} glyphs to {store_dir}")
@@ -0,0 +1,32 @@
+"""
+把 ckpt 目錄中的 unet.pth / style_encoder.pth / content_encoder.pth 轉成 safetensors
+
+    python convert_checkpoint.py --ckpt_dir ckpt
+
+之後載入模型時會優先讀取 <name>.safetensors：以 mmap 直接當作權重使用，不必先把整個 pickle 讀進記憶體，
+同一台機器上各自載入模型的行程 (例如 generate_charset.py 的 worker) 也共用 page cache 中的同一份權重。
+轉出的檔案記錄了來源 .pth 的大小與修改時間，.pth 重新訓練後會改回讀取 .pth，直到再次轉換。
+"""
+
+import os
+import argparse
+
+from src.checkpoint import load_checkpoint, save_safetensors
+
+
+CHECKPOINT_NAMES = ("unet", "style_encoder", "content_encoder")
+
+
+def convert_checkpoint(ckpt_dir, names=CHECKPOINT_NAMES):
+    for name in names:
+        pth_path = os.path.join(ckpt_dir, f"{name}.pth")
+        safetensors_path = os.path.join(ckpt_dir, f"{name}.safetensors")
+        save_safetensors(load_checkpoint(pth_path), safetensors_path, source_path=pth_path)
+        print(f"{pth_path} -> {safetensors_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_dir", type=str, required=True)
+    args = parser.parse_args()
+    convert_checkpoint(args.ckpt_dir)
@@ -0,0 +1,84 @@
+"""
+把 FontDiffuser 匯出成 ONNX，供 ONNX Runtime CPU 後端使用
+
+    python export_onnx.py --ckpt_dir ckpt --onnx_output_dir ckpt/onnx --check
+
+輸出 unet.onnx、style_encoder.onnx、content_encoder.onnx、unet_style_structure.onnx
+(RSI up block 中與步數無關的風格投影)、風格融合用的 style_latent.onnx 與 unet_latent.onnx
+(BLEND_STYLE_SIZE 的風格 latent 與其條件下的 unet) 以及還原 list 條件用的 onnx_layout.json。
+DeformConv2d 以 ONNX opset 19 的 DeformConv 匯出。
+之後以 --onnx_dir ckpt/onnx (或 FastAPI 設定 AI_ONNX_DIR) 改用 ORT 推論。
+"""
+
+import time
+
+import numpy as np
+import torch
+
+from sample import arg_parse, load_fontdiffuer_model, load_fontdiffuer_pipeline
+from style_bank import BLEND_STYLE_SIZE
+from src.onnx_backend import export_onnx
+
+
+def check_onnx(args, torch_pipe, onnx_pipe, num_glyphs=2):
+    """以相同的隨機輸入比較 PyTorch 與 ORT 的輸出與速度"""
+    generator = torch.Generator().manual_seed(0)
+    content_images = torch.rand(num_glyphs, 3, *args.content_image_size, generator=generator) * 2 - 1
+    style_images = torch.rand(1, 3, *args.style_image_size, generator=generator) * 2 - 1
+
+    def run(pipe):
+        start = time.time()
+        with torch.no_grad():
+            images = pipe.generate_batch(
+                content_images=content_images,
+                style_images=style_images,
+                order=args.order,
+                num_inference_step=args.num_inference_steps,
+                content_encoder_downsample_size=args.content_encoder_downsample_size,
+                generator=torch.Generator().manual_seed(0),
+                dm_size=args.content_image_size,
+                algorithm_type=args.algorithm_type,
+                skip_type=args.skip_type,
+                method=args.method)
+        return images, time.time() - start
+
+    torch_images, torch_seconds = run(torch_pipe)
+    onnx_images, onnx_seconds = run(onnx_pipe)
+    max_diff = max(np.abs(np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)).max()
+                   for a, b in zip(torch_images, onnx_images))
+    print(f"PyTorch: {torch_seconds:.2f}s, ONNX Runtime: {onnx_seconds:.2f}s, "
+          f"最大像素差: {max_diff:.0f}/255 ({num_glyphs} 字, {args.num_inference_steps} steps)")
+
+
+def export_arg_parse():
+    def add_arguments(parser):
+        parser.add_argument("--onnx_output_dir", type=str, default="ckpt/onnx",
+                            help="Where to write the .onnx files.")
+        parser.add_argument("--check", action="store_true",
+                            help="Compare the ORT backend with PyTorch after exporting.")
+
+    args = arg_parse(add_arguments=add_arguments)
+    args.demo = True
+    args.int8 = False
+    args.onnx_dir = None
+    assert args.ckpt_dir is not None, "The ckpt_dir should not be None."
+    return args
+
+
+if __name__ == "__main__":
+    args = export_arg_parse()
+    model = load_fontdiffuer_model(args)
+    with torch.no_grad():
+        export_onnx(model,
+                    output_dir=args.onnx_output_dir,
+                    content_size=args.content_image_size,
+                    style_size=args.style_image_size,
+                    content_encoder_downsample_size=args.content_encoder_downsample_size,
+                    latent_style_size=BLEND_STYLE_SIZE)
+    print(f"Exported the ONNX models to {args.onnx_output_dir}")
+
+    if args.check:
+        torch_pipe = load_fontdiffuer_pipeline(args)
+        args.onnx_dir = args.onnx_output_dir
+        onnx_pipe = load_fontdiffuer_pipeline(args)
+        check_onnx(args, torch_pipe, onnx_pipe)
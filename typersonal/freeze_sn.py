@@ -0,0 +1,121 @@
+"""
+推論用的 spectral norm 凍結：把 encoder 的 SNConv2d / SNLinear 換成權重已正規化的 nn.Conv2d / nn.Linear
+
+    # 凍結並把 serving checkpoint 存到 ckpt 目錄，再輸出凍結前後 encoder 的誤差與速度
+    python freeze_sn.py --ckpt_dir ckpt --ttf_path ttf/KaiXinSongA.ttf --report
+
+    # 之後的推論加上 --freeze_sn (或 FastAPI 設定 AI_FREEZE_SN=1) 會直接讀取 serving checkpoint
+    python sample.py --ckpt_dir ckpt --freeze_sn ...
+
+推論時 SN 層不會更新 u 向量，每次 forward 的 power iteration 都得到同一個權重，凍結後只在載入時算一次。
+serving checkpoint 只存兩個 encoder (沒有 u / sv buffer)，以原始 checkpoint 的 digest 判斷是否過期。
+"""
+
+import os
+import copy
+import time
+
+import torch
+
+from src.checkpoint import checkpoint_file, load_weights
+from src.spectral_norm import freeze_spectral_norm
+from utils import checkpoint_digest
+
+
+SERVING_CKPT = "fontdiffuser_serving.pth"
+ENCODER_CKPTS = ("style_encoder.pth", "content_encoder.pth")
+
+
+def load_serving_encoders(path, digest, style_encoder, content_encoder):
+    """把 serving checkpoint 讀進 meta device 上建立 (尚未載入權重) 的 encoder；沒有快取或 checkpoint 已更新時回傳 None"""
+    if not os.path.exists(path):
+        return None
+    cached = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    if cached.get("checkpoint_digest") != digest:
+        return None
+    # 先換成凍結後的結構 (此時還沒有權重，不必檢查)，再直接以讀入的 tensor 作為權重
+    for encoder, name in ((style_encoder, "style_encoder"), (content_encoder, "content_encoder")):
+        freeze_spectral_norm(encoder, check=False)
+        encoder.load_state_dict(cached[name], assign=True)
+    return style_encoder, content_encoder
+
+
+def save_serving_encoders(path, digest, style_encoder, content_encoder):
+    torch.save({"checkpoint_digest": digest,
+                "style_encoder": style_encoder.state_dict(),
+                "content_encoder": content_encoder.state_dict()}, path)
+
+
+def load_or_freeze_encoders(args, style_encoder, content_encoder):
+    """讀取 ckpt 目錄中的 serving checkpoint；沒有或已過期時，載入原始權重、凍結 (逐層檢查誤差) 並寫入"""
+    path = os.path.join(args.ckpt_dir, SERVING_CKPT)
+    digest = checkpoint_digest(args.ckpt_dir, names=ENCODER_CKPTS)
+    if load_serving_encoders(path, digest, style_encoder, content_encoder) is not None:
+        print(f"Loaded the spectral-norm frozen encoders from {path}")
+        return style_encoder, content_encoder
+    load_weights(style_encoder, checkpoint_file(args.ckpt_dir, "style_encoder"))
+    load_weights(content_encoder, checkpoint_file(args.ckpt_dir, "content_encoder"))
+    max_error = max(freeze_spectral_norm(style_encoder.eval()), freeze_spectral_norm(content_encoder.eval()))
+    save_serving_encoders(path, digest, style_encoder, content_encoder)
+    print(f"Saved the spectral-norm frozen encoders to {path} (max layer error {max_error:.2e})")
+    return style_encoder, content_encoder
+
+
+def encoder_report(args, original_model, frozen_model, repeats=5):
+    """在參考字圖上比較凍結前後 encoder 的輸出與速度"""
+    from quantize import reference_glyphs, REPORT_CHARACTERS
+
+    _, content_images, style_images = reference_glyphs(args, REPORT_CHARACTERS)
+    content_images = content_images.to(args.device)
+    style_images = style_images.to(args.device)
+
+    def timed(model):
+        with torch.no_grad():
+            model.encode_condition(content_images, style_images)  # warm up
+            start = time.time()
+            for _ in range(repeats):
+                condition = model.encode_condition(content_images, style_images)
+        return condition, (time.time() - start) / repeats
+
+    original, original_seconds = timed(original_model)
+    frozen, frozen_seconds = timed(frozen_model)
+    errors = []
+
+    def _compare(a, b):
+        if torch.is_tensor(a):
+            errors.append(((a - b).abs().max() / a.abs().max().clamp(min=1.)).item())
+        else:
+            for x, y in zip(a, b):
+                _compare(x, y)
+
+    _compare(original, frozen)
+    print(f"\nencoder 輸出最大相對誤差: {max(errors):.2e} ({len(errors)} 個 tensor)")
+    print(f"原始 SN: {original_seconds * 1000:.1f} ms / batch ({len(content_images)} 字)")
+    print(f"凍結後: {frozen_seconds * 1000:.1f} ms / batch")
+    print(f"加速: {original_seconds / frozen_seconds:.2f}x")
+    return {"max_error": max(errors), "original_seconds": original_seconds, "frozen_seconds": frozen_seconds}
+
+
+if __name__ == "__main__":
+    from sample import arg_parse, load_fontdiffuer_model
+
+    def add_arguments(parser):
+        parser.add_argument("--report", action="store_true",
+                            help="Compare the encoder outputs and speed before and after freezing.")
+
+    args = arg_parse(add_arguments=add_arguments)
+    assert args.ckpt_dir is not None, "The ckpt_dir should not be None."
+    args.int8 = False
+    args.freeze_sn = False
+    original_model = load_fontdiffuer_model(args)
+
+    frozen_model = copy.deepcopy(original_model)
+    max_error = max(freeze_spectral_norm(frozen_model.style_encoder),
+                    freeze_spectral_norm(frozen_model.content_encoder))
+    path = os.path.join(args.ckpt_dir, SERVING_CKPT)
+    save_serving_encoders(path, checkpoint_digest(args.ckpt_dir, names=ENCODER_CKPTS),
+                          frozen_model.style_encoder, frozen_model.content_encoder)
+    print(f"Saved the spectral-norm frozen encoders to {path} (max layer error {max_error:.2e})")
+
+    if args.report:
+        encoder_report(args, original_model, frozen_model)
@@ -0,0 +1,351 @@
+"""
+整套字元集 (例如 Big5 4808 字) 的批次生成，可中斷續跑、多程序分片
+
+    python generate_charset.py --ckpt_dir ckpt --style_image_path style.png \
+        --charset_path big5_4808.txt --archive_dir generated_charset --num_workers 4 \
+        --export_dir generated_images
+
+字元集依序切成 num_workers 個分片 (shard)，每個 worker 程序各自載入 pipeline、
+用 sampling_batch 一次批次生成 chunk_size 個字。
+每個分片寫入自己的 append-only 封存檔 shard-XXX.bin (連續的 PNG bytes)，
+每完成一個字就在 shard-XXX.jsonl 追加一行紀錄 (字元、offset、長度)。
+重新執行時讀取紀錄跳過已完成的字；封存檔尾端沒有紀錄的殘缺資料會被截掉。
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from PIL import Image
+
+from sample import arg_parse, sampling_batch, load_fontdiffuer_pipeline
+from utils import image_digest, model_version
+
+
+CONFIG_FILE = "config.json"
+
+
+def read_charset(file_path):
+    """讀取字元集檔案，去掉空白與重複字，保留原本順序"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        characters = [char for line in f for char in line.strip()]
+    return list(dict.fromkeys(char for char in characters if not char.isspace()))
+
+
+def run_config(args, style_image, pipe=None):
+    """決定生成結果的設定；設定不同時封存檔裡的字不能沿用
+
+    包含所有取樣參數；guidance_scale 取自實際取樣的 pipe (沒有給 pipe 時即為 args.guidance_scale)
+    """
+    return {
+        "style_image": image_digest(style_image),
+        "ckpt_dir": os.path.abspath(args.ckpt_dir),
+        "model_version": model_version(args),
+        "ttf_path": os.path.abspath(args.ttf_path),
+        "seed": args.seed,
+        "num_inference_steps": args.num_inference_steps,
+        "guidance_type": args.guidance_type,
+        "guidance_scale": pipe.guidance_scale if pipe is not None else args.guidance_scale,
+        "model_type": args.model_type,
+        "algorithm_type": args.algorithm_type,
+        "skip_type": args.skip_type,
+        "method": args.method,
+        "order": args.order,
+        "t_start": args.t_start,
+        "t_end": args.t_end,
+        "correcting_x0_fn": args.correcting_x0_fn,
+        "content_image_size": list(args.content_image_size),
+        "style_image_size": list(args.style_image_size),
+        "content_encoder_downsample_size": args.content_encoder_downsample_size,
+    }
+
+
+def shard_paths(archive_dir, shard):
+    return (os.path.join(archive_dir, f"shard-{shard:03d}.bin"),
+            os.path.join(archive_dir, f"shard-{shard:03d}.jsonl"))
+
+
+def archive_shards(archive_dir):
+    """封存目錄裡已有紀錄的分片編號 (由小到大)"""
+    return sorted(int(name[len("shard-"):-len(".jsonl")]) for name in os.listdir(archive_dir)
+                  if name.startswith("shard-") and name.endswith(".jsonl"))
+
+
+def prepare_archive_dir(archive_dir, config, reset_on_mismatch=False):
+    """建立封存目錄並檢查設定；設定不符時依 reset_on_mismatch 清空或中止"""
+    os.makedirs(archive_dir, exist_ok=True)
+    config_path = os.path.join(archive_dir, CONFIG_FILE)
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous == config:
+            return
+        changed = sorted(key for key in set(previous) | set(config) if previous.get(key) != config.get(key))
+        if not reset_on_mismatch:
+            raise SystemExit(f"{archive_dir} 是用不同設定 (風格圖、模型或取樣參數) 生成的 "
+                             f"(不同的項目: {', '.join(changed)})，請換一個 --archive_dir 或加上 --reset")
+        for name in os.listdir(archive_dir):
+            if name.startswith("shard-"):
+                os.remove(os.path.join(archive_dir, name))
+        print(f"⚠️ 設定已變更，清空 {archive_dir}")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+class GlyphArchive:
+    """單一分片的 append-only 字圖封存檔與完成紀錄
+
+    紀錄只在 PNG bytes 寫入並 fsync 之後才追加，所以紀錄裡的字一定完整可讀。
+    新的字只寫入這個分片，但 `in` 與 read 會查所有分片 (開啟時的 archive_index)，
+    所以由其他分片 (例如 generate_charset 的其他 worker) 完成的字不會重新生成。
+    """
+
+    def __init__(self, archive_dir, shard=0):
+        self.archive_dir = archive_dir
+        self.shard = shard
+        self.bin_path, self.manifest_path = shard_paths(archive_dir, shard)
+        self.entries = read_manifest(self.manifest_path)
+        self.index = archive_index(archive_dir)
+
+        # 截掉上次中斷時寫了一半、還沒有紀錄的資料
+        end = max((entry["offset"] + entry["length"] for entry in self.entries.values()
+                   if entry["status"] == "done"), default=0)
+        with open(self.bin_path, "ab") as f:
+            f.truncate(end)
+        self._bin = open(self.bin_path, "ab")
+        self._manifest = open(self.manifest_path, "a", encoding="utf-8")
+
+    def __contains__(self, char):
+        return char in self.index
+
+    def shard_of(self, char):
+        """存有這個字的分片編號，沒有則為 None"""
+        return self.index[char][0] if char in self.index else None
+
+    def read(self, char):
+        """從存有這個字的分片讀出 PNG bytes；字型缺字或尚未生成時回傳 None"""
+        if char not in self.index:
+            return None
+        shard, entry = self.index[char]
+        if entry["status"] != "done":
+            return None
+        with open(shard_paths(self.archive_dir, shard)[0], "rb") as f:
+            f.seek(entry["offset"])
+            return f.read(entry["length"])
+
+    def _record(self, entry):
+        self._manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._manifest.flush()
+        os.fsync(self._manifest.fileno())
+        self.entries[entry["char"]] = entry
+        self.index[entry["char"]] = (self.shard, entry)
+
+    def append(self, char, image):
+        buf = io.BytesIO()
+        image.save(buf, format="PNG")
+        data = buf.getvalue()
+        offset = self._bin.tell()
+        self._bin.write(data)
+        self._bin.flush()
+        os.fsync(self._bin.fileno())
+        self._record({"char": char, "status": "done", "offset": offset, "length": len(data)})
+
+    def append_missing(self, char):
+        """字型裡沒有的字也記下來，續跑時不必再檢查"""
+        self._record({"char": char, "status": "missing", "offset": 0, "length": 0})
+
+    def close(self):
+        self._bin.close()
+        self._manifest.close()
+
+
+def read_manifest(manifest_path):
+    entries = {}
+    if not os.path.exists(manifest_path):
+        return entries
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # 最後一行可能在寫入時中斷
+                continue
+            entries[entry["char"]] = entry
+    return entries
+
+
+def archive_index(archive_dir):
+    """所有分片的完成紀錄 {字元: (分片編號, 紀錄)}
+
+    同一個字出現在多個分片時 (例如改變 worker 數之前的舊版本重複生成過) 取編號最小的分片
+    """
+    index = {}
+    for shard in archive_shards(archive_dir):
+        for char, entry in read_manifest(shard_paths(archive_dir, shard)[1]).items():
+            index.setdefault(char, (shard, entry))
+    return index
+
+
+def completed_characters(archive_dir):
+    """所有分片中已完成 (含字型缺字) 的字"""
+    return set(archive_index(archive_dir))
+
+
+def iter_archive(archive_dir):
+    """依分片順序讀出封存目錄裡所有已完成的 (字元, PNG bytes)，每個字只從存有它的分片讀一次"""
+    by_shard = {}
+    for char, (shard, entry) in archive_index(archive_dir).items():
+        if entry["status"] == "done":
+            by_shard.setdefault(shard, []).append(entry)
+    for shard in sorted(by_shard):
+        with open(shard_paths(archive_dir, shard)[0], "rb") as f:
+            for entry in by_shard[shard]:
+                f.seek(entry["offset"])
+                yield entry["char"], f.read(entry["length"])
+
+
+def export_archive(archive_dir, image_dir):
+    """把封存檔展開成 {unicode}.png，供 create_ttf_from_images 使用"""
+    os.makedirs(image_dir, exist_ok=True)
+    image_paths = []
+    for char, data in iter_archive(archive_dir):
+        image_path = os.path.join(image_dir, f"{ord(char)}.png")
+        with open(image_path, "wb") as f:
+            f.write(data)
+        image_paths.append(image_path)
+    return image_paths
+
+
+def generate_into_archive(args, pipe, characters, style_image, archive, chunk_size=None, progress=None):
+    """生成 archive 中還沒有的字，每個 chunk 完成就寫入封存檔
+
+    progress(n) 在每個 chunk 寫入後被呼叫，n 為這個 chunk 處理的字數
+    """
+    chunk_size = chunk_size or args.chunk_size
+    pending = [char for char in characters if char not in archive]
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        out_images = sampling_batch(args=args, pipe=pipe, characters=chunk,
+                                    style_image=style_image, chunk_size=chunk_size)
+        for char, out_image in zip(chunk, out_images):
+            if out_image is None:
+                archive.append_missing(char)
+            else:
+                archive.append(char, out_image)
+        if progress is not None:
+            progress(len(chunk))
+
+
+def _worker(shard, characters, args, num_threads, progress_queue):
+    torch.set_num_threads(num_threads)
+    archive = None
+    try:
+        pipe = load_fontdiffuer_pipeline(args=args)
+        style_image = Image.open(args.style_image_path).convert("RGB")
+        archive = GlyphArchive(args.archive_dir, shard)
+        generate_into_archive(args, pipe, characters, style_image, archive,
+                              progress=lambda n: progress_queue.put(("progress", shard, n)))
+        progress_queue.put(("done", shard, None))
+    except Exception as e:
+        progress_queue.put(("error", shard, repr(e)))
+        raise
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def run(args):
+    style_image = Image.open(args.style_image_path).convert("RGB")
+    prepare_archive_dir(args.archive_dir, run_config(args, style_image), reset_on_mismatch=args.reset)
+
+    characters = read_charset(args.charset_path)
+    done = completed_characters(args.archive_dir)
+    remaining = [char for char in characters if char not in done]
+    print(f"🔢 字元集共 {len(characters)} 字，已完成 {len(characters) - len(remaining)} 字，"
+          f"剩餘 {len(remaining)} 字")
+
+    if remaining:
+        num_workers = max(1, min(args.num_workers, len(remaining)))
+        num_threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        # 字依序輪流分配給各分片；分片編號固定，續跑時各 worker 接著寫自己的封存檔
+        shards = [remaining[shard::num_workers] for shard in range(num_workers)]
+
+        ctx = mp.get_context("spawn")
+        progress_queue = ctx.Queue()
+        workers = [ctx.Process(target=_worker, args=(shard, shards[shard], args, num_threads, progress_queue))
+                   for shard in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        print(f"🚀 啟動 {num_workers} 個 worker，每個 {num_threads} 個 thread")
+
+        start = time.time()
+        finished, running, failed = 0, set(range(num_workers)), []
+        while running:
+            try:
+                kind, shard, value = progress_queue.get(timeout=5)
+            except queue.Empty:
+                dead = [shard for shard in running if not workers[shard].is_alive()]
+                for shard in dead:
+                    failed.append(shard)
+                    running.discard(shard)
+                continue
+            if kind == "progress":
+                finished += value
+                elapsed = time.time() - start
+                speed = finished / elapsed
+                eta = (len(remaining) - finished) / speed if speed > 0 else 0
+                sys.stdout.write(f"\r進度: {finished}/{len(remaining)} 字，{speed:.2f} 字/秒，"
+                                 f"ETA {format_seconds(eta)}")
+                sys.stdout.flush()
+            else:
+                running.discard(shard)
+                if kind == "error":
+                    print(f"\n❌ shard {shard} 失敗: {value}")
+                    failed.append(shard)
+        for worker in workers:
+            worker.join()
+        print()
+        if failed:
+            raise SystemExit(f"shard {sorted(set(failed))} 未完成，重新執行同樣的指令即可從中斷處繼續")
+
+    print(f"✅ 完成，封存於 {args.archive_dir}")
+    if args.export_dir:
+        image_paths = export_archive(args.archive_dir, args.export_dir)
+        print(f"✅ 已輸出 {len(image_paths)} 張字圖到 {args.export_dir}")
+
+
+def charset_arg_parse():
+    def add_arguments(parser):
+        parser.add_argument("--charset_path", type=str, default="big5_4808.txt",
+                            help="The text file of the characters to generate.")
+        parser.add_argument("--archive_dir", type=str, default="generated_charset",
+                            help="The directory of the append-only shard archives and manifests.")
+        parser.add_argument("--export_dir", type=str, default=None,
+                            help="If set, unpack the archive into {unicode}.png files here when finished.")
+        parser.add_argument("--num_workers", type=int, default=1,
+                            help="The number of worker processes (shards).")
+        parser.add_argument("--threads_per_worker", type=int, default=None,
+                            help="torch threads per worker, default cpu_count // num_workers.")
+        parser.add_argument("--reset", action="store_true",
+                            help="Discard the archive if it was generated with a different config.")
+
+    args = arg_parse(add_arguments=add_arguments)
+    args.demo = True
+    args.character_input = True
+    assert args.ckpt_dir is not None, "The ckpt_dir should not be None."
+    assert args.style_image_path is not None, "The style_image_path should not be None."
+    return args
+
+
+if __name__ == "__main__":
+    run(charset_arg_parse())
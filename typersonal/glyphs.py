@@ -0,0 +1,144 @@
+"""
+Content-glyph service: render the content characters of a TTF once and serve them from memory.
+
+    # Optional: precompute every glyph of the font at the content size (memory-mapped at startup)
+    python glyphs.py --ttf_path ttf/KaiXinSongA.ttf --content_image_size 96
+"""
+
+import os
+import argparse
+import threading
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from utils import load_ttf, ttf2im, font_codepoints
+
+
+def glyph_archive_path(ttf_path, content_size):
+    return f"{os.path.splitext(ttf_path)[0]}.{content_size[0]}x{content_size[1]}.glyphs.npy"
+
+
+class GlyphService:
+    """Content glyphs of one font at one content size.
+
+    The font and its cmap are loaded once. Rendered glyphs are kept as uint8 gray images in an LRU cache,
+    or read from a precomputed memory-mapped archive (see `build_archive`), and converted to the
+    normalized content tensor of the pipeline on request.
+
+    Args:
+        ttf_path: the content font.
+        content_size: the (height, width) of the content images.
+        cache_size: the number of glyphs kept in the LRU cache.
+        archive_path: a `.npy` archive written by `build_archive`, `None` to render on demand.
+    """
+
+    def __init__(self, ttf_path, content_size=(96, 96), cache_size=4096, archive_path=None):
+        self.ttf_path = ttf_path
+        self.content_size = tuple(content_size)
+        self.codepoints = font_codepoints(ttf_path)
+        self.font = load_ttf(ttf_path=ttf_path)
+        # pygame fonts are not thread-safe
+        self._render_lock = threading.Lock()
+        self._resize = transforms.Resize(self.content_size, interpolation=transforms.InterpolationMode.BILINEAR)
+        self._gray = lru_cache(maxsize=cache_size)(self._render_gray)
+
+        self.archive = None
+        self.archive_index = {}
+        if archive_path is not None and os.path.exists(archive_path):
+            self.archive = np.load(archive_path, mmap_mode="r")
+            codepoints = np.load(archive_path[:-len(".npy")] + ".codepoints.npy")
+            self.archive_index = {int(codepoint): row for row, codepoint in enumerate(codepoints)}
+            assert self.archive.shape[1:] == self.content_size, \
+                f"The glyph archive {archive_path} is not at the content size {self.content_size}."
+
+    def has_char(self, char):
+        return ord(char) in self.codepoints
+
+    def render(self, char):
+        """The 128x128 RGB PIL image of `char` as `utils.ttf2im` renders it, `None` if not in the font."""
+        if not self.has_char(char):
+            return None
+        with self._render_lock:
+            return ttf2im(font=self.font, char=char)
+
+    def _render_gray(self, char):
+        image = self.render(char)
+        if image is None:
+            return None
+        return np.asarray(self._resize(image).convert("L"))
+
+    def gray(self, char):
+        """The uint8 (height, width) content image of `char`, `None` if not in the font."""
+        row = self.archive_index.get(ord(char))
+        if row is not None:
+            return self.archive[row]
+        return self._gray(char)
+
+    def content_tensor(self, char):
+        """The normalized (3, height, width) content tensor of `char`, `None` if not in the font.
+
+        Same values as `Resize -> ToTensor -> Normalize([0.5], [0.5])` on the rendered glyph.
+        """
+        gray = self.gray(char)
+        if gray is None:
+            return None
+        tensor = torch.from_numpy(np.array(gray, dtype=np.float32)).div_(127.5).sub_(1.0)
+        return tensor.expand(3, *self.content_size)
+
+    def content_batch(self, characters):
+        """Stack the content tensors of `characters`.
+
+        Returns the indices of the characters in the font and their (N, 3, height, width) tensor
+        (`None` if there is none).
+        """
+        valid_indices, tensors = [], []
+        for index, char in enumerate(characters):
+            tensor = self.content_tensor(char)
+            if tensor is None:
+                continue
+            valid_indices.append(index)
+            tensors.append(tensor)
+        return valid_indices, (torch.stack(tensors) if tensors else None)
+
+    def build_archive(self, archive_path=None):
+        """Render every glyph of the font at the content size into a `.npy` archive."""
+        archive_path = archive_path or glyph_archive_path(self.ttf_path, self.content_size)
+        codepoints, images = [], []
+        for codepoint in sorted(self.codepoints):
+            gray = self._render_gray(chr(codepoint))
+            if gray is None:
+                continue
+            codepoints.append(codepoint)
+            images.append(gray)
+        np.save(archive_path, np.stack(images))
+        np.save(archive_path[:-len(".npy")] + ".codepoints.npy", np.asarray(codepoints, dtype=np.int64))
+        return archive_path
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_glyph_service(ttf_path, content_size):
+    """The shared `GlyphService` of a font and content size; uses the default archive if it was built."""
+    key = (os.path.abspath(ttf_path), tuple(content_size))
+    with _services_lock:
+        if key not in _services:
+            _services[key] = GlyphService(
+                ttf_path, content_size, archive_path=glyph_archive_path(ttf_path, content_size))
+        return _services[key]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the content glyph archive of a font.")
+    parser.add_argument("--ttf_path", type=str, default="ttf/KaiXinSongA.ttf")
+    parser.add_argument("--content_image_size", type=int, default=96)
+    args = parser.parse_args()
+
+    content_size = (args.content_image_size, args.content_image_size)
+    service = GlyphService(args.ttf_path, content_size)
+    path = service.build_archive()
+    print(f"Saved {len(service.codepoints)} glyphs of {args.ttf_path} to {path}")
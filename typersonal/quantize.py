@@ -0,0 +1,174 @@
+"""
+int8 量化推論模式：校正、快取與準確度報告
+
+    # 校正並把量化後的 state_dict 存到 ckpt 目錄，再輸出與 fp32 的比較報告
+    python quantize.py --ckpt_dir ckpt --ttf_path ttf/KaiXinSongA.ttf --report
+
+    # 之後的推論加上 --int8 (或 FastAPI 設定 AI_INT8=1) 會直接讀取快取
+    python sample.py --ckpt_dir ckpt --int8 ...
+
+encoder 的 SNConv2d / SNLinear 先凍結成一般的 nn.Conv2d / nn.Linear (見 freeze_sn.py)；
+UNet 與 encoder 的 nn.Conv2d 以靜態 int8 執行 (用參考字圖校正)，
+nn.Linear (attention 投影、FFN) 以動態 int8 執行；DeformConv2d 與其 offset 投影維持 fp32。
+"""
+
+import os
+import copy
+import time
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from sample import arg_parse, load_fontdiffuer_pipeline
+from src import FontDiffuserDPMPipeline, build_ddpm_scheduler
+from src.quantization import quantize_model, save_quantized, load_quantized
+from glyphs import get_glyph_service
+from utils import checkpoint_digest
+
+
+QUANTIZED_CKPT = "fontdiffuser_int8.pth"
+
+# 校正與報告使用的固定字集：筆畫由簡到繁
+CALIBRATION_CHARACTERS = "一人口大山水永字東風書龍鬱靈體藝"
+REPORT_CHARACTERS = "天地玄黃宇宙洪荒日月盈昃"
+
+
+def reference_glyphs(args, characters):
+    """把字型中的參考字轉成 content / style tensor；style 取下一個字，避免與 content 完全相同"""
+    glyph_service = get_glyph_service(args.ttf_path, args.content_image_size)
+    valid_indices, content_images = glyph_service.content_batch(characters)
+    characters = [characters[index] for index in valid_indices]
+    glyphs = [glyph_service.render(char) for char in characters]
+    style_transforms = transforms.Compose(
+        [transforms.Resize(args.style_image_size, interpolation=transforms.InterpolationMode.BILINEAR),
+         transforms.ToTensor(),
+         transforms.Normalize([0.5], [0.5])])
+    style_images = torch.stack([style_transforms(glyph) for glyph in glyphs[1:] + glyphs[:1]])
+    return characters, content_images, style_images
+
+
+def build_pipeline(args, model):
+    return FontDiffuserDPMPipeline(
+        model=model,
+        ddpm_train_scheduler=build_ddpm_scheduler(args=args),
+        model_type=args.model_type,
+        guidance_type=args.guidance_type,
+        guidance_scale=args.guidance_scale,
+    )
+
+
+def generate(args, pipe, content_images, style_images, num_inference_step=None, seed=0):
+    generator = torch.Generator(device=args.device).manual_seed(seed)
+    with torch.no_grad():
+        return pipe.generate_batch(
+            content_images=content_images.to(args.device),
+            style_images=style_images.to(args.device),
+            order=args.order,
+            num_inference_step=num_inference_step or args.num_inference_steps,
+            content_encoder_downsample_size=args.content_encoder_downsample_size,
+            chunk_size=args.chunk_size,
+            generator=generator,
+            t_start=args.t_start,
+            t_end=args.t_end,
+            dm_size=args.content_image_size,
+            algorithm_type=args.algorithm_type,
+            skip_type=args.skip_type,
+            method=args.method,
+            correcting_x0_fn=args.correcting_x0_fn)
+
+
+def quantize_with_calibration(args, model, characters=CALIBRATION_CHARACTERS):
+    """用參考字圖跑完整的取樣流程 (含 classifier-free guidance 的無條件分支) 來校正 activation 範圍"""
+    _, content_images, style_images = reference_glyphs(args, characters)
+
+    def calibrate(prepared_model):
+        generate(args, build_pipeline(args, prepared_model), content_images, style_images)
+
+    return quantize_model(model, calibrate)
+
+
+def load_or_quantize_model(args, model):
+    """讀取 ckpt 目錄中的量化快取；沒有快取或 checkpoint 已更新時，重新校正並寫入快取"""
+    path = os.path.join(args.ckpt_dir, QUANTIZED_CKPT)
+    digest = checkpoint_digest(args.ckpt_dir)
+    if load_quantized(model, path, digest) is not None:
+        print(f"Loaded the int8 quantized model from {path}")
+        return model
+    print("Calibrating the int8 quantized model ......")
+    quantize_with_calibration(args, model)
+    save_quantized(model, path, digest)
+    print(f"Saved the int8 quantized model to {path}")
+    return model
+
+
+def psnr(a, b):
+    mse = np.mean((a - b) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def accuracy_report(args, fp32_pipe, int8_pipe, characters=REPORT_CHARACTERS, repeats=1):
+    """在固定字集上比較 fp32 與 int8 的輸出差異與速度"""
+    characters, content_images, style_images = reference_glyphs(args, characters)
+
+    def timed(pipe):
+        generate(args, pipe, content_images[:1], style_images[:1], num_inference_step=2)  # warm up
+        start = time.time()
+        for _ in range(repeats):
+            images = generate(args, pipe, content_images, style_images)
+        return images, (time.time() - start) / repeats
+
+    fp32_images, fp32_seconds = timed(fp32_pipe)
+    int8_images, int8_seconds = timed(int8_pipe)
+
+    print(f"\n{'字':<4}{'MAE':>8}{'PSNR (dB)':>12}")
+    maes, psnrs = [], []
+    for char, fp32_image, int8_image in zip(characters, fp32_images, int8_images):
+        a = np.asarray(fp32_image.convert("L"), dtype=np.float64)
+        b = np.asarray(int8_image.convert("L"), dtype=np.float64)
+        maes.append(np.abs(a - b).mean())
+        psnrs.append(psnr(a, b))
+        print(f"{char:<4}{maes[-1]:>8.2f}{psnrs[-1]:>12.2f}")
+    print(f"{'平均':<3}{np.mean(maes):>8.2f}{np.mean(psnrs):>12.2f}")
+
+    num_glyphs = len(characters)
+    print(f"\nfp32: {fp32_seconds:.2f}s ({fp32_seconds / num_glyphs:.3f}s/字)")
+    print(f"int8: {int8_seconds:.2f}s ({int8_seconds / num_glyphs:.3f}s/字)")
+    print(f"加速: {fp32_seconds / int8_seconds:.2f}x ({args.num_inference_steps} steps, "
+          f"{torch.get_num_threads()} threads)")
+    return {"mae": float(np.mean(maes)), "psnr": float(np.mean(psnrs)),
+            "fp32_seconds": fp32_seconds, "int8_seconds": int8_seconds}
+
+
+def quantize_arg_parse():
+    def add_arguments(parser):
+        parser.add_argument("--report", action="store_true",
+                            help="Compare the int8 model with fp32 on a fixed glyph set.")
+        parser.add_argument("--recalibrate", action="store_true",
+                            help="Ignore the cached int8 state_dict and calibrate again.")
+
+    args = arg_parse(add_arguments=add_arguments)
+    args.demo = True
+    args.int8 = False
+    assert args.ckpt_dir is not None, "The ckpt_dir should not be None."
+    return args
+
+
+if __name__ == "__main__":
+    args = quantize_arg_parse()
+    fp32_pipe = load_fontdiffuer_pipeline(args=args)
+
+    int8_model = copy.deepcopy(fp32_pipe.model)
+    if args.recalibrate:
+        path = os.path.join(args.ckpt_dir, QUANTIZED_CKPT)
+        quantize_with_calibration(args, int8_model)
+        save_quantized(int8_model, path, checkpoint_digest(args.ckpt_dir))
+        print(f"Saved the int8 quantized model to {path}")
+    else:
+        load_or_quantize_model(args, int8_model)
+
+    if args.report:
+        int8_pipe = build_pipeline(args, int8_model)
+        int8_pipe.prepare_unconditional_condition(content_size=args.content_image_size,
+                                                  style_size=args.style_image_size)
+        accuracy_report(args, fp32_pipe, int8_pipe)
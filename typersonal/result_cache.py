@@ -0,0 +1,66 @@
+"""
+Result cache of the blended glyphs (`blend_styles_latent`).
+
+The key covers everything the generated image depends on: the character, the uploaded style image (by pixel
+hash), the preset style glyph (by file stamp), the blend weight, the number of solver steps, the guidance
+scale and the model version. The stroke thickness is applied after the cache, so one entry serves every thickness.
+"""
+
+import os
+import threading
+
+from PIL import Image
+
+from utils import image_digest, model_version
+from tiered_cache import TieredLRUCache
+
+
+class ImageResultCache(TieredLRUCache):
+    """`TieredLRUCache` of PIL images, spilled as PNG files."""
+
+    suffix = ".png"
+
+    def dump(self, value, path):
+        value.save(path, format="PNG")
+
+    def load(self, path):
+        with Image.open(path) as image:
+            return image.convert("RGB")
+
+    def sizeof(self, value):
+        return value.width * value.height * len(value.getbands())
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_blend_cache(args):
+    """The process-wide blend result cache, configured by `--blend_cache_size` / `--blend_cache_mb` /
+    `--blend_cache_dir`."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            max_mb = getattr(args, "blend_cache_mb", 64)
+            _cache = ImageResultCache(max_entries=getattr(args, "blend_cache_size", 1024),
+                                      max_bytes=int(max_mb * 1024 * 1024) if max_mb else None,
+                                      spill_dir=getattr(args, "blend_cache_dir", None),
+                                      max_spill_entries=getattr(args, "blend_cache_disk_size", 100000))
+        return _cache
+
+
+def blend_cache_keys(args, character, image_a_digest, style_option, style_b_path, alphas, lattice_size=None):
+    """The keys of the blend weights `alphas`, from the `image_digest` of the uploaded image and one stat
+    of the style B glyph. `lattice_size` tags the images of one alpha lattice (`blend_styles_lattice`),
+    which share their starting noise and are only interpolated with each other."""
+    style_b_stat = os.stat(style_b_path)
+    style_b_stamp = (style_b_stat.st_mtime_ns, style_b_stat.st_size)
+    version = model_version(args)
+    return [("blend", character, image_a_digest, style_option, style_b_stamp,
+             round(alpha, 2), lattice_size, args.num_inference_steps, args.guidance_scale, version)
+            for alpha in alphas]
+
+
+def blend_cache_key(args, character, image_a, style_option, style_b_path, alpha, lattice_size=None):
+    return blend_cache_keys(args, character, image_digest(image_a), style_option, style_b_path, [alpha],
+                            lattice_size=lattice_size)[0]
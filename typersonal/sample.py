@@ -11,20 +11,29 @@ from accelerate.utils import set_seed
 
 from src import (FontDiffuserDPMPipeline,
                  FontDiffuserModelDPM,
+                 CompiledUNet,
+                 CompiledEncoder,
                  build_ddpm_scheduler,
                  build_unet,
                  build_content_encoder,
                  build_style_encoder)
-from utils import (ttf2im,
-                   load_ttf,
-                   is_char_in_font,
+from src.checkpoint import build_on_meta, checkpoint_file, load_weights
+from src.modules.attention import ATTENTION_BACKENDS, set_attention_backend
+from src.modules.deform_conv import DEFORM_CONV_BACKENDS, set_deform_conv_backend
+from glyphs import get_glyph_service
+from content_features import lookup_content_features
+from style_bank import BLEND_STYLE_SIZE
+from style_cache import encode_style_cached, concat_style_features, style_image_of
+from utils import (checkpoint_digest,
+                   encoder_variant,
                    save_args_to_yaml,
                    save_single_image,
                    save_image_with_content_style)
 
 
 # def arg_parse():
-def arg_parse(ignore_cli: bool = False):  # 👈 加這個 flag
+def arg_parse(ignore_cli: bool = False, add_arguments=None):  # 👈 加這個 flag
+    """`add_arguments(parser)` lets other scripts add their own options."""
     from configs.fontdiffuser import get_parser
 
     parser = get_parser()
@@ -41,6 +50,37 @@ def arg_parse(ignore_cli: bool = False):  # 👈 加這個 flag
                         help="The saving directory.")
     parser.add_argument("--device", type=str, default="cpu")
     parser.add_argument("--ttf_path", type=str, default="ttf/KaiXinSongA.ttf")
+    parser.add_argument("--chunk_size", type=int, default=8,
+                        help="The number of glyphs sampled together in one DPM-Solver loop.")
+    parser.add_argument("--freeze_sn", action="store_true",
+                        help="Fold the spectral norms of the encoders into plain convs (cached in ckpt_dir).")
+    parser.add_argument("--int8", action="store_true",
+                        help="Run the model with int8 quantized convs and linears (CPU only).")
+    parser.add_argument("--attention_backend", type=str, default="auto", choices=ATTENTION_BACKENDS,
+                        help="The attention implementation, compare them with benchmark_attention.py.")
+    parser.add_argument("--deform_conv_backend", type=str, default="torchvision", choices=DEFORM_CONV_BACKENDS,
+                        help="The deformable convolution implementation, compare them with benchmark_deform_conv.py.")
+    parser.add_argument("--compile_unet", action="store_true",
+                        help="Trace the UNet and the encoders for fixed batch sizes with TorchScript, cached in "
+                             "ckpt_dir/compiled.")
+    parser.add_argument("--compile_batch_sizes", type=str, default="2,4,8,16",
+                        help="The UNet batch sizes to compile (twice the glyphs per chunk with guidance).")
+    parser.add_argument("--onnx_dir", type=str, default=None,
+                        help="Run the ONNX models exported by export_onnx.py with ONNX Runtime instead of PyTorch.")
+    parser.add_argument("--onnx_threads", type=int, default=0,
+                        help="The intra-op threads of the ONNX Runtime sessions, 0 lets ORT decide.")
+    parser.add_argument("--style_cache_size", type=int, default=64,
+                        help="The number of reference style images whose encoder outputs are cached, 0 to disable.")
+    parser.add_argument("--style_cache_dir", type=str, default=None,
+                        help="Spill the style features evicted from memory to this directory.")
+    parser.add_argument("--blend_cache_size", type=int, default=1024,
+                        help="The number of blended glyphs cached in memory, 0 to disable.")
+    parser.add_argument("--blend_cache_mb", type=float, default=64,
+                        help="The memory budget of the blended glyph cache in MB, 0 for no limit.")
+    parser.add_argument("--blend_cache_dir", type=str, default=None,
+                        help="Spill the blended glyphs evicted from memory to this directory as PNG files.")
+    if add_arguments is not None:
+        add_arguments(parser)
     # args = parser.parse_args()
     args = parser.parse_args(args=[] if ignore_cli else None)
     style_image_size = args.style_image_size
@@ -56,10 +96,9 @@ def image_process(args, content_image=None, style_image=None):
         # Read content image and style image
         if args.character_input:
             assert args.content_character is not None, "The content_character should not be None."
-            if not is_char_in_font(font_path=args.ttf_path, char=args.content_character):
-                return None, None
-            font = load_ttf(ttf_path=args.ttf_path)
-            content_image = ttf2im(font=font, char=args.content_character)
+            content_image = get_glyph_service(args.ttf_path, args.content_image_size).render(args.content_character)
+            if content_image is None:
+                return None, None, None
             content_image_pil = content_image.copy()
         else:
             content_image = Image.open(args.content_image_path).convert('RGB')
@@ -69,10 +108,9 @@ def image_process(args, content_image=None, style_image=None):
         assert style_image is not None, "The style image should not be None."
         if args.character_input:
             assert args.content_character is not None, "The content_character should not be None."
-            if not is_char_in_font(font_path=args.ttf_path, char=args.content_character):
-                return None, None
-            font = load_ttf(ttf_path=args.ttf_path)
-            content_image = ttf2im(font=font, char=args.content_character)
+            content_image = get_glyph_service(args.ttf_path, args.content_image_size).render(args.content_character)
+            if content_image is None:
+                return None, None, None
         else:
             assert content_image is not None, "The content image should not be None."
         content_image_pil = None
@@ -93,20 +131,52 @@ def image_process(args, content_image=None, style_image=None):
 
     return content_image, style_image, content_image_pil
 
-def load_fontdiffuer_pipeline(args):
-    # Load the model state_dict
-    unet = build_unet(args=args)
-    unet.load_state_dict(torch.load(f"{args.ckpt_dir}/unet.pth"))
-    style_encoder = build_style_encoder(args=args)
-    style_encoder.load_state_dict(torch.load(f"{args.ckpt_dir}/style_encoder.pth"))
-    content_encoder = build_content_encoder(args=args)
-    content_encoder.load_state_dict(torch.load(f"{args.ckpt_dir}/content_encoder.pth"))
+def load_fontdiffuer_model(args):
+    # Build the modules on the meta device (skipping the random init) and map the checkpoint files into them.
+    unet = load_weights(build_on_meta(build_unet, args=args), checkpoint_file(args.ckpt_dir, "unet"))
+    style_encoder = build_on_meta(build_style_encoder, args=args)
+    content_encoder = build_on_meta(build_content_encoder, args=args)
+    freeze_sn = getattr(args, "freeze_sn", False)
+    int8 = getattr(args, "int8", False)
+    if freeze_sn and not int8:
+        # Load (or build) the serving checkpoint of the encoders with the spectral norms folded in.
+        # The int8 model always folds them, before quantizing the encoders.
+        from freeze_sn import load_or_freeze_encoders
+        load_or_freeze_encoders(args, style_encoder, content_encoder)
+    else:
+        load_weights(style_encoder, checkpoint_file(args.ckpt_dir, "style_encoder"))
+        load_weights(content_encoder, checkpoint_file(args.ckpt_dir, "content_encoder"))
     model = FontDiffuserModelDPM(
         unet=unet,
         style_encoder=style_encoder,
         content_encoder=content_encoder)
     model.to(args.device)
+    set_attention_backend(model, getattr(args, "attention_backend", "auto"))
+    # Inference only: keep the spectral-norm buffers fixed and disable dropout.
+    model.eval()
     print("Loaded the model state_dict successfully!")
+    if int8:
+        from quantize import load_or_quantize_model
+        model = load_or_quantize_model(args, model)
+    set_deform_conv_backend(model, getattr(args, "deform_conv_backend", "torchvision"))
+    return model
+
+
+def load_inference_model(args):
+    """The model that samples with `args`: the ONNX Runtime sessions with `--onnx_dir`, else the torch model."""
+    onnx_dir = getattr(args, "onnx_dir", None)
+    if onnx_dir:
+        # Run the exported graphs (see export_onnx.py) with ONNX Runtime on the CPU.
+        from src.onnx_backend import OnnxFontDiffuserModel
+        model = OnnxFontDiffuserModel(onnx_dir, num_threads=getattr(args, "onnx_threads", 0))
+        print("Loaded the ONNX Runtime sessions successfully!")
+        return model
+    return load_fontdiffuer_model(args)
+
+
+def load_fontdiffuer_pipeline(args):
+    onnx_dir = getattr(args, "onnx_dir", None)
+    model = load_inference_model(args)
 
     # Load the training ddpm_scheduler.
     train_scheduler = build_ddpm_scheduler(args=args)
@@ -120,12 +190,48 @@ def load_fontdiffuer_pipeline(args):
         guidance_type=args.guidance_type,
         guidance_scale=args.guidance_scale,
     )
+    # Precompute the unconditional encoder features of classifier-free guidance.
+    uncond_condition = pipe.prepare_unconditional_condition(
+        content_size=args.content_image_size,
+        style_size=args.style_image_size)
     print("Loaded dpm_solver pipeline sucessfully!")
 
+    if getattr(args, "compile_unet", False) and not onnx_dir:
+        start = time.time()
+        cache_key = checkpoint_digest(args.ckpt_dir)
+        if getattr(args, "int8", False):
+            from src.quantization import QUANTIZED_VERSION
+            cache_key += f"-int8v{QUANTIZED_VERSION}"
+        # The traces bake in the attention and deformable convolution implementations.
+        cache_key += f"-{getattr(args, 'attention_backend', 'auto')}"
+        if getattr(args, "deform_conv_backend", "torchvision") != "torchvision":
+            cache_key += f"-{args.deform_conv_backend}"
+        batch_sizes = [int(size) for size in args.compile_batch_sizes.split(",")]
+        cache_dir = os.path.join(args.ckpt_dir, "compiled")
+        model.compiled_unet = CompiledUNet(
+            unet=model.unet,
+            content_encoder_downsample_size=args.content_encoder_downsample_size,
+            batch_sizes=batch_sizes,
+            cache_dir=cache_dir,
+            cache_key=cache_key).compile(uncond_condition, sample_size=args.content_image_size)
+
+        # The content encoder runs on the glyphs of a chunk (half the UNet batch with guidance) and on the
+        # style image, the style encoder on the style image and on the blended styles.
+        encoder_key = f"{checkpoint_digest(args.ckpt_dir)}-{encoder_variant(args)}"
+        glyph_batch_sizes = sorted({max(size // 2, 1) for size in batch_sizes})
+        model.compiled_content_encoder = CompiledEncoder(
+            model.content_encoder, "content_encoder", cache_dir=cache_dir, cache_key=encoder_key).compile(
+            [(size, *args.content_image_size) for size in glyph_batch_sizes] + [(1, *args.style_image_size)])
+        model.compiled_style_encoder = CompiledEncoder(
+            model.style_encoder, "style_encoder", cache_dir=cache_dir, cache_key=encoder_key).compile(
+            [(1, *args.style_image_size), (1, *BLEND_STYLE_SIZE)])
+        print(f"Compiled the unet for batch sizes {args.compile_batch_sizes} and the encoders, "
+              f"costing time {time.time() - start}s")
+
     return pipe
 
 
-def sampling(args, pipe, content_image=None, style_image=None):
+def sampling(args, pipe, content_image=None, style_image=None, callback=None, callback_steps=1):
     if not args.demo:
         os.makedirs(args.save_image_dir, exist_ok=True)
         # saving sampling config
@@ -134,14 +240,23 @@ def sampling(args, pipe, content_image=None, style_image=None):
     if args.seed:
         set_seed(seed=args.seed)
     
+    style_image_pil = style_image
     content_image, style_image, content_image_pil = image_process(args=args, 
                                                                   content_image=content_image, 
-                                                                  style_image=style_image)
+                                                                  style_image=style_image_of(style_image))
     if content_image == None:
         print(f"The content_character you provided is not in the ttf. \
                 Please change the content_character or you can change the ttf.")
         return None
 
+    content_features = None
+    if args.character_input:
+        content_features = lookup_content_features(args, [args.content_character], args.device)
+    # In demo mode the same uploaded style image is usually reused by many requests.
+    style_features = None
+    if args.demo:
+        style_features = encode_style_cached(args, pipe, style_image_pil)
+
     with torch.no_grad():
         content_image = content_image.to(args.device)
         style_image = style_image.to(args.device)
@@ -160,7 +275,11 @@ def sampling(args, pipe, content_image=None, style_image=None):
             algorithm_type=args.algorithm_type,
             skip_type=args.skip_type,
             method=args.method,
-            correcting_x0_fn=args.correcting_x0_fn)
+            correcting_x0_fn=args.correcting_x0_fn,
+            callback=callback,
+            callback_steps=callback_steps,
+            content_features=content_features,
+            style_features=style_features)
         end = time.time()
 
         if args.save_image:
@@ -184,6 +303,82 @@ def sampling(args, pipe, content_image=None, style_image=None):
         return images[0]
 
 
+def seeded_noise(seed, batch_size, size):
+    """The starting noise of `batch_size` glyphs, each drawn from its own generator seeded with `seed`.
+
+    A glyph then starts from the noise `sampling` draws for it alone, whatever its position in the batch.
+    """
+    noise = torch.randn((1, 3, *size), generator=torch.Generator().manual_seed(seed))
+    return noise.repeat(batch_size, 1, 1, 1)
+
+
+def sampling_batch(args, pipe, characters, style_image, chunk_size=None):
+    """Batched `sampling` for demo mode: many content characters with one shared style image,
+    or a list of style images (one per character).
+
+    Returns a list aligned with `characters`, `None` for the characters not in the ttf.
+    """
+    chunk_size = chunk_size or getattr(args, "chunk_size", 8)
+
+    glyphs = get_glyph_service(args.ttf_path, args.content_image_size)
+    style_inference_transforms = transforms.Compose(
+        [transforms.Resize(args.style_image_size, \
+                           interpolation=transforms.InterpolationMode.BILINEAR),
+         transforms.ToTensor(),
+         transforms.Normalize([0.5], [0.5])])
+
+    style_image_list = style_image if isinstance(style_image, (list, tuple)) else None
+
+    valid_indices, content_images = glyphs.content_batch(characters)
+    if len(valid_indices) < len(characters):
+        missing = set(range(len(characters))) - set(valid_indices)
+        print(f"The content_characters {''.join(characters[index] for index in sorted(missing))} "
+              f"are not in the ttf, skip them.")
+
+    results = [None] * len(characters)
+    if content_images is None:
+        return results
+
+    with torch.no_grad():
+        content_images = content_images.to(args.device)
+        if style_image_list is None:
+            style_images = style_inference_transforms(style_image_of(style_image))[None, :].to(args.device)
+            style_features = encode_style_cached(args, pipe, style_image)
+        else:
+            style_images = torch.stack([style_inference_transforms(style_image_of(style_image_list[index]))
+                                        for index in valid_indices]).to(args.device)
+            style_features = concat_style_features(
+                [encode_style_cached(args, pipe, style_image_list[index]) for index in valid_indices])
+        content_features = lookup_content_features(
+            args, [characters[index] for index in valid_indices], args.device)
+        latents = seeded_noise(args.seed, len(valid_indices), args.content_image_size) if args.seed else None
+        print(f"Sampling {len(valid_indices)} characters by DPM-Solver++ ......")
+        start = time.time()
+        images = pipe.generate_batch(
+            content_images=content_images,
+            style_images=style_images,
+            order=args.order,
+            num_inference_step=args.num_inference_steps,
+            content_encoder_downsample_size=args.content_encoder_downsample_size,
+            chunk_size=chunk_size,
+            content_features=content_features,
+            style_features=style_features,
+            latents=latents,
+            t_start=args.t_start,
+            t_end=args.t_end,
+            dm_size=args.content_image_size,
+            algorithm_type=args.algorithm_type,
+            skip_type=args.skip_type,
+            method=args.method,
+            correcting_x0_fn=args.correcting_x0_fn)
+        end = time.time()
+        print(f"Finish the batched sampling process, costing time {end - start}s")
+
+    for index, image in zip(valid_indices, images):
+        results[index] = image
+    return results
+
+
 def load_controlnet_pipeline(args,
                              config_path="lllyasviel/sd-controlnet-canny", 
                              ckpt_path="runwayml/stable-diffusion-v1-5"):
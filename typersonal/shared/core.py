@@ -1,17 +1,20 @@
 # typersonal/shared/core.py
 
 import os
+import copy
+import time
 import torch
 import numpy as np
 from PIL import Image
-import torchvision.transforms as T
 import cv2
-from src.dpm_solver.dpm_solver_pytorch import NoiseScheduleVP, model_wrapper, DPM_Solver
-from utils import ttf2im, load_ttf, is_char_in_font
-from sample import sampling
+from glyphs import get_glyph_service
+from content_features import lookup_content_features
+from style_cache import get_style_cache, encode_style, style_latent_cached, style_digest
+from result_cache import get_blend_cache, blend_cache_keys
+from style_bank import BLEND_STYLE_SIZE, lookup_style_latent
+from sample import sampling, sampling_batch
 
 
-cached_image = {}
 
 # 修正風格資料夾路徑
 # BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -26,84 +29,136 @@ STYLE_DIRS = {
     "可愛手繪": os.path.join(BASE_DIR, "cute_handdrawn")
 }
 
-def generate_image(character, sampling_step, style_image, args, pipe):
+def generate_image(character, sampling_step, style_image, args, pipe, callback=None, callback_steps=1):
+    """callback(step, total, x0_pred) 會每 callback_steps 步收到一次預測的 x0，用於串流預覽"""
+    # 複製 args，避免與其他請求同時修改同一份設定
+    args = copy.copy(args)
     args.character_input = True
     args.content_character = character
     args.num_inference_steps = sampling_step
     args.seed = 42  # 可改為 random
 
-    font = load_ttf(args.ttf_path)
-    if not is_char_in_font(args.ttf_path, character):
+    if not get_glyph_service(args.ttf_path, args.content_image_size).has_char(character):
         raise ValueError("Character not in TTF font")
 
-    content_image = ttf2im(font, character)
-
+    # character_input 模式下 sampling 會自行從字型服務取得內容字圖
     return sampling(
         args=args,
         pipe=pipe,
-        content_image=content_image,
+        content_image=None,
+        style_image=style_image,
+        callback=callback,
+        callback_steps=callback_steps
+    )
+
+
+def generate_image_previews(character, sampling_step, style_image, preview_every, preview_size, args, pipe, progress):
+    """串流用的 generate_image：每 preview_every 步呼叫 progress((step, total, 預覽圖))
+
+    預覽在推論端 (worker 程序或本程序的推論 thread) 就縮成灰階小圖，只有小圖經由 progress 傳回
+    """
+    def on_step(step, total, x0_pred):
+        progress((step, total, x0_to_preview(x0_pred, size=preview_size)))
+
+    return generate_image(character, sampling_step, style_image, args, pipe,
+                          callback=on_step, callback_steps=max(1, preview_every))
+
+
+def x0_to_preview(x0_pred, size=64):
+    """把預測的 x0 ([-1, 1] tensor) 轉成小張灰階預覽圖"""
+    gray = (x0_pred[0] / 2 + 0.5).clamp(0, 1).mean(dim=0)
+    image = Image.fromarray((gray.cpu().numpy() * 255).astype(np.uint8), mode="L")
+    return image.resize((size, size), Image.BILINEAR)
+
+
+def generate_images(characters, sampling_step, style_image, args, pipe):
+    """批次版 generate_image：一張共用風格圖（或每個字各一張）生成多個字，回傳與 characters 對齊的圖片 list"""
+    # 複製 args，避免與其他請求同時修改同一份設定
+    args = copy.copy(args)
+    args.character_input = True
+    args.num_inference_steps = sampling_step
+    args.seed = 42  # 可改為 random
+
+    return sampling_batch(
+        args=args,
+        pipe=pipe,
+        characters=characters,
         style_image=style_image
     )
 
 
-def sampling_with_latent(args, pipe, content_image, style_latent, thickness=0.0):
+WARMUP_CHARACTERS = "永一二三十人大中"
+
+
+def warm_up_batch(batch_size, sampling_step, args, pipe):
+    """以空白風格圖批次生成 batch_size 個字 (結果丟棄)，讓該批次大小的第一個真實請求不必付初始化成本
+    (kernel 選擇、記憶體配置、字型與取樣計畫的快取)，回傳花費秒數"""
+    glyphs = get_glyph_service(args.ttf_path, args.content_image_size)
+    characters = [character for character in WARMUP_CHARACTERS if glyphs.has_char(character)]
+    if not characters:
+        characters = [chr(codepoint) for codepoint in sorted(glyphs.codepoints) if chr(codepoint).isalnum()][:8]
+    characters = [characters[index % len(characters)] for index in range(batch_size)]
+    style_image = Image.new("RGB", tuple(args.style_image_size[::-1]), (255, 255, 255))
+    start = time.time()
+    generate_images(characters, sampling_step, style_image, args, pipe)
+    return time.time() - start
+
+
+def cache_stats(args, pipe):
+    """本程序 (API 程序或某個 worker) 的風格編碼快取與混合結果快取的命中統計"""
+    return {"style": get_style_cache(args).stats(), "blend": get_blend_cache(args).stats()}
+
+
+def encode_style_image(style_image, args, pipe):
+    """預先編碼一張參考風格圖 (生成用的 style 特徵與融合用的 latent)，回傳 EncodedStyle
+
+    之後的生成與融合可以用 EncodedStyle 取代原圖，直接使用編碼結果 (見 style_cache.EncodedStyle)
+    """
+    return encode_style(args, pipe, style_image, BLEND_STYLE_SIZE)
+
+
+def sampling_with_latents(args, pipe, content_image, style_latents, content_features=None):
+    """同一個字、多個風格 latent ([N, C, H, W]) 在一次 DPM-Solver 迴圈中批次生成，回傳 N 張 PIL 圖
+
+    所有 latent 共用同一份起始雜訊，結果只隨風格 latent 變化 (alpha lattice 的相鄰結果因此連續)
+    取樣走 pipeline 共用的 SamplingEngine，與一般生成同一條路徑 (含 classifier-free guidance)
+    """
     with torch.no_grad():
-        content_image = content_image.to(pipe.model.device)
-        style_latent = style_latent.to(pipe.model.device)
-
-        def forward_with_latent(x, t):
-            content_feat, content_res = pipe.model.content_encoder(content_image)
-            content_res.append(content_feat)
-            style_feat = style_latent
-            style_hidden = style_feat.permute(0, 2, 3, 1).reshape(style_feat.shape[0], -1, style_feat.shape[1])
-            style_content_feat, style_content_res = pipe.model.content_encoder(content_image)
-            style_content_res.append(style_content_feat)
-            output = pipe.model.unet(
-                x, t,
-                [style_feat, content_res, style_hidden, style_content_res],
-                args.content_encoder_downsample_size
-            )[0]
-            return output
-
-        noise_schedule = NoiseScheduleVP(schedule='discrete', betas=pipe.train_scheduler_betas)
-        model_fn = model_wrapper(
-            model=forward_with_latent,
-            noise_schedule=noise_schedule,
-            model_type=pipe.model_type,
-            guidance_type=pipe.guidance_type,
-            condition=None,
-            unconditional_condition=None,
-            guidance_scale=pipe.guidance_scale
-        )
-        dpm_solver = DPM_Solver(
-            model_fn=model_fn,
-            noise_schedule=noise_schedule,
-            algorithm_type=args.algorithm_type,
-            correcting_x0_fn=args.correcting_x0_fn
-        )
-        x_T = torch.randn((1, 3, args.content_image_size[0], args.content_image_size[1])).to(pipe.model.device)
-        x_sample = dpm_solver.sample(
-            x=x_T,
-            steps=args.num_inference_steps,
+        x_sample = pipe.engine.sample_latents(
+            content_image,
+            style_latents,
+            style_size=BLEND_STYLE_SIZE,
+            num_inference_step=args.num_inference_steps,
+            content_encoder_downsample_size=args.content_encoder_downsample_size,
+            content_features=content_features,
             order=args.order,
+            algorithm_type=args.algorithm_type,
             skip_type=args.skip_type,
             method=args.method,
+            correcting_x0_fn=args.correcting_x0_fn
         )
-        x_sample = (x_sample / 2 + 0.5).clamp(0, 1).cpu().permute(0, 2, 3, 1).numpy()
-        image = (x_sample[0] * 255).astype(np.uint8)
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        kernel = np.ones((3, 3), np.uint8)
-        if thickness < 0:
-            gray = cv2.dilate(gray, kernel, iterations=int(-thickness))
-        elif thickness > 0:
-            gray = cv2.erode(gray, kernel, iterations=int(thickness))
-        return Image.fromarray(cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB))
+    x_sample = (x_sample / 2 + 0.5).clamp(0, 1).cpu().permute(0, 2, 3, 1).numpy()
+    return [Image.fromarray((sample * 255).astype(np.uint8)) for sample in x_sample]
 
 
-def blend_styles_latent(character, image_a, style_option, alpha, thickness, args, pipe):
-    print(f"[blend] 字: {character}, 風格: {style_option}, alpha: {alpha}, thickness: {thickness}")
-    print(f"[blend] 上傳 image_a 大小: {image_a.size}, 模式: {image_a.mode}")
+def sampling_with_latent(args, pipe, content_image, style_latent, thickness=0.0, content_features=None):
+    image = sampling_with_latents(args, pipe, content_image, style_latent, content_features=content_features)[0]
+    return adjust_thickness(image, thickness)
+
 
+def adjust_thickness(image, thickness):
+    """筆畫粗細後處理：thickness > 0 侵蝕 (變粗)，< 0 膨脹 (變細)"""
+    gray = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
+    kernel = np.ones((3, 3), np.uint8)
+    if thickness > 0:
+        gray = cv2.erode(gray, kernel, iterations=int(thickness))
+    elif thickness < 0:
+        gray = cv2.dilate(gray, kernel, iterations=int(-thickness))
+    return Image.fromarray(cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB))
+
+
+def _style_b_path(character, style_option):
+    """預設風格中該字的 style B 圖檔路徑，輸入不合法或找不到圖時回傳 None"""
     if not isinstance(character, str) or len(character) != 1:
         print("[blend] ❌ 字元格式錯誤")
         return None
@@ -119,53 +174,101 @@ def blend_styles_latent(character, image_a, style_option, alpha, thickness, args
     if not os.path.exists(path):
         print(f"[blend] ❌ 找不到 style B 圖片: {path}")
         return None
+    return path
+
+
+def _blend_inputs(character, image_a, style_option, args, pipe, digest_a=None):
+    """融合所需的 (latent_a, latent_b, content_tensor, content_features)，無法處理時回傳 None
+    image_a 可以是 PIL 圖或 EncodedStyle；digest_a 為 image_a 已算好的像素雜湊"""
+    path = _style_b_path(character, style_option)
+    if path is None:
+        return None
+
+    content_tensor = get_glyph_service(args.ttf_path, args.content_image_size).content_tensor(character)
+    if content_tensor is None:
+        print("[blend] ❌ 該字不在 TTF 字型內")
+        return None
+    content_tensor = content_tensor[None, :].to(pipe.model.device)
+    content_features = lookup_content_features(args, [character], pipe.model.device)
+
+    # 同一張上傳圖只編碼一次 (以像素雜湊為 key 的快取)
+    latent_a = style_latent_cached(args, pipe, image_a, BLEND_STYLE_SIZE, digest=digest_a)
+    # 預設風格的 latent 由 style_bank.py 離線建好，直接查表；沒有建庫時才讀 PNG 編碼
+    latent_b = lookup_style_latent(args, STYLE_DIRS[style_option], character, pipe.model.device)
+    if latent_b is None:
+        image_b = Image.open(path).convert("RGB")
+        latent_b = style_latent_cached(args, pipe, image_b, BLEND_STYLE_SIZE)
+    return latent_a, latent_b, content_tensor, content_features
+
+
+def blend_styles_latent(character, image_a, style_option, alpha, thickness, args, pipe):
+    print(f"[blend] 字: {character}, 風格: {style_option}, alpha: {alpha}, thickness: {thickness}")
+    print(f"[blend] 上傳 image_a 大小: {image_a.size}, 模式: {image_a.mode}")
+
+    path = _style_b_path(character, style_option)
+    if path is None:
+        return None
 
-    image_b = Image.open(path).convert("RGB")
-    cache_key = (character, style_option, round(alpha, 2))
-    if cache_key in cached_image:
+    # key 含上傳圖的像素雜湊、風格圖檔、取樣步數與模型版本，不同使用者不會拿到彼此的結果
+    blend_cache = get_blend_cache(args)
+    digest_a = style_digest(image_a)
+    cache_key = blend_cache_keys(args, character, digest_a, style_option, path, [alpha])[0]
+    image = blend_cache.get(cache_key)
+    if image is not None:
         print("[blend] 使用快取圖像")
-        image = np.array(cached_image[cache_key])
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        kernel = np.ones((3, 3), np.uint8)
-        if thickness > 0:
-            gray = cv2.erode(gray, kernel, iterations=int(thickness))
-        elif thickness < 0:
-            gray = cv2.dilate(gray, kernel, iterations=int(-thickness))
-        return Image.fromarray(cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB))
-
-    tf = T.Compose([
-        T.Resize((128, 128)),
-        T.ToTensor(),
-        T.Normalize([0.5], [0.5])
-    ])
-    image_a_tensor = tf(image_a).unsqueeze(0).to(pipe.model.device)
-    image_b_tensor = tf(image_b).unsqueeze(0).to(pipe.model.device)
+        return adjust_thickness(image, thickness)
 
-    with torch.no_grad():
-        latent_a, _, _ = pipe.model.style_encoder(image_a_tensor)
-        latent_b, _, _ = pipe.model.style_encoder(image_b_tensor)
+    inputs = _blend_inputs(character, image_a, style_option, args, pipe, digest_a=digest_a)
+    if inputs is None:
+        return None
+    latent_a, latent_b, content_tensor, content_features = inputs
     fused_latent = (1 - alpha) * latent_a + alpha * latent_b
 
-    if not is_char_in_font(font_path=args.ttf_path, char=character):
-        print("[blend] ❌ 該字不在 TTF 字型內")
+    image = sampling_with_latents(args, pipe, content_tensor, fused_latent, content_features=content_features)[0]
+    blend_cache.put(cache_key, image)
+    return adjust_thickness(image, thickness)
+
+
+def blend_styles_lattice(character, image_a, style_option, alpha, thickness, lattice_size, args, pipe):
+    """滑桿用的融合：alpha = 0, 1/(n-1), ..., 1 共 lattice_size 張在一次批次取樣中生成並快取
+
+    之後同一組 (字、上傳圖、風格) 的任何 alpha 都由 lattice 取得：落在格點上直接回傳，
+    落在兩格之間則以相鄰兩張做像素內插，不再重新跑 diffusion。
+    """
+    print(f"[blend] 字: {character}, 風格: {style_option}, alpha: {alpha}, lattice: {lattice_size}")
+    lattice_size = max(2, int(lattice_size))
+    path = _style_b_path(character, style_option)
+    if path is None:
         return None
 
-    font = load_ttf(ttf_path=args.ttf_path)
-    content_image = ttf2im(font=font, char=character)
-    content_tf = T.Compose([
-        T.Resize(args.content_image_size, interpolation=T.InterpolationMode.BILINEAR),
-        T.ToTensor(),
-        T.Normalize([0.5], [0.5])
-    ])
-    content_tensor = content_tf(content_image)[None, :].to(pipe.model.device)
-
-    image = sampling_with_latent(args, pipe, content_tensor, fused_latent, thickness=0)
-    cached_image[cache_key] = image
-    image_np = np.array(image)
-    gray = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
-    kernel = np.ones((3, 3), np.uint8)
-    if thickness > 0:
-        gray = cv2.erode(gray, kernel, iterations=int(thickness))
-    elif thickness < 0:
-        gray = cv2.dilate(gray, kernel, iterations=int(-thickness))
-    return Image.fromarray(cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB))
+    position = min(max(float(alpha), 0.0), 1.0) * (lattice_size - 1)
+    lower = min(int(position), lattice_size - 2)
+    weight = position - lower
+    lattice_alphas = [index / (lattice_size - 1) for index in range(lattice_size)]
+
+    blend_cache = get_blend_cache(args)
+    # 上傳圖的雜湊與 style B 的 stat 只算一次，所有格點共用
+    digest_a = style_digest(image_a)
+    keys = blend_cache_keys(args, character, digest_a, style_option, path, lattice_alphas, lattice_size=lattice_size)
+    neighbours = [blend_cache.get(keys[lower]), blend_cache.get(keys[lower + 1])]
+    if any(image is None for image in neighbours):
+        inputs = _blend_inputs(character, image_a, style_option, args, pipe, digest_a=digest_a)
+        if inputs is None:
+            return None
+        latent_a, latent_b, content_tensor, content_features = inputs
+        alphas = torch.tensor(lattice_alphas, device=latent_a.device).view(-1, 1, 1, 1)
+        fused_latents = (1 - alphas) * latent_a + alphas * latent_b
+        lattice = sampling_with_latents(args, pipe, content_tensor, fused_latents, content_features=content_features)
+        for key, image in zip(keys, lattice):
+            blend_cache.put(key, image)
+        neighbours = lattice[lower:lower + 2]
+    else:
+        print("[blend] 使用快取 lattice")
+
+    if weight < 1e-6:
+        image = neighbours[0]
+    elif weight > 1 - 1e-6:
+        image = neighbours[1]
+    else:
+        image = Image.blend(neighbours[0], neighbours[1], weight)
+    return adjust_thickness(image, thickness)
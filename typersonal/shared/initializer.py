@@ -9,4 +9,24 @@ def init_args_and_pipe():
     args.ckpt_dir = os.path.join(base_dir, '..', 'ckpt')
     args.ttf_path = os.path.join(base_dir, '..', 'ttf', 'KaiXinSongA.ttf')
     args.device = 'cpu'
+    # AI_FREEZE_SN=1 時把 encoder 的 spectral norm 折進權重 (首次啟動會寫入 ckpt 目錄的 serving checkpoint)
+    args.freeze_sn = os.environ.get("AI_FREEZE_SN", "0") == "1"
+    # AI_INT8=1 時使用 int8 量化模型 (首次啟動會校正並快取在 ckpt 目錄)
+    args.int8 = os.environ.get("AI_INT8", "0") == "1"
+    # AI_ATTENTION_BACKEND：attention 實作 (auto / sdpa / chunked / reference)，可用 benchmark_attention.py 比較
+    args.attention_backend = os.environ.get("AI_ATTENTION_BACKEND", "auto")
+    # AI_DEFORM_CONV_BACKEND：可變形卷積實作 (torchvision / grid_sample)，可用 benchmark_deform_conv.py 比較
+    args.deform_conv_backend = os.environ.get("AI_DEFORM_CONV_BACKEND", "torchvision")
+    # AI_COMPILE_UNET=1 時在啟動時編譯 (或從快取載入) 固定 batch 大小的 UNet 與 style / content encoder
+    args.compile_unet = os.environ.get("AI_COMPILE_UNET", "0") == "1"
+    # AI_ONNX_DIR 指向 export_onnx.py 的輸出目錄時，改用 ONNX Runtime 推論
+    args.onnx_dir = os.environ.get("AI_ONNX_DIR") or None
+    args.onnx_threads = int(os.environ.get("AI_ONNX_THREADS", "0"))
+    # 參考風格圖的編碼結果快取：AI_STYLE_CACHE_SIZE 張常駐記憶體，設定 AI_STYLE_CACHE_DIR 時溢出到磁碟
+    args.style_cache_size = int(os.environ.get("AI_STYLE_CACHE_SIZE", "64"))
+    args.style_cache_dir = os.environ.get("AI_STYLE_CACHE_DIR") or None
+    # 混合結果快取：AI_BLEND_CACHE_SIZE 張、最多 AI_BLEND_CACHE_MB MB，設定 AI_BLEND_CACHE_DIR 時溢出到磁碟
+    args.blend_cache_size = int(os.environ.get("AI_BLEND_CACHE_SIZE", "1024"))
+    args.blend_cache_mb = float(os.environ.get("AI_BLEND_CACHE_MB", "64"))
+    args.blend_cache_dir = os.environ.get("AI_BLEND_CACHE_DIR") or None
     return args, load_fontdiffuer_pipeline(args)
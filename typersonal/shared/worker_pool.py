@@ -0,0 +1,254 @@
+# typersonal/shared/worker_pool.py
+"""
+多程序推論 worker pool
+
+模型權重只在 API 程序載入一次並移到共享記憶體 (model.share_memory())，
+worker 以 spawn 啟動時透過 torch.multiprocessing 對應同一份權重，RSS 不會隨 worker 數倍增。
+每個 worker 綁定一段 CPU 核心 (os.sched_setaffinity) 並設定自己的 torch.set_num_threads，
+API 程序經由本機 IPC queue 送出工作、取回結果；串流端點的進度 (例如每幾步的預覽圖) 也經由同一條 queue 傳回。
+每個 worker 另有自己的控制 queue，submit_to_each 經由它在每個 worker 各執行一次 (例如收集各自的快取統計)。
+torch 在建立 pool 時才 import，API 程序啟動時只讀設定 (configured_num_workers) 不必載入 torch。
+"""
+
+import os
+import queue
+import threading
+import itertools
+from concurrent.futures import Future
+
+
+# 閒置的 worker 多久檢查一次自己的控制 queue (秒)
+CONTROL_POLL_SECONDS = 0.2
+
+
+def split_cpus(num_workers, cpus=None):
+    """把可用的 CPU 核心切成 num_workers 段連續的區間"""
+    if cpus is None:
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") \
+            else list(range(os.cpu_count() or 1))
+    num_workers = max(1, min(num_workers, len(cpus)))
+    size, extra = divmod(len(cpus), num_workers)
+    slices, start = [], 0
+    for rank in range(num_workers):
+        end = start + size + (1 if rank < extra else 0)
+        slices.append(cpus[start:end])
+        start = end
+    return slices
+
+
+def _next_task(task_queue, control_queue):
+    """先取控制 queue 的工作，沒有時等共用 queue 的工作；兩者都沒有時回傳 ()"""
+    try:
+        return control_queue.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        return task_queue.get(timeout=CONTROL_POLL_SECONDS)
+    except queue.Empty:
+        return ()
+
+
+def _worker_main(rank, cpus, args, pipe, task_queue, control_queue, result_queue):
+    import torch
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    print(f"[worker {rank}] 綁定 CPU {cpus[0]}-{cpus[-1]}，{len(cpus)} threads")
+
+    while True:
+        task = _next_task(task_queue, control_queue)
+        if task == ():
+            continue
+        if task is None:
+            break
+        task_id, fn, fn_args, fn_kwargs, reports_progress = task
+        result_queue.put(("started", task_id, rank))
+        if reports_progress:
+            fn_kwargs = dict(fn_kwargs, progress=lambda value, task_id=task_id: result_queue.put(
+                ("progress", task_id, value)))
+        try:
+            with torch.no_grad():
+                result = fn(*fn_args, args, pipe, **fn_kwargs)
+            result_queue.put(("result", task_id, result))
+        except Exception as e:
+            # 例外不一定能 pickle，轉成字串傳回
+            result_queue.put(("error", task_id, f"{type(e).__name__}: {e}"))
+
+
+class InferenceWorkerPool:
+    """共用一份模型權重的推論程序池
+
+    submit(fn, *fn_args, **fn_kwargs) 會在某個 worker 中呼叫 fn(*fn_args, args, pipe, **fn_kwargs)，
+    例如 shared.core 的 generate_images / blend_styles_latent；fn 必須是可 import 的模組層級函式。
+    指定 progress 時 fn 另外收到 progress 參數，worker 端每次呼叫 progress(value)，
+    API 程序的 progress(value) 就在結果 thread 上依序收到 value (須可 pickle)。
+    submit_to_each 則在每個存活的 worker 各呼叫一次 fn (忙碌中的 worker 做完目前的工作後才執行)。
+
+    Args:
+        args: init_args_and_pipe 回傳的設定
+        pipe: 已載入的 pipeline，其模型權重會被移到共享記憶體
+        num_workers: worker 程序數
+        cpus: 可用的 CPU 核心，預設為目前程序的 affinity
+    """
+
+    def __init__(self, args, pipe, num_workers=2, cpus=None):
+        import torch.multiprocessing as mp
+
+        pipe.model.share_memory()
+        self.cpu_slices = split_cpus(num_workers, cpus)
+        self.num_workers = len(self.cpu_slices)
+
+        ctx = mp.get_context("spawn")
+        self._task_queue = ctx.Queue()
+        self._control_queues = [ctx.Queue() for _ in self.cpu_slices]
+        self._result_queue = ctx.Queue()
+        self._task_ids = itertools.count()
+        self._futures = {}
+        self._progress = {}
+        self._running_on = {}
+        self._pinned_to = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.workers = [
+            ctx.Process(target=_worker_main, daemon=True, name=f"inference-worker-{rank}",
+                        args=(rank, cpus, args, pipe, self._task_queue, self._control_queues[rank],
+                              self._result_queue))
+            for rank, cpus in enumerate(self.cpu_slices)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        self._dispatcher = threading.Thread(target=self._dispatch_results, daemon=True,
+                                            name="inference-worker-results")
+        self._dispatcher.start()
+
+    def _new_task(self, progress=None, rank=None):
+        if self._closed:
+            raise RuntimeError("InferenceWorkerPool is closed")
+        future = Future()
+        with self._lock:
+            task_id = next(self._task_ids)
+            self._futures[task_id] = future
+            if progress is not None:
+                self._progress[task_id] = progress
+            if rank is not None:
+                self._pinned_to[task_id] = rank
+        return task_id, future
+
+    def submit(self, fn, *fn_args, progress=None, **fn_kwargs):
+        """送出一個工作，回傳 concurrent.futures.Future"""
+        task_id, future = self._new_task(progress)
+        self._task_queue.put((task_id, fn, fn_args, fn_kwargs, progress is not None))
+        return future
+
+    def submit_to_each(self, fn, *fn_args, **fn_kwargs):
+        """在每個存活的 worker 各執行一次 fn，回傳 {rank: Future}"""
+        futures = {}
+        for rank, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                continue
+            task_id, futures[rank] = self._new_task(rank=rank)
+            self._control_queues[rank].put((task_id, fn, fn_args, fn_kwargs, False))
+        return futures
+
+    def run(self, fn, *fn_args, progress=None, **fn_kwargs):
+        """同步版 submit，等待並回傳結果"""
+        return self.submit(fn, *fn_args, progress=progress, **fn_kwargs).result()
+
+    def _dispatch_results(self):
+        while not self._closed:
+            try:
+                kind, task_id, value = self._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                self._fail_dead_workers()
+                continue
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                if kind == "started":
+                    self._running_on[task_id] = value
+                    continue
+                if kind == "progress":
+                    progress = self._progress.get(task_id)
+                else:
+                    future = self._futures.pop(task_id, None)
+                    self._progress.pop(task_id, None)
+                    self._running_on.pop(task_id, None)
+                    self._pinned_to.pop(task_id, None)
+            if kind == "progress":
+                if progress is not None:
+                    try:
+                        progress(value)
+                    except Exception as e:
+                        print(f"[worker pool] ❌ 進度回呼失敗: {e}")
+                continue
+            if future is None:
+                continue
+            if kind == "result":
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+    def _fail_dead_workers(self):
+        dead = {rank for rank, worker in enumerate(self.workers) if not worker.is_alive()}
+        if not dead:
+            return
+        with self._lock:
+            # 執行中的工作，以及排在死掉的 worker 控制 queue 裡的工作
+            lost = {task_id for task_id, rank in self._running_on.items() if rank in dead}
+            lost.update(task_id for task_id, rank in self._pinned_to.items() if rank in dead)
+            futures = [self._futures.pop(task_id) for task_id in lost]
+            for task_id in lost:
+                self._running_on.pop(task_id, None)
+                self._pinned_to.pop(task_id, None)
+                self._progress.pop(task_id, None)
+        for future in futures:
+            future.set_exception(RuntimeError("Inference worker died while running the task"))
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._futures)
+            running = len(self._running_on)
+        return {
+            "num_workers": self.num_workers,
+            "alive_workers": sum(worker.is_alive() for worker in self.workers),
+            "cpu_slices": self.cpu_slices,
+            "pending": pending,
+            "running": running,
+        }
+
+    def close(self, timeout=10.0):
+        if self._closed:
+            return
+        for _ in self.workers:
+            self._task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self._closed = True
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+            self._progress.clear()
+            self._pinned_to.clear()
+        for future in futures:
+            future.set_exception(RuntimeError("InferenceWorkerPool is closed"))
+
+
+def configured_num_workers():
+    """AI_WORKERS 設定的 worker 數 (不超過可用核心數)，0 表示不使用 worker pool"""
+    num_workers = int(os.environ.get("AI_WORKERS", "0"))
+    if num_workers <= 0:
+        return 0
+    return len(split_cpus(num_workers))
+
+
+def create_worker_pool_from_env(args, pipe):
+    """AI_WORKERS > 0 時建立 worker pool，否則回傳 None (維持在 API 程序內推論)"""
+    num_workers = configured_num_workers()
+    if num_workers <= 0:
+        return None
+    return InferenceWorkerPool(args, pipe, num_workers=num_workers)
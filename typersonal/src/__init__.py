@@ -1,7 +1,9 @@
 from .model import (FontDiffuserModel,
-                   FontDiffuserModelDPM)
+                   FontDiffuserModelDPM,
+                   EncodedCondition)
 from .criterion import ContentPerceptualLoss
 from .dpm_solver.pipeline_dpm_solver import FontDiffuserDPMPipeline
+from .compiled_unet import CompiledUNet, CompiledEncoder
 from .modules import (ContentEncoder,
                      StyleEncoder, 
                      UNet,
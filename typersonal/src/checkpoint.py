@@ -0,0 +1,104 @@
+import os
+import json
+import struct
+
+import torch
+
+
+# The dtypes of the safetensors format
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def checkpoint_file(ckpt_dir, name):
+    """The weights of the module `name` (e.g. "unet") in `ckpt_dir`.
+
+    Prefer `<name>.safetensors` (see convert_checkpoint.py), unless the `<name>.pth` it was converted from
+    has changed since, then fall back to the `.pth`.
+    """
+    pth_path = os.path.join(ckpt_dir, f"{name}.pth")
+    safetensors_path = os.path.join(ckpt_dir, f"{name}.safetensors")
+    if not os.path.exists(safetensors_path):
+        return pth_path
+    if os.path.exists(pth_path):
+        source = read_safetensors_header(safetensors_path).get("__metadata__", {}).get("source")
+        if source is not None and source != _source_stamp(pth_path):
+            print(f"{safetensors_path} is older than {pth_path}, loading the .pth")
+            return pth_path
+    return safetensors_path
+
+
+def read_safetensors_header(path):
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header["__data_start__"] = 8 + header_size
+    return header
+
+
+def load_safetensors_mmap(path):
+    """The tensors of a safetensors file, as views of one copy-on-write memory map of the file.
+
+    Nothing is read until a tensor is used, and the processes mapping the same file share its pages in the
+    page cache. (`safetensors.torch.load_file` copies every tensor into its own memory.)
+    """
+    header = read_safetensors_header(path)
+    data_start = header.pop("__data_start__")
+    header.pop("__metadata__", None)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    buffer = torch.empty(0, dtype=torch.uint8).set_(storage)
+    state_dict = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        data = buffer[data_start + begin:data_start + end]
+        if (data_start + begin) % data.new_empty(0, dtype=dtype).element_size():
+            data = data.clone()  # unaligned, can not be viewed in place
+        state_dict[name] = data.view(dtype).reshape(info["shape"])
+    return state_dict
+
+
+def load_checkpoint(path):
+    """Load a state_dict without reading it all into memory: memory-mapped safetensors, or a `.pth` loaded
+    with `mmap=True` (the zip format of `torch.save`; older pickles are read normally)."""
+    if path.endswith(".safetensors"):
+        return load_safetensors_mmap(path)
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        return torch.load(path, map_location="cpu")
+
+
+def save_safetensors(state_dict, path, source_path=None):
+    """Save a state_dict as safetensors, recording the stamp of the `.pth` it was converted from."""
+    from safetensors.torch import save_file
+
+    metadata = {"source": _source_stamp(source_path)} if source_path else None
+    # safetensors refuses tensors sharing memory, so save independent contiguous copies.
+    save_file({name: tensor.detach().contiguous().clone() for name, tensor in state_dict.items()}, path,
+              metadata=metadata)
+
+
+def build_on_meta(build_fn, *args, **kwargs):
+    """Construct a module on the meta device: no memory is allocated and the random init is skipped.
+    Load its weights with `load_weights`."""
+    with torch.device("meta"):
+        return build_fn(*args, **kwargs)
+
+
+def load_weights(module, path):
+    """Load the checkpoint at `path` into a module built by `build_on_meta`, using the loaded (memory-mapped)
+    tensors as its parameters instead of copying them."""
+    module.load_state_dict(load_checkpoint(path), assign=True)
+    left_on_meta = [name for name, tensor in [*module.named_parameters(), *module.named_buffers()]
+                    if tensor.is_meta]
+    assert not left_on_meta, f"{path} does not initialize {left_on_meta}."
+    return module
@@ -0,0 +1,238 @@
+import os
+import json
+import hashlib
+
+import torch
+import torch.nn as nn
+
+
+def flatten_condition(cond):
+    """Flatten the nested list condition into a tuple of tensors and a layout to rebuild it.
+
+    The layout is a nested tuple with `None` for a tensor leaf and a tuple for a list.
+    """
+    tensors = []
+
+    def _flatten(feature):
+        if torch.is_tensor(feature):
+            tensors.append(feature)
+            return None
+        return tuple(_flatten(f) for f in feature)
+
+    layout = _flatten(cond)
+    return tuple(tensors), layout
+
+
+def unflatten_condition(tensors, layout):
+    tensors = iter(tensors)
+
+    def _unflatten(node):
+        if node is None:
+            return next(tensors)
+        return [_unflatten(child) for child in node]
+
+    return _unflatten(layout)
+
+
+class _FlatUNet(nn.Module):
+    """Trace-friendly view of the UNet: flat tensor inputs, the noise prediction as the only output."""
+
+    def __init__(self, unet, layout, content_encoder_downsample_size):
+        super().__init__()
+        self.unet = unet
+        self.layout = layout
+        self.content_encoder_downsample_size = content_encoder_downsample_size
+
+    def forward(self, sample, timestep, *cond_tensors):
+        encoder_hidden_states = unflatten_condition(cond_tensors, self.layout)
+        return self.unet(
+            sample,
+            timestep,
+            encoder_hidden_states=encoder_hidden_states,
+            content_encoder_downsample_size=self.content_encoder_downsample_size,
+        )[0]
+
+
+class _FlatEncoder(nn.Module):
+    """Trace-friendly view of an encoder: the flattened tuple of its (nested) outputs."""
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, images):
+        return flatten_condition(self.encoder(images))[0]
+
+
+class _TraceCache:
+    """The traced modules of a `CompiledUNet` / `CompiledEncoder`, by input signature, saved in `cache_dir`."""
+
+    def __getstate__(self):
+        # Traced modules can not be pickled (e.g. to a worker process); they are reloaded from the cache.
+        state = self.__dict__.copy()
+        state["_traced"] = {}
+        state["_missing"] = set()
+        return state
+
+    def _path(self, signature):
+        raise NotImplementedError
+
+    def _load(self, path):
+        return torch.jit.load(path, map_location="cpu")
+
+    def _get(self, signature):
+        traced = self._traced.get(signature)
+        if traced is not None or signature in self._missing:
+            return traced
+        path = self._path(signature)
+        if path is not None and os.path.exists(path):
+            traced = self._load(path)
+            self._traced[signature] = traced
+        else:
+            self._missing.add(signature)
+        return traced
+
+
+class CompiledUNet(_TraceCache):
+    """TorchScript traces of the UNet forward for a few fixed batch-size buckets.
+
+    Each trace specializes the Python control flow of `UNet.forward` (the block dispatch, the residual
+    slicing and the list conditioning) for one input signature. The traces are saved in `cache_dir`,
+    keyed by `cache_key` (e.g. the checkpoint digest), so a restart only loads them. Calls with any
+    other signature return `None`, and the caller falls back to the eager UNet.
+
+    Args:
+        unet: the eager `UNet`.
+        content_encoder_downsample_size: baked into the traces.
+        batch_sizes: the UNet batch sizes to compile. With classifier-free guidance the UNet batch is
+            twice the number of glyphs.
+        cache_dir: where to save and load the traced modules, `None` to keep them in memory only.
+        cache_key: a string identifying the weights, part of the file names.
+    """
+
+    def __init__(self, unet, content_encoder_downsample_size, batch_sizes=(2, 4, 8, 16),
+                 cache_dir=None, cache_key=""):
+        self.unet = unet
+        self.content_encoder_downsample_size = content_encoder_downsample_size
+        self.batch_sizes = tuple(batch_sizes)
+        self.cache_dir = cache_dir
+        self.cache_key = cache_key
+        self._traced = {}
+        self._missing = set()
+
+    @staticmethod
+    def signature(sample, cond_tensors, layout):
+        return (tuple(sample.shape), tuple(tuple(t.shape) for t in cond_tensors), layout)
+
+    def _path(self, signature):
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(repr((self.cache_key, self.content_encoder_downsample_size,
+                                    torch.__version__, signature)).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"unet-b{signature[0][0]}-{digest}.pt")
+
+    def _trace(self, sample, timestep, cond_tensors, layout):
+        flat_unet = _FlatUNet(self.unet, layout, self.content_encoder_downsample_size).eval()
+        with torch.no_grad():
+            traced = torch.jit.trace(flat_unet, (sample, timestep, *cond_tensors), check_trace=False)
+            traced = torch.jit.freeze(traced)
+        return traced
+
+    def compile(self, cond, sample_size, channels=3):
+        """Trace (or load from the cache) every batch-size bucket.
+
+        Args:
+            cond: an `EncodedCondition` with batch size 1, e.g. the cached unconditional condition.
+            sample_size: the (height, width) of x_t.
+        """
+        for batch_size in self.batch_sizes:
+            cond_tensors, layout = flatten_condition(cond.expand(batch_size))
+            # Materialize the broadcast views, the traces are shared by expanded and concatenated inputs.
+            cond_tensors = tuple(t.contiguous() for t in cond_tensors)
+            sample = torch.randn(batch_size, channels, *sample_size, device=cond_tensors[0].device)
+            timestep = torch.full((batch_size,), 500.0, device=sample.device)
+            signature = self.signature(sample, cond_tensors, layout)
+            self._missing.discard(signature)
+            if self._get(signature) is not None:
+                continue
+            traced = self._trace(sample, timestep, cond_tensors, layout)
+            self._traced[signature] = traced
+            path = self._path(signature)
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                torch.jit.save(traced, path)
+        return self
+
+    def __call__(self, sample, timestep, cond):
+        """Run the traced UNet, return `None` if no trace matches the inputs."""
+        cond_tensors, layout = flatten_condition(cond)
+        traced = self._get(self.signature(sample, cond_tensors, layout))
+        if traced is None:
+            return None
+        if not torch.is_tensor(timestep) or timestep.dim() == 0:
+            timestep = torch.as_tensor(timestep, dtype=torch.float32, device=sample.device).reshape(-1)
+        timestep = timestep.to(torch.float32).expand(sample.shape[0])
+        return traced(sample, timestep, *cond_tensors)
+
+
+class CompiledEncoder(_TraceCache):
+    """TorchScript traces of a style or content encoder for a few fixed image shapes.
+
+    The encoders run once per request rather than per solver step, but the traces still drop their Python
+    dispatch and, frozen, fold the spectral-norm weights of the eval-mode `SNConv2d` layers into constants.
+    Like `CompiledUNet`, the traces are cached in `cache_dir` and calls with any other shape return `None`.
+
+    Args:
+        encoder: the eager `StyleEncoder` or `ContentEncoder`.
+        name: "style_encoder" or "content_encoder", part of the file names.
+        cache_dir: where to save and load the traced modules, `None` to keep them in memory only.
+        cache_key: a string identifying the weights, part of the file names.
+    """
+
+    def __init__(self, encoder, name, cache_dir=None, cache_key=""):
+        self.encoder = encoder
+        self.name = name
+        self.cache_dir = cache_dir
+        self.cache_key = cache_key
+        # signature -> (traced module, output layout)
+        self._traced = {}
+        self._missing = set()
+
+    def _path(self, signature):
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(repr((self.cache_key, torch.__version__, signature)).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{self.name}-b{signature[0]}-{digest}.pt")
+
+    def _load(self, path):
+        extra_files = {"layout.json": ""}
+        traced = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        return traced, json.loads(extra_files["layout.json"])
+
+    def compile(self, image_shapes, channels=3):
+        """Trace (or load from the cache) the encoder for every (batch size, height, width) of `image_shapes`."""
+        device = next(self.encoder.parameters()).device
+        for batch_size, height, width in image_shapes:
+            images = torch.randn(batch_size, channels, height, width, device=device)
+            signature = tuple(images.shape)
+            self._missing.discard(signature)
+            if self._get(signature) is not None:
+                continue
+            flat_encoder = _FlatEncoder(self.encoder).eval()
+            with torch.no_grad():
+                _, layout = flatten_condition(self.encoder(images))
+                traced = torch.jit.freeze(torch.jit.trace(flat_encoder, (images,), check_trace=False))
+            self._traced[signature] = (traced, layout)
+            path = self._path(signature)
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                torch.jit.save(traced, path, _extra_files={"layout.json": json.dumps(layout)})
+        return self
+
+    def __call__(self, images):
+        """Run the traced encoder, return `None` if no trace matches the images."""
+        compiled = self._get(tuple(images.shape))
+        if compiled is None:
+            return None
+        traced, layout = compiled
+        return unflatten_condition(traced(images), layout)
@@ -1,6 +1,12 @@
 import torch
 import torch.nn.functional as F
 import math
+import threading
+
+
+# The solver is shared by the inference threads; guards the evict and insert of `DPM_Solver.multistep_plans`
+# (module level, so the solver still pickles to the worker processes).
+_multistep_plans_lock = threading.Lock()
 
 
 class NoiseScheduleVP:
@@ -314,6 +320,8 @@ def model_wrapper(
             log_prob = classifier_fn(x_in, t_input, condition, **classifier_kwargs)
             return torch.autograd.grad(log_prob.sum(), x_in)[0]
 
+    cfg_condition_cache = {}
+
     def model_fn(x, t_continuous):
         """
         The noise predicition model function that is used for DPM-Solver.
@@ -333,9 +341,10 @@ def model_wrapper(
             elif model_kwargs["version"] == "V1" or model_kwargs["version"] == "V2_ConStyle" or model_kwargs["version"] == "V3":  # add this
                 x_in = torch.cat([x] * 2)
                 t_in = torch.cat([t_continuous] * 2)
-                c_in = []
-                c_in.append(torch.cat([unconditional_condition[0], condition[0]], dim=0))
-                c_in.append(torch.cat([unconditional_condition[1], condition[1]], dim=0))
+                # The conditions are fixed during sampling, so only concatenate them once.
+                if "c_in" not in cfg_condition_cache:
+                    cfg_condition_cache["c_in"] = cat_condition(unconditional_condition, condition)
+                c_in = cfg_condition_cache["c_in"]
                 noise_uncond, noise = noise_pred_fn(x_in, t_in, cond=c_in).chunk(2)
                 return noise_uncond + guidance_scale * (noise - noise_uncond)
             elif model_kwargs["version"] == "FG_Sep":
@@ -439,6 +448,9 @@ class DPM_Solver:
         self.correcting_xt_fn = correcting_xt_fn
         self.dynamic_thresholding_ratio = dynamic_thresholding_ratio
         self.thresholding_max_val = thresholding_max_val
+        # The precomputed multistep schedules, keyed by the sampling configuration (see `multistep_plan`).
+        self.multistep_plans = {}
+        self.max_multistep_plans = 64
 
     def dynamic_thresholding_fn(self, x0):
         """
@@ -468,6 +480,15 @@ class DPM_Solver:
             x0 = self.correcting_x0_fn(x0)
         return x0
 
+    def data_prediction_from_model(self, x, t, model_t):
+        """
+        Convert an output of `self.model_fn` at time `t` to the data prediction x0.
+        """
+        if self.algorithm_type == "dpmsolver++":
+            return model_t
+        alpha_t, sigma_t = self.noise_schedule.marginal_alpha(t), self.noise_schedule.marginal_std(t)
+        return (x - sigma_t * model_t) / alpha_t
+
     def model_fn(self, x, t):
         """
         Convert the model to the noise prediction model or the data prediction model. 
@@ -506,6 +527,125 @@ class DPM_Solver:
         else:
             raise ValueError("Unsupported skip_type {}, need to be 'logSNR' or 'time_uniform' or 'time_quadratic'".format(skip_type))
 
+    def multistep_plan(self, steps, order, skip_type, t_T, t_0, lower_order_final, solver_type, device):
+        """The precomputed schedule of a multistep DPM-Solver configuration, shared by all the samplings using it.
+
+        Returns:
+            A list of `steps + 1` dicts, one per time step, with the time `t` and the `alpha` / `sigma` of the
+            data prediction at `t`. From step 1 on, it also has the `order` of the update that reaches `t` and
+            its `coefficients`, so `multistep_plan_update` is pure tensor arithmetic.
+        """
+        if solver_type not in ['dpmsolver', 'taylor']:
+            raise ValueError("'solver_type' must be either 'dpmsolver' or 'taylor', got {}".format(solver_type))
+        key = (steps, order, skip_type, t_T, t_0, lower_order_final, solver_type, str(device))
+        plan = self.multistep_plans.get(key)
+        if plan is not None:
+            return plan
+
+        ns = self.noise_schedule
+        timesteps = self.get_time_steps(skip_type=skip_type, t_T=t_T, t_0=t_0, N=steps, device=device)
+        assert timesteps.shape[0] - 1 == steps
+        plan = []
+        for step in range(steps + 1):
+            t = timesteps[step]
+            log_alpha = ns.marginal_log_mean_coeff(t)
+            plan.append({"t": t, "log_alpha": log_alpha, "alpha": torch.exp(log_alpha),
+                         "sigma": ns.marginal_std(t), "lambda": ns.marginal_lambda(t)})
+        for step in range(1, steps + 1):
+            # The first `order` values are initialized by lower order multistep DPM-Solver,
+            # and we only use lower order for the final steps when steps < 10.
+            if step < order:
+                step_order = step
+            elif lower_order_final and steps < 10:
+                step_order = min(order, steps + 1 - step)
+            else:
+                step_order = order
+            plan[step]["order"] = step_order
+            plan[step]["coefficients"] = self._multistep_coefficients(plan[step - step_order:step], plan[step],
+                                                                      step_order, solver_type)
+
+        with _multistep_plans_lock:
+            if key in self.multistep_plans:
+                # Another thread built the same plan meanwhile
+                return self.multistep_plans[key]
+            if len(self.multistep_plans) >= self.max_multistep_plans:
+                self.multistep_plans.pop(next(iter(self.multistep_plans)))
+            self.multistep_plans[key] = plan
+        return plan
+
+    def _multistep_coefficients(self, prev, cur, order, solver_type):
+        """The coefficients of `multistep_dpm_solver_update` from the times of `prev` to the time of `cur`, with
+        the signs folded in: x_t = c["x"] * x + c["model"] * model_prev_0 + c["D1"] * D1 + c["D2"] * D2."""
+        lambda_t, sigma_t, alpha_t = cur["lambda"], cur["sigma"], cur["alpha"]
+        h = lambda_t - prev[-1]["lambda"]
+        if self.algorithm_type == "dpmsolver++":
+            phi_1 = torch.expm1(-h)
+            coefficients = {"x": sigma_t / prev[-1]["sigma"], "model": -(alpha_t * phi_1)}
+        else:
+            phi_1 = torch.expm1(h)
+            coefficients = {"x": torch.exp(cur["log_alpha"] - prev[-1]["log_alpha"]), "model": -(sigma_t * phi_1)}
+        if order == 1:
+            return coefficients
+
+        h_0 = prev[-1]["lambda"] - prev[-2]["lambda"]
+        r0 = h_0 / h
+        coefficients["inv_r0"] = 1. / r0
+        if order == 2:
+            if self.algorithm_type == "dpmsolver++":
+                if solver_type == 'dpmsolver':
+                    coefficients["D1"] = -(0.5 * (alpha_t * phi_1))
+                else:
+                    coefficients["D1"] = alpha_t * (phi_1 / h + 1.)
+            else:
+                if solver_type == 'dpmsolver':
+                    coefficients["D1"] = -(0.5 * (sigma_t * phi_1))
+                else:
+                    coefficients["D1"] = -(sigma_t * (phi_1 / h - 1.))
+            return coefficients
+
+        h_1 = prev[-2]["lambda"] - prev[-3]["lambda"]
+        r1 = h_1 / h
+        coefficients["inv_r1"] = 1. / r1
+        coefficients["D1_weight"] = r0 / (r0 + r1)
+        coefficients["inv_r01"] = 1. / (r0 + r1)
+        if self.algorithm_type == "dpmsolver++":
+            phi_2 = phi_1 / h + 1.
+            phi_3 = phi_2 / h - 0.5
+            coefficients["D1"] = alpha_t * phi_2
+            coefficients["D2"] = -(alpha_t * phi_3)
+        else:
+            phi_2 = phi_1 / h - 1.
+            phi_3 = phi_2 / h - 0.5
+            coefficients["D1"] = -(sigma_t * phi_2)
+            coefficients["D2"] = -(sigma_t * phi_3)
+        return coefficients
+
+    def multistep_plan_update(self, x, model_prev_list, entry):
+        """`multistep_dpm_solver_update` to the time step `entry` of a `multistep_plan`."""
+        c = entry["coefficients"]
+        order = entry["order"]
+        model_prev_0 = model_prev_list[-1]
+        x_t = c["x"] * x + c["model"] * model_prev_0
+        if order == 1:
+            return x_t
+        D1_0 = c["inv_r0"] * (model_prev_0 - model_prev_list[-2])
+        if order == 2:
+            return x_t + c["D1"] * D1_0
+        D1_1 = c["inv_r1"] * (model_prev_list[-2] - model_prev_list[-3])
+        D1 = D1_0 + c["D1_weight"] * (D1_0 - D1_1)
+        D2 = c["inv_r01"] * (D1_0 - D1_1)
+        return x_t + c["D1"] * D1 + c["D2"] * D2
+
+    def planned_model_fn(self, x, entry):
+        """`model_fn` at the time step `entry` of a `multistep_plan`, with its precomputed alpha_t and sigma_t."""
+        noise = self.noise_prediction_fn(x, entry["t"])
+        if self.algorithm_type != "dpmsolver++":
+            return noise
+        x0 = (x - entry["sigma"] * noise) / entry["alpha"]
+        if self.correcting_x0_fn is not None:
+            x0 = self.correcting_x0_fn(x0)
+        return x0
+
     def get_orders_and_timesteps_for_singlestep_solver(self, steps, order, skip_type, t_T, t_0, device):
         """
         Get the order of each step for sampling by the singlestep DPM-Solver.
@@ -1058,7 +1198,7 @@ class DPM_Solver:
 
     def inverse(self, x, steps=20, t_start=None, t_end=None, order=2, skip_type='time_uniform',
         method='multistep', lower_order_final=True, denoise_to_zero=False, solver_type='dpmsolver',
-        atol=0.0078, rtol=0.05, return_intermediate=False,
+        atol=0.0078, rtol=0.05, return_intermediate=False, callback=None,
     ):
         """
         Inverse the sample `x` from time `t_start` to `t_end` by DPM-Solver.
@@ -1073,7 +1213,7 @@ class DPM_Solver:
 
     def sample(self, x, steps=20, t_start=None, t_end=None, order=2, skip_type='time_uniform',
         method='multistep', lower_order_final=True, denoise_to_zero=False, solver_type='dpmsolver',
-        atol=0.0078, rtol=0.05, return_intermediate=False,
+        atol=0.0078, rtol=0.05, return_intermediate=False, callback=None,
     ):
         """
         Compute the sample at time `t_end` by DPM-Solver, given the initial `x` at time `t_start`.
@@ -1179,6 +1319,9 @@ class DPM_Solver:
             rtol: A `float`. The relative tolerance of the adaptive step size solver. Valid when `method` == 'adaptive'.
             return_intermediate: A `bool`. Whether to save the xt at each step.
                 When set to `True`, method returns a tuple (x0, intermediates); when set to False, method returns only x0.
+            callback: A function `callback(step, t, xt, x0_pred)` called after each step, e.g. for progressive previews.
+                `x0_pred` is the latest data prediction (for `method=multistep`), or `None` when it is not available.
+                Not supported by the adaptive solver.
         Returns:
             x_end: A pytorch tensor. The approximated solution at time `t_end`.
 
@@ -1188,6 +1331,8 @@ class DPM_Solver:
         assert t_0 > 0 and t_T > 0, "Time range needs to be greater than 0. For discrete-time DPMs, it needs to be in [1 / N, 1], where N is the length of betas array"
         if return_intermediate:
             assert method in ['multistep', 'singlestep', 'singlestep_fixed'], "Cannot use adaptive solver when saving intermediate values"
+        if callback is not None:
+            assert method in ['multistep', 'singlestep', 'singlestep_fixed'], "Cannot use adaptive solver with a callback"
         if self.correcting_xt_fn is not None:
             assert method in ['multistep', 'singlestep', 'singlestep_fixed'], "Cannot use adaptive solver when correcting_xt_fn is not None"
         device = x.device
@@ -1197,47 +1342,37 @@ class DPM_Solver:
                 x = self.dpm_solver_adaptive(x, order=order, t_T=t_T, t_0=t_0, atol=atol, rtol=rtol, solver_type=solver_type)
             elif method == 'multistep':
                 assert steps >= order
-                timesteps = self.get_time_steps(skip_type=skip_type, t_T=t_T, t_0=t_0, N=steps, device=device)
-                assert timesteps.shape[0] - 1 == steps
+                # The time steps and the update coefficients only depend on the configuration,
+                # so the loop below only runs the model and combines its outputs.
+                plan = self.multistep_plan(steps, order, skip_type, t_T, t_0, lower_order_final, solver_type, device)
                 # Init the initial values.
                 step = 0
-                t = timesteps[step]
-                t_prev_list = [t]
-                model_prev_list = [self.model_fn(x, t)]
+                t = plan[step]["t"]
+                model_prev_list = [self.planned_model_fn(x, plan[step])]
                 if self.correcting_xt_fn is not None:
                     x = self.correcting_xt_fn(x, t, step)
                 if return_intermediate:
                     intermediates.append(x)
-                # Init the first `order` values by lower order multistep DPM-Solver.
-                for step in range(1, order):
-                    t = timesteps[step]
-                    x = self.multistep_dpm_solver_update(x, model_prev_list, t_prev_list, t, step, solver_type=solver_type)
-                    if self.correcting_xt_fn is not None:
-                        x = self.correcting_xt_fn(x, t, step)
-                    if return_intermediate:
-                        intermediates.append(x)
-                    t_prev_list.append(t)
-                    model_prev_list.append(self.model_fn(x, t))
-                # Compute the remaining values by `order`-th order multistep DPM-Solver.
-                for step in range(order, steps + 1):
-                    t = timesteps[step]
-                    # We only use lower order for steps < 10
-                    if lower_order_final and steps < 10:
-                        step_order = min(order, steps + 1 - step)
-                    else:
-                        step_order = order
-                    x = self.multistep_dpm_solver_update(x, model_prev_list, t_prev_list, t, step_order, solver_type=solver_type)
+                if callback is not None:
+                    callback(step, t, x, self.data_prediction_from_model(x, t, model_prev_list[-1]))
+                # The first `order` values are initialized by lower order multistep DPM-Solver,
+                # the remaining ones by `order`-th order multistep DPM-Solver.
+                for step in range(1, steps + 1):
+                    t = plan[step]["t"]
+                    x = self.multistep_plan_update(x, model_prev_list, plan[step])
                     if self.correcting_xt_fn is not None:
                         x = self.correcting_xt_fn(x, t, step)
                     if return_intermediate:
                         intermediates.append(x)
-                    for i in range(order - 1):
-                        t_prev_list[i] = t_prev_list[i + 1]
-                        model_prev_list[i] = model_prev_list[i + 1]
-                    t_prev_list[-1] = t
+                    if step >= order:
+                        model_prev_list.pop(0)
                     # We do not need to evaluate the final model value.
                     if step < steps:
-                        model_prev_list[-1] = self.model_fn(x, t)
+                        model_prev_list.append(self.planned_model_fn(x, plan[step]))
+                    if callback is not None:
+                        # The final x is already the sample at time `t_end`.
+                        x0_pred = self.data_prediction_from_model(x, t, model_prev_list[-1]) if step < steps else x
+                        callback(step, t, x, x0_pred)
             elif method in ['singlestep', 'singlestep_fixed']:
                 if method == 'singlestep':
                     timesteps_outer, orders = self.get_orders_and_timesteps_for_singlestep_solver(steps=steps, order=order, skip_type=skip_type, t_T=t_T, t_0=t_0, device=device)
@@ -1257,6 +1392,8 @@ class DPM_Solver:
                         x = self.correcting_xt_fn(x, t, step)
                     if return_intermediate:
                         intermediates.append(x)
+                    if callback is not None:
+                        callback(step, t, x, None)
             else:
                 raise ValueError("Got wrong method {}".format(method))
             if denoise_to_zero:
@@ -1319,6 +1456,22 @@ def interpolate_fn(x, xp, yp):
     return cand
 
 
+def cat_condition(uncond, cond):
+    """
+    Concatenate the unconditional and the conditional inputs along the batch dimension.
+    The conditions can be tensors or (nested) lists of tensors, e.g. the encoded hidden states.
+
+    Args:
+        `uncond`: a PyTorch tensor or a list of them, for the unconditional branch.
+        `cond`: a PyTorch tensor or a list of them, with the same layout as `uncond`.
+    Returns:
+        the concatenated condition with the same layout (and list type) as `cond`.
+    """
+    if torch.is_tensor(cond):
+        return torch.cat([uncond, cond], dim=0)
+    return type(cond)(cat_condition(u, c) for u, c in zip(uncond, cond))
+
+
 def expand_dims(v, dims):
     """
     Expand the tensor `v` to the dim `dims`.
@@ -1,9 +1,9 @@
 import torch
 from PIL import Image
 
-from .dpm_solver_pytorch import (NoiseScheduleVP, 
-                                model_wrapper, 
-                                DPM_Solver)
+from ..model import map_condition
+from .dpm_solver_pytorch import NoiseScheduleVP
+from .sampling_engine import SamplingEngine
 
 class FontDiffuserDPMPipeline():
     """FontDiffuser pipeline with DPM_Solver scheduler.
@@ -29,6 +29,24 @@ class FontDiffuserDPMPipeline():
         self.guidance_type = guidance_type
         self.guidance_scale = guidance_scale
 
+        # Encoded all-ones (unconditional) inputs, keyed by (content size, style size, device)
+        self.uncond_condition_cache = {}
+        # The model wrapper and the solvers, shared by all the requests
+        self.engine = SamplingEngine(self)
+
+    def prepare_unconditional_condition(self, content_size, style_size):
+        """Encode the unconditional (all-ones) content and style images once for a resolution.
+        The classifier-free guidance branch then never runs the encoders on them again.
+        """
+        key = (tuple(content_size), tuple(style_size), str(self.model.device))
+        if key not in self.uncond_condition_cache:
+            uncond_content_images = torch.ones((1, 3, *content_size), device=self.model.device)
+            uncond_style_images = torch.ones((1, 3, *style_size), device=self.model.device)
+            with torch.no_grad():
+                self.uncond_condition_cache[key] = self.model.encode_condition(
+                    uncond_content_images, uncond_style_images)
+        return self.uncond_condition_cache[key]
+
     def numpy_to_pil(self, images):
         """Convert a numpy image or a batch of images to a PIL image.
         """
@@ -55,58 +73,76 @@ class FontDiffuserDPMPipeline():
         method="multistep",
         correcting_x0_fn=None,
         generator=None,
+        cache_condition=True,
+        callback=None,
+        callback_steps=1,
+        content_features=None,
+        style_features=None,
+        latents=None,
     ):
-        model_kwargs = {}
-        model_kwargs["version"] = self.version
-        model_kwargs["content_encoder_downsample_size"] = content_encoder_downsample_size
+        """Sample the glyph images by DPM-Solver.
+
+        `callback(step, num_inference_step, x0_pred)` is called every `callback_steps` solver steps
+        (and at the last one) with the current prediction of x0 in [-1, 1], for progressive previews.
+        `content_features` are the stored content encoder outputs of `content_images`, and `style_features`
+        the (cached) `encode_style` outputs of `style_images`, if any. `latents` is the starting noise
+        ([batch_size, 3, H, W]), drawn from `generator` when it is None.
+        """
+        # One reference style image can drive a whole batch of content glyphs.
+        if style_images.shape[0] == 1 and content_images.shape[0] > 1:
+            style_images = style_images.expand(content_images.shape[0], -1, -1, -1)
+        if style_features is not None:
+            style_features = map_condition(
+                lambda t: t.expand(content_images.shape[0], *t.shape[1:]) if t.shape[0] == 1 else t, style_features)
 
         cond = []
         cond.append(content_images)
         cond.append(style_images)
 
-        uncond = []
-        uncond_content_images = torch.ones_like(content_images).to(self.model.device)
-        uncond_style_images = torch.ones_like(style_images).to(self.model.device)
-        uncond.append(uncond_content_images)
-        uncond.append(uncond_style_images)
-
-        # 2.Convert the discrete-time model to the continuous-time
-        model_fn = model_wrapper(
-            model=self.model,
-            noise_schedule=self.noise_schedule,
-            model_type=self.model_type,
-            model_kwargs=model_kwargs,
-            guidance_type=self.guidance_type,
-            condition=cond, 
-            unconditional_condition=uncond,
-            guidance_scale=self.guidance_scale
-        )
-
-        # 3. Define dpm-solver and sample by multistep DPM-Solver.
-        # (We recommend multistep DPM-Solver for conditional sampling)
-        # You can adjust the `steps` to balance the computation costs and the sample quality.
-        dpm_solver = DPM_Solver(
-            model_fn=model_fn,
-            noise_schedule=self.noise_schedule,
-            algorithm_type=algorithm_type,
-            correcting_x0_fn=correcting_x0_fn
-        )
-        # If the DPM is defined on pixel-space images, you can further set `correcting_x0_fn="dynamic_thresholding"
+        if cache_condition:
+            # 1. Run the encoders once, instead of at every solver step.
+            # The unconditional features are shared by all requests, so broadcast the cached ones.
+            cond = self.model.encode_condition(*cond, content_features=content_features,
+                                               style_features=style_features)
+            uncond = self.prepare_unconditional_condition(
+                content_size=content_images.shape[-2:],
+                style_size=style_images.shape[-2:]).expand(content_images.shape[0])
+        else:
+            uncond = []
+            uncond_content_images = torch.ones_like(content_images).to(self.model.device)
+            uncond_style_images = torch.ones_like(style_images).to(self.model.device)
+            uncond.append(uncond_content_images)
+            uncond.append(uncond_style_images)
 
-        # 4. Generate
+        # 2. Generate
         # Sample gaussian noise to begin loop => [batch, 3, height, width]
-        x_T = torch.randn(
-            (batch_size, 3, dm_size[0], dm_size[1]),
-            generator=generator,
-        )
-        x_T = x_T.to(self.model.device)
+        if latents is None:
+            latents = torch.randn(
+                (batch_size, 3, dm_size[0], dm_size[1]),
+                generator=generator,
+            )
+        x_T = latents.to(self.model.device)
 
-        x_sample = dpm_solver.sample(
-            x=x_T,
-            steps=num_inference_step,
+        solver_callback = None
+        if callback is not None:
+            def solver_callback(step, t, x_t, x0_pred):
+                if step % callback_steps == 0 or step == num_inference_step:
+                    callback(step, num_inference_step, x0_pred if x0_pred is not None else x_t)
+
+        # The shared engine runs the multistep DPM-Solver with classifier-free guidance.
+        # You can adjust the `steps` to balance the computation costs and the sample quality.
+        x_sample = self.engine.sample(
+            x_T,
+            cond,
+            uncond,
+            num_inference_step=num_inference_step,
+            content_encoder_downsample_size=content_encoder_downsample_size,
             order=order,
+            algorithm_type=algorithm_type,
             skip_type=skip_type,
             method=method,
+            correcting_x0_fn=correcting_x0_fn,
+            callback=solver_callback,
         )
 
         x_sample = (x_sample / 2 + 0.5).clamp(0, 1)
@@ -115,3 +151,66 @@ class FontDiffuserDPMPipeline():
         x_images = self.numpy_to_pil(x_sample)
 
         return x_images
+
+    def generate_batch(
+        self,
+        content_images,
+        style_images,
+        order,
+        num_inference_step,
+        content_encoder_downsample_size,
+        chunk_size=8,
+        generator=None,
+        content_features=None,
+        style_features=None,
+        latents=None,
+        **kwargs,
+    ):
+        """Generate one glyph per content image, running a single DPM-Solver loop per chunk.
+
+        Args:
+            content_images: A tensor with shape [N, 3, H, W].
+            style_images: A tensor with shape [1, 3, H, W] (shared by all glyphs) or [N, 3, H, W].
+            chunk_size: The max number of glyphs sampled together in one solver loop.
+            content_features: The stored content encoder outputs of `content_images` ([N, ...] each), if any.
+            style_features: The `encode_style` outputs of `style_images` (batch 1 or N), if any.
+            latents: The starting noise of the N glyphs ([N, 3, H, W]), drawn from `generator` per chunk
+                when it is None.
+            kwargs: The other sampling arguments of `generate`.
+        Returns:
+            A list of N PIL images, in the same order as `content_images`.
+        """
+        num_images = content_images.shape[0]
+        if style_images.shape[0] not in (1, num_images):
+            raise ValueError(
+                f"Got {style_images.shape[0]} style images for {num_images} content images, "
+                "need 1 or the same number.")
+        if style_images.shape[0] == 1:
+            style_images = style_images.expand(num_images, -1, -1, -1)
+
+        x_images = []
+        for start in range(0, num_images, chunk_size):
+            content_chunk = content_images[start:start + chunk_size]
+            style_chunk = style_images[start:start + chunk_size]
+            feature_chunk = None
+            if content_features is not None:
+                feature_chunk = [feature[start:start + chunk_size] for feature in content_features]
+            style_feature_chunk = None
+            if style_features is not None:
+                style_feature_chunk = map_condition(
+                    lambda t: t if t.shape[0] == 1 else t[start:start + chunk_size], style_features)
+            latent_chunk = None if latents is None else latents[start:start + chunk_size]
+            x_images += self.generate(
+                content_images=content_chunk,
+                style_images=style_chunk,
+                batch_size=content_chunk.shape[0],
+                order=order,
+                num_inference_step=num_inference_step,
+                content_encoder_downsample_size=content_encoder_downsample_size,
+                generator=generator,
+                content_features=feature_chunk,
+                style_features=style_feature_chunk,
+                latents=latent_chunk,
+                **kwargs)
+
+        return x_images
@@ -0,0 +1,160 @@
+import threading
+
+import torch
+
+from .dpm_solver_pytorch import (model_wrapper,
+                                 DPM_Solver,
+                                 cat_condition)
+
+
+class SamplingEngine():
+    """DPM-Solver sampling of `FontDiffuserModelDPM`, shared by all the requests of a pipeline.
+
+    The continuous-time model wrapper and the `DPM_Solver` of each algorithm type are built once, on the
+    noise schedule of the pipeline. The condition of the running request reaches them through thread-local
+    state, so the requests running concurrently on the inference threads share the same objects.
+    Both the style image path (`FontDiffuserDPMPipeline.generate`) and the style latent path
+    (`sample_latents`, used by the style blending) sample here, with the same classifier-free guidance.
+
+    Args:
+        pipe: The `FontDiffuserDPMPipeline` providing the model, the noise schedule and the guidance settings.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self._request = threading.local()
+        self._solvers = {}
+        self._solvers_lock = threading.Lock()
+
+    def __getstate__(self):
+        # The solvers hold closures; a worker process builds its own.
+        return {"pipe": self.pipe}
+
+    def __setstate__(self, state):
+        self.__init__(state["pipe"])
+
+    def _guided_model(self, x, t_input):
+        """The model output under the condition of the running request, classifier-free guided if it has
+        an unconditional branch."""
+        request = self._request.state
+        model_kwargs = request["model_kwargs"]
+        if request["cfg_condition"] is None:
+            return self.pipe.model(x, t_input, request["condition"], **model_kwargs)
+        x_in = torch.cat([x] * 2)
+        t_in = torch.cat([t_input] * 2)
+        noise_uncond, noise = self.pipe.model(x_in, t_in, request["cfg_condition"], **model_kwargs).chunk(2)
+        return noise_uncond + self.pipe.guidance_scale * (noise - noise_uncond)
+
+    def solver(self, algorithm_type="dpmsolver++", correcting_x0_fn=None):
+        """The shared `DPM_Solver` of an algorithm type."""
+        key = (algorithm_type, correcting_x0_fn)
+        with self._solvers_lock:
+            if key not in self._solvers:
+                # The guidance is applied in `_guided_model`, on the condition of the running request.
+                model_fn = model_wrapper(
+                    model=self._guided_model,
+                    noise_schedule=self.pipe.noise_schedule,
+                    model_type=self.pipe.model_type,
+                    guidance_type="uncond",
+                )
+                self._solvers[key] = DPM_Solver(
+                    model_fn=model_fn,
+                    noise_schedule=self.pipe.noise_schedule,
+                    algorithm_type=algorithm_type,
+                    correcting_x0_fn=correcting_x0_fn
+                )
+            return self._solvers[key]
+
+    def sample(
+        self,
+        x_T,
+        condition,
+        unconditional_condition,
+        num_inference_step,
+        content_encoder_downsample_size,
+        order=2,
+        algorithm_type="dpmsolver++",
+        skip_type="time_uniform",
+        method="multistep",
+        correcting_x0_fn=None,
+        callback=None,
+    ):
+        """Sample x_0 (in [-1, 1]) from the noise `x_T` under `condition`.
+
+        `condition` and `unconditional_condition` are encoded conditions (or raw `[content_images,
+        style_images]`) with the batch size of `x_T`. Without `unconditional_condition`, or with a guidance
+        scale of 1, the guidance is skipped. `callback` is the `DPM_Solver.sample` callback.
+        """
+        cfg_condition = None
+        if (self.pipe.guidance_type == "classifier-free" and self.pipe.guidance_scale != 1.
+                and unconditional_condition is not None):
+            # The conditions are fixed during sampling, so only concatenate them once.
+            cfg_condition = cat_condition(unconditional_condition, condition)
+        self._request.state = {
+            "condition": condition,
+            "cfg_condition": cfg_condition,
+            "model_kwargs": {"version": self.pipe.version,
+                             "content_encoder_downsample_size": content_encoder_downsample_size},
+        }
+        try:
+            return self.solver(algorithm_type, correcting_x0_fn).sample(
+                x=x_T,
+                steps=num_inference_step,
+                order=order,
+                skip_type=skip_type,
+                method=method,
+                callback=callback,
+            )
+        finally:
+            self._request.state = None
+
+    def prepare_unconditional_latent_condition(self, content_size, style_size):
+        """The unconditional counterpart of `encode_latent_condition`: the all-ones content image with the
+        latent of the all-ones style image, encoded once per resolution."""
+        cache = self.pipe.uncond_condition_cache
+        key = ("latent", tuple(content_size), tuple(style_size), str(self.pipe.model.device))
+        if key not in cache:
+            uncond_content_images = torch.ones((1, 3, *content_size), device=self.pipe.model.device)
+            uncond_style_images = torch.ones((1, 3, *style_size), device=self.pipe.model.device)
+            with torch.no_grad():
+                uncond_latents = self.pipe.model.encode_style_latent(uncond_style_images)
+                cache[key] = self.pipe.model.encode_latent_condition(uncond_content_images, uncond_latents)
+        return cache[key]
+
+    def sample_latents(
+        self,
+        content_images,
+        style_latents,
+        style_size,
+        num_inference_step,
+        content_encoder_downsample_size,
+        content_features=None,
+        generator=None,
+        **kwargs,
+    ):
+        """Sample one glyph per style encoder latent, conditioned on a single content image.
+
+        Args:
+            content_images: A tensor with shape [1, 3, H, W].
+            style_latents: The style encoder feature maps, a tensor with shape [N, C, h, w].
+            style_size: The size of the style images the latents were encoded from.
+            content_features: The stored content encoder outputs of `content_images`, if any.
+            kwargs: The other arguments of `sample`.
+        Returns:
+            x_0 with shape [N, 3, H, W], in [-1, 1]. All the glyphs start from the same noise, so they
+            only differ by their latents.
+        """
+        device = self.pipe.model.device
+        batch_size = style_latents.shape[0]
+        condition = self.pipe.model.encode_latent_condition(
+            content_images.to(device), style_latents.to(device), content_features=content_features)
+        uncond = self.prepare_unconditional_latent_condition(
+            content_size=content_images.shape[-2:], style_size=style_size).expand(batch_size)
+        x_T = torch.randn((1, 3, *content_images.shape[-2:]), generator=generator).to(device)
+        return self.sample(
+            x_T.expand(batch_size, -1, -1, -1).contiguous(),
+            condition,
+            uncond,
+            num_inference_step=num_inference_step,
+            content_encoder_downsample_size=content_encoder_downsample_size,
+            **kwargs)
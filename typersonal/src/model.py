@@ -58,6 +58,29 @@ class FontDiffuserModel(ModelMixin, ConfigMixin):
         return noise_pred, offset_out_sum
 
 
+def map_condition(fn, feature):
+    """Apply `fn` to every tensor of a (nested list) condition, keeping its layout."""
+    if torch.is_tensor(feature):
+        return fn(feature)
+    return [map_condition(fn, f) for f in feature]
+
+
+class EncodedCondition(list):
+    """Step-invariant condition of FontDiffuserModelDPM, computed once per request.
+
+    The layout is the `encoder_hidden_states` of the unet plus the style-side
+    projections of the offset interpreters:
+        [style_img_feature, content_residual_features, style_hidden_states,
+         style_content_res_features, style_structure_projections]
+    """
+
+    def expand(self, batch_size):
+        """Broadcast a condition encoded with batch size 1 to `batch_size`, without copying.
+        """
+        return EncodedCondition(
+            map_condition(lambda t: t.expand(batch_size, *t.shape[1:]), feature) for feature in self)
+
+
 class FontDiffuserModelDPM(ModelMixin, ConfigMixin):
     """DPM Forward function for FontDiffuer with content encoder \
         style encoder and unet.
@@ -73,6 +96,10 @@ class FontDiffuserModelDPM(ModelMixin, ConfigMixin):
         self.unet = unet
         self.style_encoder = style_encoder
         self.content_encoder = content_encoder
+        # Optional `CompiledUNet` / `CompiledEncoder`s, used for the input shapes they were compiled for.
+        self.compiled_unet = None
+        self.compiled_style_encoder = None
+        self.compiled_content_encoder = None
     
     def forward(
         self, 
@@ -82,22 +109,18 @@ class FontDiffuserModelDPM(ModelMixin, ConfigMixin):
         content_encoder_downsample_size,
         version,
     ):
-        content_images = cond[0]
-        style_images = cond[1]
-
-        style_img_feature, _, style_residual_features = self.style_encoder(style_images)
-        
-        batch_size, channel, height, width = style_img_feature.shape
-        style_hidden_states = style_img_feature.permute(0, 2, 3, 1).reshape(batch_size, height*width, channel)
-        
-        # Get content feature
-        content_img_feture, content_residual_features = self.content_encoder(content_images)
-        content_residual_features.append(content_img_feture)
-        # Get the content feature from reference image
-        style_content_feature, style_content_res_features = self.content_encoder(style_images)
-        style_content_res_features.append(style_content_feature)
-
-        input_hidden_states = [style_img_feature, content_residual_features, style_hidden_states, style_content_res_features]
+        if isinstance(cond, EncodedCondition):
+            # The encoders have already been run by `encode_condition`.
+            input_hidden_states = cond
+            if self.compiled_unet is not None:
+                noise_pred = self.compiled_unet(x_t, timesteps, input_hidden_states)
+                if noise_pred is not None:
+                    return noise_pred
+        else:
+            input_hidden_states = self.encode_condition(
+                content_images=cond[0],
+                style_images=cond[1],
+                project_style_structure=False)
 
         out = self.unet(
             x_t, 
@@ -108,3 +131,117 @@ class FontDiffuserModelDPM(ModelMixin, ConfigMixin):
         noise_pred = out[0]
         
         return noise_pred
+
+    def run_style_encoder(self, style_images):
+        """The style encoder outputs, from the `compiled_style_encoder` trace if one matches the images."""
+        if self.compiled_style_encoder is not None:
+            outputs = self.compiled_style_encoder(style_images)
+            if outputs is not None:
+                return outputs
+        return self.style_encoder(style_images)
+
+    def run_content_encoder(self, images):
+        """The content encoder outputs, from the `compiled_content_encoder` trace if one matches the images."""
+        if self.compiled_content_encoder is not None:
+            outputs = self.compiled_content_encoder(images)
+            if outputs is not None:
+                return outputs
+        return self.content_encoder(images)
+
+    def encode_style(
+        self,
+        style_images,
+        project_style_structure=True,
+    ):
+        """Run the style-side encoders on the reference style images.
+
+        Returns `[style_img_feature, style_hidden_states, style_content_res_features,
+        style_structure_projections]` (without the projections if `project_style_structure` is False).
+        They only depend on the style images, so they can be cached per reference image (see style_cache.py).
+        """
+        style_img_feature, _, style_residual_features = self.run_style_encoder(style_images)
+
+        batch_size, channel, height, width = style_img_feature.shape
+        style_hidden_states = style_img_feature.permute(0, 2, 3, 1).reshape(batch_size, height*width, channel)
+
+        # Get the content feature from reference image
+        style_content_feature, style_content_res_features = self.run_content_encoder(style_images)
+        style_content_res_features.append(style_content_feature)
+
+        style_features = [style_img_feature, style_hidden_states, style_content_res_features]
+        if project_style_structure:
+            # The style-side projections of the offset interpreters are step-invariant too.
+            style_features.append(self.unet.project_style_structure(style_content_res_features))
+        return style_features
+
+    def encode_condition(
+        self,
+        content_images,
+        style_images,
+        project_style_structure=True,
+        content_features=None,
+        style_features=None,
+    ):
+        """Run the encoders, which do not depend on x_t or t, once for all the solver steps.
+
+        `content_features` are precomputed content encoder outputs of `content_images` (the residual
+        features followed by the final feature map, see content_features.py), and `style_features` the
+        `encode_style` outputs of `style_images`; the corresponding encoders are then skipped.
+        """
+        if style_features is None:
+            style_features = self.encode_style(style_images, project_style_structure=project_style_structure)
+        style_img_feature, style_hidden_states, style_content_res_features = style_features[:3]
+
+        # Get content feature
+        if content_features is not None:
+            content_residual_features = list(content_features)
+        else:
+            content_img_feture, content_residual_features = self.run_content_encoder(content_images)
+            content_residual_features.append(content_img_feture)
+
+        input_hidden_states = [style_img_feature, content_residual_features, style_hidden_states, style_content_res_features]
+        if not project_style_structure:
+            return input_hidden_states
+
+        input_hidden_states.append(style_features[3])
+        return EncodedCondition(input_hidden_states)
+
+    def encode_content(self, content_images):
+        """The content encoder outputs of the content images: the residual features followed by the final
+        feature map (the `content_features` of `encode_condition`, see content_features.py)."""
+        content_img_feature, content_residual_features = self.run_content_encoder(content_images)
+        return content_residual_features + [content_img_feature]
+
+    def encode_style_latent(self, style_images):
+        """The style encoder feature maps of the style images ([N, C, h, w]), the latents blended by
+        `encode_latent_condition`."""
+        style_img_feature, _, _ = self.run_style_encoder(style_images)
+        return style_img_feature
+
+    def encode_latent_condition(
+        self,
+        content_images,
+        style_latents,
+        content_features=None,
+    ):
+        """The condition of style encoder feature maps (e.g. a blend of two styles) instead of style images.
+
+        The content image is then also the structure reference of the style side. A batch-1 content image
+        is broadcast to the `N` latents of `style_latents` ([N, C, H, W]).
+        """
+        if content_features is None:
+            content_img_feature, content_features = self.run_content_encoder(content_images)
+            content_features.append(content_img_feature)
+        content_features = list(content_features)
+        style_projections = self.unet.project_style_structure(content_features)
+
+        batch_size, channel, height, width = style_latents.shape
+        style_hidden_states = style_latents.permute(0, 2, 3, 1).reshape(batch_size, height*width, channel)
+        expand = lambda t: t.expand(batch_size, *t.shape[1:]) if t.shape[0] == 1 else t
+        return EncodedCondition([
+            style_latents,
+            map_condition(expand, content_features),
+            style_hidden_states,
+            map_condition(expand, content_features),
+            map_condition(expand, style_projections),
+        ])
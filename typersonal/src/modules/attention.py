@@ -5,6 +5,29 @@ from torch import nn
 import torch.nn.functional as F
 
 
+# The attention implementations of `CrossAttention` (see `set_attention_backend`):
+#   "sdpa": the fused `F.scaled_dot_product_attention`.
+#   "chunked": `scaled_dot_product_attention` over chunks of queries, so at most `max_attention_bytes` of
+#       attention scores exist at a time.
+#   "reference": the explicit matmul -> softmax -> matmul, which materializes the whole attention matrix.
+#   "auto": "sdpa", or "chunked" once the attention matrix of the batch would exceed `max_attention_bytes`.
+ATTENTION_BACKENDS = ("auto", "sdpa", "chunked", "reference")
+
+
+def set_attention_backend(model, backend="auto", max_attention_mb=None):
+    """Select the attention implementation of every `CrossAttention` of `model`.
+
+    `max_attention_mb` bounds the attention scores of the "chunked" (and "auto") backend.
+    """
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {backend}, expected one of {ATTENTION_BACKENDS}.")
+    for module in model.modules():
+        if isinstance(module, CrossAttention):
+            module._backend = backend
+            if max_attention_mb is not None:
+                module.max_attention_bytes = int(max_attention_mb * 2**20)
+
+
 class SpatialTransformer(nn.Module):
     """
     Transformer block for image-like data. First, project the input (aka embedding) and reshape to b, t, d. Then apply
@@ -172,6 +195,9 @@ class CrossAttention(nn.Module):
         dropout (:obj:`float`, *optional*, defaults to 0.0): The dropout probability to use.
     """
 
+    # The budget of attention scores of the "auto" and "chunked" backends.
+    max_attention_bytes = 64 * 2**20
+
     def __init__(
         self, query_dim: int, context_dim: Optional[int] = None, heads: int = 8, dim_head: int = 64, dropout: int = 0.0
     ):
@@ -185,6 +211,8 @@ class CrossAttention(nn.Module):
         # is split across the batch axis to save memory
         # You can set slice_size with `set_attention_slice`
         self._slice_size = None
+        # One of `ATTENTION_BACKENDS`, you can set it with `set_attention_backend`
+        self._backend = "auto"
 
         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
@@ -214,6 +242,10 @@ class CrossAttention(nn.Module):
         key = self.to_k(context)
         value = self.to_v(context)
 
+        backend = self._attention_backend(query, key)
+        if backend != "reference":
+            return self.to_out(self._fused_attention(query, key, value, chunked=backend == "chunked"))
+
         dim = query.shape[-1]
 
         query = self.reshape_heads_to_batch_dim(query)
@@ -231,6 +263,42 @@ class CrossAttention(nn.Module):
 
         return self.to_out(hidden_states)
 
+    def _attention_backend(self, query, key):
+        backend = self._backend
+        if backend == "auto":
+            if self._slice_size is not None:
+                # An explicit `set_attention_slice` keeps the sliced reference path.
+                return "reference"
+            backend = "chunked" if self._attention_bytes(query, key) > self.max_attention_bytes else "sdpa"
+        if backend != "reference" and not hasattr(F, "scaled_dot_product_attention"):
+            return "reference"
+        return backend
+
+    def _attention_bytes(self, query, key):
+        batch_size, query_length, _ = query.shape
+        return batch_size * self.heads * query_length * key.shape[1] * query.element_size()
+
+    def _fused_attention(self, query, key, value, chunked=False):
+        """`scaled_dot_product_attention` on [batch, heads, tokens, dim_head] views of the projections,
+        over chunks of queries with `chunked`. Its default scale is `self.scale`."""
+        batch_size, query_length, dim = query.shape
+        split_heads = lambda t: t.view(batch_size, -1, self.heads, dim // self.heads).transpose(1, 2)
+        query, key, value = split_heads(query), split_heads(key), split_heads(value)
+
+        chunk_length = query_length
+        if chunked:
+            # Each query token has heads * key_length scores per batch element.
+            token_bytes = batch_size * self.heads * key.shape[2] * query.element_size()
+            chunk_length = max(1, self.max_attention_bytes // token_bytes)
+        if chunk_length >= query_length:
+            hidden_states = F.scaled_dot_product_attention(query, key, value)
+        else:
+            hidden_states = torch.cat([
+                F.scaled_dot_product_attention(query[:, :, start:start + chunk_length], key, value)
+                for start in range(0, query_length, chunk_length)
+            ], dim=2)
+        return hidden_states.transpose(1, 2).reshape(batch_size, query_length, dim)
+
     def _attention(self, query, key, value):
         # TODO: use baddbmm for better performance
         attention_scores = torch.matmul(query, key.transpose(-1, -2)) * self.scale
@@ -298,15 +366,24 @@ class OffsetRefStrucInter(nn.Module):
         self.gnorm_out = torch.nn.GroupNorm(num_groups=num_groups, num_channels=style_feat_in_channels, eps=1e-6, affine=True)
         self.proj_out = nn.Conv2d(style_feat_in_channels, 1*2*3*3, kernel_size=1, stride=1, padding=0)
 
-    def forward(self, res_hidden_states, style_content_hidden_states):
-        batch, c_channel, height, width = res_hidden_states.shape
-        _, s_channel, _, _ = style_content_hidden_states.shape
-        # style projecter
+    def project_style(self, style_content_hidden_states):
+        """The style projecter only depends on the reference image, so it can be computed
+        once and reused at every denoising step.
+        """
+        batch, s_channel, height, width = style_content_hidden_states.shape
         style_content_hidden_states = self.gnorm_s(style_content_hidden_states)
         style_content_hidden_states = self.style_proj_in(style_content_hidden_states)
         
         style_content_hidden_states = style_content_hidden_states.permute(0, 2, 3, 1).reshape(batch, height*width, s_channel)
         style_content_hidden_states = self.ln_s(style_content_hidden_states)
+        return style_content_hidden_states
+
+    def forward(self, res_hidden_states, style_content_hidden_states, style_projected=None):
+        batch, c_channel, height, width = res_hidden_states.shape
+        # style projecter
+        if style_projected is None:
+            style_projected = self.project_style(style_content_hidden_states)
+        style_content_hidden_states = style_projected
 
         # content projecter
         res_hidden_states = self.gnorm_c(res_hidden_states)
@@ -0,0 +1,88 @@
+import torch
+import torch.nn.functional as F
+from torchvision.ops import DeformConv2d
+
+
+# The deformable convolution implementations of `StyleRSIUpBlock2D` (see `set_deform_conv_backend`):
+#   "torchvision": `torchvision.ops.deform_conv2d`.
+#   "grid_sample": `GridSampleDeformConv2d`, one bilinear `F.grid_sample` of all the kernel taps followed by
+#       one matmul with the weight.
+DEFORM_CONV_BACKENDS = ("torchvision", "grid_sample")
+
+
+class GridSampleDeformConv2d(DeformConv2d):
+    """`DeformConv2d` (v1, without mask) as a bilinear `F.grid_sample` and a matmul.
+
+    The sampling positions of the kernel taps of every output pixel are gathered into one grid, so the whole
+    batch (e.g. both halves of the classifier-free guidance batch) is sampled by a single `grid_sample` call
+    into a [batch, in_channels * taps, pixels] column tensor, and convolved by a single batched matmul; both
+    run multithreaded on the CPU. `grid_sample` with zero padding and `align_corners=True` interpolates
+    exactly like `deform_conv2d`: the corners outside the input count as zeros.
+    Grouped convolutions, several offset groups or a mask fall back to `deform_conv2d`.
+    It has the parameters of `DeformConv2d`, so it loads the same checkpoints.
+    """
+
+    def _base_grid(self, out_height, out_width, device, dtype):
+        """The undeformed (y, x) sampling positions, [taps, out_height * out_width] each."""
+        kernel_h, kernel_w = self.kernel_size
+        rows = torch.arange(out_height, device=device, dtype=dtype) * self.stride[0] - self.padding[0]
+        cols = torch.arange(out_width, device=device, dtype=dtype) * self.stride[1] - self.padding[1]
+        taps_y = torch.arange(kernel_h, device=device, dtype=dtype) * self.dilation[0]
+        taps_x = torch.arange(kernel_w, device=device, dtype=dtype) * self.dilation[1]
+        # [kernel_h, kernel_w, out_height, out_width], taps in the row-major order of the offsets
+        y = taps_y.view(-1, 1, 1, 1) + rows.view(1, 1, -1, 1)
+        x = taps_x.view(1, -1, 1, 1) + cols.view(1, 1, 1, -1)
+        y, x = torch.broadcast_tensors(y, x)
+        taps = kernel_h * kernel_w
+        return y.reshape(taps, -1), x.reshape(taps, -1)
+
+    def forward(self, input, offset, mask=None):
+        taps = self.kernel_size[0] * self.kernel_size[1]
+        if mask is not None or self.groups != 1 or offset.shape[1] != 2 * taps:
+            return super().forward(input, offset, mask)
+
+        batch_size, in_channels, height, width = input.shape
+        out_height, out_width = offset.shape[-2:]
+        base_y, base_x = self._base_grid(out_height, out_width, input.device, input.dtype)
+        # The offsets are (dy, dx) pairs per tap: [batch, taps, 2, pixels]
+        offset = offset.reshape(batch_size, taps, 2, out_height * out_width)
+        y = base_y + offset[:, :, 0]
+        x = base_x + offset[:, :, 1]
+        # Pixel coordinates to the [-1, 1] range of `grid_sample` (align_corners=True)
+        grid = torch.stack([x * (2 / max(width - 1, 1)) - 1, y * (2 / max(height - 1, 1)) - 1], dim=-1)
+        # [batch, in_channels, taps, pixels] -> the im2col columns [batch, in_channels * taps, pixels]
+        columns = F.grid_sample(input, grid, mode="bilinear", padding_mode="zeros", align_corners=True)
+        columns = columns.reshape(batch_size, in_channels * taps, out_height * out_width)
+        output = torch.matmul(self.weight.reshape(self.out_channels, -1), columns)
+        if self.bias is not None:
+            output = output + self.bias.view(1, -1, 1)
+        return output.view(batch_size, self.out_channels, out_height, out_width)
+
+
+def _rebuild(conv, cls):
+    """A `cls` module sharing the parameters of the deformable convolution `conv`."""
+    with torch.device("meta"):
+        module = cls(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                     padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                     bias=conv.bias is not None)
+    module.weight = conv.weight
+    module.bias = conv.bias
+    return module.train(conv.training)
+
+
+def set_deform_conv_backend(model, backend="torchvision"):
+    """Select the deformable convolution implementation of every `DeformConv2d` of `model`, in place.
+
+    The modules are replaced by modules sharing their parameters, so it can be switched back and forth.
+    """
+    if backend not in DEFORM_CONV_BACKENDS:
+        raise ValueError(f"Unknown deformable convolution backend {backend}, expected one of {DEFORM_CONV_BACKENDS}.")
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if not isinstance(child, DeformConv2d):
+                continue
+            if backend == "grid_sample" and not isinstance(child, GridSampleDeformConv2d):
+                setattr(parent, name, _rebuild(child, GridSampleDeformConv2d))
+            elif backend == "torchvision" and isinstance(child, GridSampleDeformConv2d):
+                setattr(parent, name, _rebuild(child, DeformConv2d))
+    return model
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from typing import Optional, Tuple, Union
 
+import threading
+
 import torch
 import torch.nn as nn
 import torch.utils.checkpoint
@@ -20,6 +22,10 @@ from .unet_blocks import (DownBlock2D,
 
 logger = logging.get_logger(__name__)
 
+# The UNet is shared by the inference threads; guards the evict and insert of `UNet.time_embedding_cache`
+# (module level, so the model still pickles to the worker processes).
+_time_embedding_cache_lock = threading.Lock()
+
 
 @dataclass
 class UNetOutput(BaseOutput):
@@ -68,6 +74,9 @@ class UNet(ModelMixin, ConfigMixin):
         timestep_input_dim = block_out_channels[0]
 
         self.time_embedding = TimestepEmbedding(timestep_input_dim, time_embed_dim)
+        # Inference time embeddings, keyed by the timestep value (see `timestep_embedding`)
+        self.time_embedding_cache = {}
+        self.max_time_embedding_cache = 1024
 
         self.down_blocks = nn.ModuleList([])
         self.mid_block = None
@@ -189,6 +198,52 @@ class UNet(ModelMixin, ConfigMixin):
             if hasattr(block, "attentions") and block.attentions is not None:
                 block.set_attention_slice(slice_size)
 
+    def project_style_structure(self, style_structure_features):
+        """Precompute the step-invariant style projections of every StyleRSIUpBlock2D.
+        The non-StyleRSI up blocks get an empty list.
+        """
+        projections = []
+        for upsample_block in self.up_blocks:
+            if hasattr(upsample_block, "project_style_structure"):
+                projections.append(upsample_block.project_style_structure(style_structure_features))
+            else:
+                projections.append([])
+        return projections
+
+    def _embed_timesteps(self, timesteps):
+        t_emb = self.time_proj(timesteps)
+
+        # timesteps does not contain any weights and will always return f32 tensors
+        # but time_embedding might actually be running in fp16. so we need to cast here.
+        # there might be better ways to encapsulate this.
+        t_emb = t_emb.to(dtype=self.dtype)
+        return self.time_embedding(t_emb)  # projection
+
+    def timestep_embedding(self, timesteps):
+        """The projected time embedding of `timesteps` ([B]).
+
+        At inference the sampler runs every request through the same few timesteps (see
+        `DPM_Solver.multistep_plan`), so the embedding of a timestep shared by the whole batch is cached per
+        batch size (computing it at batch size 1 and broadcasting would not match the uncached output bitwise).
+        The key also names the time embedding module and the versions of its weights, so loading or
+        replacing them (e.g. int8 quantization) does not reuse stale embeddings.
+        """
+        if self.training or torch.is_grad_enabled() or torch.jit.is_tracing():
+            return self._embed_timesteps(timesteps)
+        values = set(timesteps.tolist())
+        if len(values) != 1:
+            return self._embed_timesteps(timesteps)
+        key = (values.pop(), timesteps.shape[0], self.dtype, str(timesteps.device), id(self.time_embedding),
+               tuple(p._version for p in self.time_embedding.parameters()))
+        emb = self.time_embedding_cache.get(key)
+        if emb is None:
+            emb = self._embed_timesteps(timesteps)
+            with _time_embedding_cache_lock:
+                if len(self.time_embedding_cache) >= self.max_time_embedding_cache:
+                    self.time_embedding_cache.pop(next(iter(self.time_embedding_cache)))
+                self.time_embedding_cache[key] = emb
+        return emb
+
     def _set_gradient_checkpointing(self, module, value=False):
         if isinstance(module, (DownBlock2D, UpBlock2D)):
             module.gradient_checkpointing = value
@@ -226,13 +281,7 @@ class UNet(ModelMixin, ConfigMixin):
         # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
         timesteps = timesteps.expand(sample.shape[0])
 
-        t_emb = self.time_proj(timesteps)
-
-        # timesteps does not contain any weights and will always return f32 tensors
-        # but time_embedding might actually be running in fp16. so we need to cast here.
-        # there might be better ways to encapsulate this.
-        t_emb = t_emb.to(dtype=self.dtype)
-        emb = self.time_embedding(t_emb)  # projection
+        emb = self.timestep_embedding(timesteps)
 
         # 2. pre-process
         sample = self.conv_in(sample)
@@ -262,6 +311,8 @@ class UNet(ModelMixin, ConfigMixin):
             )
 
         # 5. up
+        # the optional 5th condition holds the precomputed style projections
+        style_structure_projections = encoder_hidden_states[4] if len(encoder_hidden_states) > 4 else None
         offset_out_sum = 0
         for i, upsample_block in enumerate(self.up_blocks):
             is_final_block = i == len(self.up_blocks) - 1
@@ -281,6 +332,7 @@ class UNet(ModelMixin, ConfigMixin):
                     res_hidden_states_tuple=res_samples,
                     style_structure_features=encoder_hidden_states[3],
                     encoder_hidden_states=encoder_hidden_states[2],
+                    style_structure_projections=style_structure_projections[i] if style_structure_projections is not None else None,
                 )
                 offset_out_sum += offset_out
             else:
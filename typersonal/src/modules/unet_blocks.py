@@ -531,6 +531,10 @@ class StyleRSIUpBlock2D(nn.Module):
 
         self.gradient_checkpointing = False
 
+    def project_style_structure(self, style_structure_features):
+        style_content_feat = style_structure_features[-self.upblock_index-2]
+        return [sc_inter_offset.project_style(style_content_feat) for sc_inter_offset in self.sc_interpreter_offsets]
+
     def forward(
         self,
         hidden_states,
@@ -539,10 +543,13 @@ class StyleRSIUpBlock2D(nn.Module):
         temb=None,
         encoder_hidden_states=None,
         upsample_size=None,
+        style_structure_projections=None,
     ):
         total_offset = 0
 
         style_content_feat = style_structure_features[-self.upblock_index-2]
+        if style_structure_projections is None:
+            style_structure_projections = [None] * self.num_layers
 
         for i, (sc_inter_offset, dcn_deform, resnet, attn) in \
             enumerate(zip(self.sc_interpreter_offsets, self.dcn_deforms, self.resnets, self.attentions)):
@@ -551,7 +558,7 @@ class StyleRSIUpBlock2D(nn.Module):
             res_hidden_states_tuple = res_hidden_states_tuple[:-1]
             
             # Skip Style Content Interpreter by DCN
-            offset = sc_inter_offset(res_hidden_states, style_content_feat)
+            offset = sc_inter_offset(res_hidden_states, style_content_feat, style_structure_projections[i])
             offset = offset.contiguous()
             # offset sum
             offset_sum = torch.mean(torch.abs(offset))
@@ -0,0 +1,318 @@
+import os
+import json
+import inspect
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .model import EncodedCondition, map_condition
+from .compiled_unet import flatten_condition, unflatten_condition, _FlatUNet
+
+
+ONNX_OPSET = 19
+ONNX_FILES = {
+    "unet": "unet.onnx",
+    "style_encoder": "style_encoder.onnx",
+    "content_encoder": "content_encoder.onnx",
+    "style_structure": "unet_style_structure.onnx",
+    # The blend path: the style encoder feature maps at the latent style size, and the unet for the
+    # conditions of those latents (`encode_latent_condition`), whose style tokens have another shape.
+    "style_latent": "style_latent.onnx",
+    "unet_latent": "unet_latent.onnx",
+}
+LAYOUT_FILE = "onnx_layout.json"
+
+
+def _deform_conv2d_symbolic(g, input, weight, offset, mask, bias, stride_h, stride_w, pad_h, pad_w,
+                            dilation_h, dilation_w, n_weight_grps, n_offset_grps, use_mask):
+    """Map `torchvision::deform_conv2d` to the ONNX `DeformConv` op (opset 19)."""
+    from torch.onnx.symbolic_helper import _get_const
+
+    stride_h, stride_w, pad_h, pad_w, dilation_h, dilation_w, n_weight_grps, n_offset_grps = [
+        _get_const(value, "i", name) for value, name in zip(
+            [stride_h, stride_w, pad_h, pad_w, dilation_h, dilation_w, n_weight_grps, n_offset_grps],
+            ["stride_h", "stride_w", "pad_h", "pad_w", "dilation_h", "dilation_w", "n_weight_grps", "n_offset_grps"])]
+    inputs = [input, weight, offset, bias]
+    if _get_const(use_mask, "b", "use_mask"):
+        inputs.append(mask)
+    return g.op("DeformConv", *inputs,
+                strides_i=[stride_h, stride_w],
+                pads_i=[pad_h, pad_w, pad_h, pad_w],
+                dilations_i=[dilation_h, dilation_w],
+                group_i=n_weight_grps,
+                offset_group_i=n_offset_grps)
+
+
+class _ContentEncoderExport(nn.Module):
+    def __init__(self, content_encoder):
+        super().__init__()
+        self.content_encoder = content_encoder
+
+    def forward(self, images):
+        feature, residual_features = self.content_encoder(images)
+        return tuple(residual_features) + (feature,)
+
+
+class _StyleEncoderExport(nn.Module):
+    def __init__(self, style_encoder):
+        super().__init__()
+        self.style_encoder = style_encoder
+
+    def forward(self, images):
+        style_img_feature, _, _ = self.style_encoder(images)
+        batch_size, channel, height, width = style_img_feature.shape
+        style_hidden_states = style_img_feature.permute(0, 2, 3, 1).reshape(batch_size, height*width, channel)
+        return style_img_feature, style_hidden_states
+
+
+class _StyleLatentExport(nn.Module):
+    def __init__(self, style_encoder):
+        super().__init__()
+        self.style_encoder = style_encoder
+
+    def forward(self, images):
+        style_img_feature, _, _ = self.style_encoder(images)
+        return style_img_feature
+
+
+class _StyleStructureExport(nn.Module):
+    def __init__(self, unet, layout):
+        super().__init__()
+        self.unet = unet
+        self.layout = layout
+
+    def forward(self, *style_content_res_features):
+        projections = self.unet.project_style_structure(list(style_content_res_features))
+        return flatten_condition(projections)[0]
+
+
+def _export(module, inputs, path, input_names, output_names):
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # The custom DeformConv symbolic is registered for the TorchScript-based exporter.
+        kwargs["dynamo"] = False
+    dynamic_axes = {name: {0: "batch"} for name in input_names + output_names if name != "timestep"}
+    dynamic_axes["timestep"] = {0: "batch"}
+    torch.onnx.export(
+        module.eval(), tuple(inputs), path,
+        opset_version=ONNX_OPSET,
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        do_constant_folding=True,
+        **kwargs)
+
+
+def export_onnx(model, output_dir, content_size, style_size, content_encoder_downsample_size, latent_style_size):
+    """Export the unet, the two encoders and the style structure projections of `FontDiffuserModelDPM`.
+
+    The style encoder and the unet are exported a second time for the style latents of `latent_style_size`
+    images (`encode_style_latent` / `encode_latent_condition`). The nested list conditioning is flattened
+    into numbered tensor inputs; the layout to rebuild it is written to `onnx_layout.json`.
+    """
+    from torch.onnx import register_custom_op_symbolic
+    register_custom_op_symbolic("torchvision::deform_conv2d", _deform_conv2d_symbolic, ONNX_OPSET)
+
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.eval()
+    device = next(model.parameters()).device
+    content_images = torch.randn(2, 3, *content_size, device=device)
+    style_images = torch.randn(2, 3, *style_size, device=device)
+    latent_style_images = torch.randn(2, 3, *latent_style_size, device=device)
+
+    with torch.no_grad():
+        cond = model.encode_condition(content_images, style_images)
+        content_outputs = _ContentEncoderExport(model.content_encoder)(content_images)
+        style_content_res = list(_ContentEncoderExport(model.content_encoder)(style_images))
+        projection_tensors, projection_layout = flatten_condition(cond[4])
+        cond_tensors, unet_layout = flatten_condition(cond)
+        style_latents = model.encode_style_latent(latent_style_images)
+        latent_cond = model.encode_latent_condition(content_images, style_latents)
+        latent_cond_tensors, latent_unet_layout = flatten_condition(latent_cond)
+        assert latent_unet_layout == unet_layout
+
+        _export(_ContentEncoderExport(model.content_encoder), [content_images],
+                os.path.join(output_dir, ONNX_FILES["content_encoder"]),
+                input_names=["images"],
+                output_names=[f"feature_{i}" for i in range(len(content_outputs))])
+        _export(_StyleEncoderExport(model.style_encoder), [style_images],
+                os.path.join(output_dir, ONNX_FILES["style_encoder"]),
+                input_names=["images"],
+                output_names=["style_img_feature", "style_hidden_states"])
+        _export(_StyleLatentExport(model.style_encoder), [latent_style_images],
+                os.path.join(output_dir, ONNX_FILES["style_latent"]),
+                input_names=["images"],
+                output_names=["style_img_feature"])
+        _export(_StyleStructureExport(model.unet, projection_layout), style_content_res,
+                os.path.join(output_dir, ONNX_FILES["style_structure"]),
+                input_names=[f"style_content_res_{i}" for i in range(len(style_content_res))],
+                output_names=[f"projection_{i}" for i in range(len(projection_tensors))])
+
+        sample = torch.randn(2, 3, *content_size, device=device)
+        timestep = torch.full((2,), 500.0, device=device)
+        _export(_FlatUNet(model.unet, unet_layout, content_encoder_downsample_size),
+                [sample, timestep, *cond_tensors],
+                os.path.join(output_dir, ONNX_FILES["unet"]),
+                input_names=["sample", "timestep"] + [f"cond_{i}" for i in range(len(cond_tensors))],
+                output_names=["noise_pred"])
+        _export(_FlatUNet(model.unet, unet_layout, content_encoder_downsample_size),
+                [sample, timestep, *latent_cond_tensors],
+                os.path.join(output_dir, ONNX_FILES["unet_latent"]),
+                input_names=["sample", "timestep"] + [f"cond_{i}" for i in range(len(latent_cond_tensors))],
+                output_names=["noise_pred"])
+
+    def _to_json(layout):
+        return None if layout is None else [_to_json(child) for child in layout]
+
+    with open(os.path.join(output_dir, LAYOUT_FILE), "w") as f:
+        json.dump({
+            "content_size": list(content_size),
+            "style_size": list(style_size),
+            "latent_style_size": list(latent_style_size),
+            # The shape of the style encoder feature map each unet graph was exported with
+            "unet_style_shape": list(cond[0].shape[1:]),
+            "unet_latent_style_shape": list(latent_cond[0].shape[1:]),
+            "content_encoder_downsample_size": content_encoder_downsample_size,
+            "num_content_features": len(content_outputs),
+            "projection_layout": _to_json(projection_layout),
+            "unet_layout": _to_json(unet_layout),
+        }, f, indent=2)
+
+
+class OnnxFontDiffuserModel:
+    """ONNX Runtime stand-in for `FontDiffuserModelDPM` in `FontDiffuserDPMPipeline`.
+
+    The encoders run once per request in `encode_condition` (or `encode_latent_condition` for blended style
+    latents), and every DPM-Solver step runs the `unet.onnx` (or `unet_latent.onnx`) session. Inputs and outputs stay torch tensors on the CPU, so the solver code is shared
+    with the PyTorch backend.
+
+    Args:
+        onnx_dir: the directory written by `export_onnx`.
+        num_threads: the intra-op threads of each session, 0 lets ORT decide.
+        providers: the ORT execution providers.
+    """
+
+    def __init__(self, onnx_dir, num_threads=0, providers=("CPUExecutionProvider",)):
+        import onnxruntime as ort
+
+        self._init_args = (onnx_dir, num_threads, tuple(providers))
+        missing = [file_name for file_name in ONNX_FILES.values()
+                   if not os.path.exists(os.path.join(onnx_dir, file_name))]
+        assert not missing, f"{onnx_dir} lacks {missing}, re-export it with export_onnx.py."
+        with open(os.path.join(onnx_dir, LAYOUT_FILE)) as f:
+            layout = json.load(f)
+
+        def _from_json(node):
+            return None if node is None else tuple(_from_json(child) for child in node)
+
+        self.projection_layout = _from_json(layout["projection_layout"])
+        self.unet_layout = _from_json(layout["unet_layout"])
+        self.content_encoder_downsample_size = layout["content_encoder_downsample_size"]
+        self.style_size = tuple(layout["style_size"])
+        self.latent_style_size = tuple(layout["latent_style_size"])
+        # The unet session of each style feature map shape
+        self.unet_sessions = {tuple(layout["unet_style_shape"]): "unet",
+                              tuple(layout["unet_latent_style_shape"]): "unet_latent"}
+        self.device = torch.device("cpu")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.sessions = {
+            name: ort.InferenceSession(os.path.join(onnx_dir, file_name), sess_options=options,
+                                       providers=list(providers))
+            for name, file_name in ONNX_FILES.items()
+        }
+        # Inputs that do not reach any output are dropped by the exporter.
+        self.session_inputs = {name: {i.name for i in session.get_inputs()}
+                               for name, session in self.sessions.items()}
+
+    def __reduce__(self):
+        # ORT sessions can not be pickled; a worker process opens its own sessions on the same files.
+        return (OnnxFontDiffuserModel, self._init_args)
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        return self
+
+    def _run(self, name, feeds):
+        inputs = self.session_inputs[name]
+        feeds = {key: np.ascontiguousarray(value.detach().cpu().numpy(), dtype=np.float32)
+                 for key, value in feeds.items() if key in inputs}
+        return [torch.from_numpy(output) for output in self.sessions[name].run(None, feeds)]
+
+    def _project_style_structure(self, style_content_res_features):
+        projections = self._run("style_structure", {f"style_content_res_{i}": feature
+                                                    for i, feature in enumerate(style_content_res_features)})
+        return unflatten_condition(projections, self.projection_layout)
+
+    def encode_style(self, style_images, project_style_structure=True):
+        style_img_feature, style_hidden_states = self._run("style_encoder", {"images": style_images})
+        style_content_res_features = self._run("content_encoder", {"images": style_images})
+        style_features = [style_img_feature, style_hidden_states, style_content_res_features]
+        if project_style_structure:
+            style_features.append(self._project_style_structure(style_content_res_features))
+        return style_features
+
+    def encode_condition(self, content_images, style_images, project_style_structure=True, content_features=None,
+                         style_features=None):
+        if content_features is not None:
+            content_residual_features = list(content_features)
+        else:
+            content_residual_features = self._run("content_encoder", {"images": content_images})
+        if style_features is None:
+            style_features = self.encode_style(style_images, project_style_structure=project_style_structure)
+        style_img_feature, style_hidden_states, style_content_res_features = style_features[:3]
+        input_hidden_states = [style_img_feature, content_residual_features, style_hidden_states,
+                               style_content_res_features]
+        if not project_style_structure:
+            return input_hidden_states
+        input_hidden_states.append(style_features[3])
+        return EncodedCondition(input_hidden_states)
+
+    def encode_content(self, content_images):
+        return self._run("content_encoder", {"images": content_images})
+
+    def encode_style_latent(self, style_images):
+        size = tuple(style_images.shape[-2:])
+        if size == self.latent_style_size:
+            return self._run("style_latent", {"images": style_images})[0]
+        assert size == self.style_size, \
+            f"The style encoder was exported for {self.style_size} and {self.latent_style_size} images, not {size}."
+        return self._run("style_encoder", {"images": style_images})[0]
+
+    def encode_latent_condition(self, content_images, style_latents, content_features=None):
+        if content_features is None:
+            content_features = self._run("content_encoder", {"images": content_images})
+        content_features = list(content_features)
+        style_projections = self._project_style_structure(content_features)
+
+        batch_size, channel, height, width = style_latents.shape
+        style_hidden_states = style_latents.permute(0, 2, 3, 1).reshape(batch_size, height*width, channel)
+        expand = lambda t: t.expand(batch_size, *t.shape[1:]) if t.shape[0] == 1 else t
+        return EncodedCondition([
+            style_latents,
+            map_condition(expand, content_features),
+            style_hidden_states,
+            map_condition(expand, content_features),
+            map_condition(expand, style_projections),
+        ])
+
+    def __call__(self, x_t, timesteps, cond, content_encoder_downsample_size, version):
+        assert content_encoder_downsample_size == self.content_encoder_downsample_size, \
+            "The unet.onnx was exported with another content_encoder_downsample_size."
+        if not isinstance(cond, EncodedCondition):
+            cond = self.encode_condition(content_images=cond[0], style_images=cond[1])
+        cond_tensors, layout = flatten_condition(cond)
+        assert layout == self.unet_layout, "The condition does not match the exported unet.onnx."
+        style_shape = tuple(cond_tensors[0].shape[1:])
+        assert style_shape in self.unet_sessions, f"No unet graph was exported for {style_shape} style features."
+        if not torch.is_tensor(timesteps) or timesteps.dim() == 0:
+            timesteps = torch.as_tensor(timesteps, dtype=torch.float32).reshape(-1)
+        feeds = {"sample": x_t, "timestep": timesteps.to(torch.float32).expand(x_t.shape[0])}
+        feeds.update({f"cond_{i}": tensor for i, tensor in enumerate(cond_tensors)})
+        return self._run(self.unet_sessions[style_shape], feeds)[0]
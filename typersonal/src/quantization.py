@@ -0,0 +1,117 @@
+import os
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import (QuantStub,
+                                   DeQuantStub,
+                                   get_default_qconfig,
+                                   prepare,
+                                   convert,
+                                   quantize_dynamic)
+
+from .modules.attention import OffsetRefStrucInter
+from .spectral_norm import freeze_spectral_norm
+
+
+# Bumped when the quantized structure changes, so older caches are recalibrated (2: frozen spectral norms).
+QUANTIZED_VERSION = 2
+
+
+class StaticQuantConv2d(nn.Module):
+    """Wrap a float `nn.Conv2d` with quant/dequant stubs, so that only the conv itself runs in int8
+    while the surrounding norms, activations and attention stay in fp32.
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x.contiguous())))
+
+
+def quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    return torch.backends.quantized.engine
+
+
+def _keeps_fp32(parent, name):
+    # The offsets predicted for `DeformConv2d` move its sampling grid, so keep their projection in fp32.
+    return isinstance(parent, OffsetRefStrucInter) and name == "proj_out"
+
+
+def _wrap_convs(module):
+    """Replace every plain `nn.Conv2d` (not the deformable ones) by `StaticQuantConv2d`."""
+    for name, child in module.named_children():
+        if type(child) is nn.Conv2d and child.padding_mode == "zeros" and not _keeps_fp32(module, name):
+            setattr(module, name, StaticQuantConv2d(child))
+        else:
+            _wrap_convs(child)
+
+
+def prepare_int8(model):
+    """Insert observers for the static int8 convs of `model` in place.
+
+    The `SNConv2d` / `SNLinear` layers of the encoders are first frozen into plain layers holding their
+    normalized weights, so the encoders are quantized like the unet.
+    """
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    model.eval()
+    freeze_spectral_norm(model, check=False)
+    _wrap_convs(model)
+    qconfig = get_default_qconfig(engine)
+    for module in model.modules():
+        module.qconfig = None
+    # Only the wrapped convs and their stubs are observed (and converted to int8)
+    for module in model.modules():
+        if isinstance(module, StaticQuantConv2d):
+            for child in module.modules():
+                child.qconfig = qconfig
+    prepare(model, inplace=True)
+    return model
+
+
+def convert_int8(model):
+    """Convert a prepared (and calibrated) model: static int8 convs and dynamic int8 linears."""
+    convert(model, inplace=True)
+    for module in model.modules():
+        if hasattr(module, "qconfig"):
+            del module.qconfig
+    quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def quantize_model(model, calibrate_fn):
+    """Quantize `model` in place, `calibrate_fn(model)` runs the calibration forward passes."""
+    prepare_int8(model)
+    with torch.no_grad():
+        calibrate_fn(model)
+    return convert_int8(model)
+
+
+def save_quantized(model, path, checkpoint_digest):
+    torch.save({"checkpoint_digest": checkpoint_digest, "version": QUANTIZED_VERSION,
+                "state_dict": model.state_dict()}, path)
+
+
+def load_quantized(model, path, checkpoint_digest):
+    """Load a cached quantized state_dict into the float `model` in place.
+
+    Return `None` if there is no cache, or it was made from another checkpoint or quantized structure.
+    """
+    if not os.path.exists(path):
+        return None
+    cached = torch.load(path, map_location="cpu", weights_only=False)
+    if cached.get("checkpoint_digest") != checkpoint_digest or cached.get("version") != QUANTIZED_VERSION:
+        return None
+    # Build the same quantized structure, then overwrite the placeholder qparams with the cached ones.
+    prepare_int8(model)
+    convert_int8(model)
+    model.load_state_dict(cached["state_dict"])
+    return model
@@ -0,0 +1,69 @@
+import torch
+import torch.nn as nn
+
+from .modules import content_encoder, style_encoder
+
+
+# The spectral-normalized layers of the encoders (each encoder module defines its own copies).
+SN_LAYERS = (style_encoder.SNConv2d, style_encoder.SNLinear,
+             content_encoder.SNConv2d, content_encoder.SNLinear)
+
+
+def _frozen_layer(layer):
+    """A plain `nn.Conv2d` / `nn.Linear` holding the normalized weight of an SN layer in eval mode."""
+    layer.eval()
+    with torch.no_grad():
+        weight = layer.W_()
+    factory = {"device": layer.weight.device, "dtype": layer.weight.dtype}
+    if isinstance(layer, nn.Conv2d):
+        frozen = nn.Conv2d(layer.in_channels, layer.out_channels, layer.kernel_size, stride=layer.stride,
+                           padding=layer.padding, dilation=layer.dilation, groups=layer.groups,
+                           bias=layer.bias is not None, **factory)
+    else:
+        frozen = nn.Linear(layer.in_features, layer.out_features, bias=layer.bias is not None, **factory)
+    with torch.no_grad():
+        frozen.weight.copy_(weight)
+        if layer.bias is not None:
+            frozen.bias.copy_(layer.bias)
+    return frozen.eval()
+
+
+def check_frozen_layer(layer, frozen, rtol=1e-5):
+    """Compare an SN layer (in eval mode) with its frozen copy on a random input, return the max abs error."""
+    device = layer.weight.device
+    if isinstance(layer, nn.Conv2d):
+        size = max(8, *layer.kernel_size)
+        x = torch.randn(2, layer.in_channels, size, size, device=device)
+    else:
+        x = torch.randn(2, layer.in_features, device=device)
+    with torch.no_grad():
+        expected = layer(x)
+        error = (frozen(x) - expected).abs().max().item()
+    assert error <= rtol * max(1., expected.abs().max().item()), \
+        f"The frozen {type(layer).__name__} differs from the original by {error}."
+    return error
+
+
+def freeze_spectral_norm(model, check=True):
+    """Replace every `SNConv2d` / `SNLinear` of `model` in place by a plain layer with the normalized weight.
+
+    In eval mode the power iteration of an SN layer does not update its `u` vectors, so its weight is the
+    same at every call; the frozen layer computes it once instead of at every forward.
+    With `check`, each frozen layer is compared with the original on a random input.
+
+    Returns:
+        The max abs error of the checked layers (0 without `check`).
+    """
+    max_error = 0.
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, SN_LAYERS):
+                frozen = _frozen_layer(child)
+                if check:
+                    max_error = max(max_error, check_frozen_layer(child, frozen))
+                setattr(parent, name, frozen)
+    return max_error
+
+
+def has_spectral_norm(model):
+    return any(isinstance(module, SN_LAYERS) for module in model.modules())
@@ -0,0 +1,180 @@
+"""
+Style bank: the style encoder latents of every glyph of the preset style folders (`STYLE_DIRS`), computed offline.
+
+The preset folders never change at runtime, so `blend_styles_latent` looks the style B latent up in a
+memory-mapped array instead of decoding `<codepoint>.png` and running the style encoder per request. The bank is
+built with the style encoder the samplers run (`--int8`, `--freeze_sn`, `--onnx_dir`) and keyed by that variant
+(`utils.encoder_variant`).
+
+    python style_bank.py --ckpt_dir ckpt
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+
+from style_cache import style_image_tensor
+from utils import checkpoint_digest, encoder_variant
+
+
+# Bump when the stored layout changes, older banks are then ignored.
+BANK_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# blend_styles_latent encodes both style images at this size
+BLEND_STYLE_SIZE = (128, 128)
+
+
+def style_bank_dir(ckpt_dir, style_folder, size=BLEND_STYLE_SIZE, variant="fp32"):
+    """The bank of a style folder for a style encoder checkpoint and encoder variant:
+    `ckpt/style_bank/<key>/<folder name>`."""
+    key = hashlib.sha1(repr((
+        BANK_VERSION,
+        checkpoint_digest(ckpt_dir, names=("style_encoder.pth",)),
+        variant,
+        tuple(size),
+    )).encode()).hexdigest()[:16]
+    return os.path.join(ckpt_dir, "style_bank", key, os.path.basename(os.path.normpath(style_folder)))
+
+
+def _style_pngs(style_folder):
+    """The (codepoint, path) of the `<codepoint>.png` files of a style folder."""
+    pngs = []
+    for name in sorted(os.listdir(style_folder)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() == ".png" and stem.isdigit():
+            pngs.append((int(stem), os.path.join(style_folder, name)))
+    return pngs
+
+
+class StyleBank:
+    """Memory-mapped style encoder latents of one style folder, one row per codepoint.
+
+    Args:
+        bank_dir: a directory written by `StyleBank.build`.
+        variant: if set, the `encoder_variant` the bank must have been built with.
+    """
+
+    def __init__(self, bank_dir, variant=None):
+        self.bank_dir = bank_dir
+        with open(os.path.join(bank_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        assert self.manifest["version"] == BANK_VERSION, \
+            f"The style bank {bank_dir} has version {self.manifest['version']}."
+        assert variant is None or self.manifest["variant"] == variant, \
+            f"The style bank {bank_dir} was built for {self.manifest['variant']}, not {variant}."
+        codepoints = np.load(os.path.join(bank_dir, "codepoints.npy"))
+        self.index = {int(codepoint): row for row, codepoint in enumerate(codepoints)}
+        self.latents = np.load(os.path.join(bank_dir, "latents.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.index)
+
+    def latent(self, char):
+        """The (1, C, H, W) latent of `char`, `None` if it is not in the bank."""
+        row = self.index.get(ord(char))
+        if row is None:
+            return None
+        return torch.from_numpy(np.array(self.latents[row:row + 1], dtype=np.float32))
+
+    @classmethod
+    def build(cls, model, style_folder, bank_dir, size=BLEND_STYLE_SIZE, variant="fp32", batch_size=64):
+        """Encode every `<codepoint>.png` of `style_folder` with `model.encode_style_latent` and write the bank.
+
+        `variant` is the `encoder_variant` of `model`, recorded in the manifest. The bank is written to a temporary directory and renamed when complete.
+        """
+        pngs = _style_pngs(style_folder)
+        assert pngs, f"No <codepoint>.png in {style_folder}."
+        device = model.device
+        tmp_dir = bank_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        latents = None
+        with torch.no_grad():
+            for start in range(0, len(pngs), batch_size):
+                images = torch.cat([style_image_tensor(Image.open(path).convert("RGB"), size)
+                                    for _, path in pngs[start:start + batch_size]])
+                latent = model.encode_style_latent(images.to(device))
+                if latents is None:
+                    latents = np.lib.format.open_memmap(
+                        os.path.join(tmp_dir, "latents.npy"), mode="w+", dtype=np.float32,
+                        shape=(len(pngs), *latent.shape[1:]))
+                latents[start:start + latent.shape[0]] = latent.cpu().numpy()
+                print(f"Encoded {min(start + batch_size, len(pngs))}/{len(pngs)} style glyphs", end="\r")
+        print()
+        latents.flush()
+        del latents
+
+        np.save(os.path.join(tmp_dir, "codepoints.npy"), np.asarray([codepoint for codepoint, _ in pngs],
+                                                                    dtype=np.int64))
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+            json.dump({"version": BANK_VERSION, "variant": variant, "style_folder": os.path.abspath(style_folder),
+                       "size": list(size), "num_glyphs": len(pngs)}, f, indent=2)
+        shutil.rmtree(bank_dir, ignore_errors=True)
+        os.replace(tmp_dir, bank_dir)
+        return cls(bank_dir, variant)
+
+
+_banks = {}
+_banks_lock = threading.Lock()
+
+
+def get_style_bank(args, style_folder):
+    """The shared bank of a style folder for the checkpoint and encoder variant in `args`, `None` if it was not
+    built."""
+    if args.ckpt_dir is None:
+        return None
+    variant = encoder_variant(args)
+    key = (os.path.abspath(args.ckpt_dir), variant, os.path.abspath(style_folder))
+    with _banks_lock:
+        if key not in _banks:
+            bank_dir = style_bank_dir(args.ckpt_dir, style_folder, variant=variant)
+            bank = None
+            if os.path.exists(os.path.join(bank_dir, MANIFEST_FILE)):
+                bank = StyleBank(bank_dir, variant)
+                print(f"Loaded {len(bank)} style latents from {bank_dir}")
+            _banks[key] = bank
+        return _banks[key]
+
+
+def lookup_style_latent(args, style_folder, char, device):
+    """The banked latent of `char` in `style_folder` on `device`, `None` to encode the PNG instead."""
+    bank = get_style_bank(args, style_folder)
+    if bank is None:
+        return None
+    latent = bank.latent(char)
+    return None if latent is None else latent.to(device)
+
+
+if __name__ == "__main__":
+    from sample import arg_parse, load_inference_model
+
+    def add_arguments(parser):
+        parser.add_argument("--style_dirs", type=str, nargs="*", default=None,
+                            help="The style folders to index, default every folder of STYLE_DIRS.")
+        parser.add_argument("--bank_batch_size", type=int, default=64,
+                            help="The number of style glyphs encoded together.")
+
+    args = arg_parse(add_arguments=add_arguments)
+    assert args.ckpt_dir is not None, "The ckpt_dir should not be None."
+    # Built with the style encoder of the sampling options (--int8, --freeze_sn, --onnx_dir), which key the bank
+    model = load_inference_model(args)
+    variant = encoder_variant(args)
+
+    style_dirs = args.style_dirs
+    if not style_dirs:
+        from shared.core import STYLE_DIRS
+        style_dirs = list(STYLE_DIRS.values())
+    for style_folder in style_dirs:
+        if not os.path.isdir(style_folder):
+            print(f"Skip {style_folder}, not a directory")
+            continue
+        bank_dir = style_bank_dir(args.ckpt_dir, style_folder, variant=variant)
+        bank = StyleBank.build(model, style_folder, bank_dir, variant=variant, batch_size=args.bank_batch_size)
+        print(f"Saved the {variant} latents of {len(bank)} glyphs of {style_folder} to {bank_dir}")
@@ -0,0 +1,156 @@
+"""
+Style-feature cache: the encoder outputs of a reference style image, keyed by a hash of its decoded pixels.
+
+A user typically uploads one handwriting sample and requests many characters with it. The style encoder and
+the style-side content encoder only depend on that image, so their outputs (`FontDiffuserModelDPM.encode_style`)
+are kept in a bounded LRU, optionally spilling the evicted entries to disk, and repeat requests skip both
+encoders.
+"""
+
+import threading
+
+import torch
+import torchvision.transforms as transforms
+
+from src.model import map_condition
+from utils import image_digest, model_version
+from tiered_cache import TieredLRUCache
+
+
+class StyleFeatureCache(TieredLRUCache):
+    """`TieredLRUCache` of style features (nested lists of tensors), spilled with `torch.save`."""
+
+    suffix = ".pt"
+
+    def dump(self, value, path):
+        torch.save(map_condition(lambda t: t.cpu(), value), path)
+
+    def load(self, path):
+        return torch.load(path, map_location="cpu")
+
+    def sizeof(self, value):
+        total = []
+        map_condition(lambda t: total.append(t.numel() * t.element_size()), value)
+        return sum(total)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_style_cache(args):
+    """The process-wide style feature cache, configured by `--style_cache_size` / `--style_cache_dir`."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = StyleFeatureCache(max_entries=getattr(args, "style_cache_size", 64),
+                                       spill_dir=getattr(args, "style_cache_dir", None))
+        return _cache
+
+
+def style_image_tensor(image, size):
+    """Resize and normalize a PIL style image into a batch-1 tensor, as the pipelines do."""
+    style_transforms = transforms.Compose(
+        [transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR),
+         transforms.ToTensor(),
+         transforms.Normalize([0.5], [0.5])])
+    return style_transforms(image)[None, :]
+
+
+class EncodedStyle:
+    """A reference style image together with its encoder outputs, computed once (see `encode_style`).
+
+    It can be passed instead of the PIL image to `encode_style_cached` / `style_latent_cached` and the
+    samplers built on them: the stored outputs (on the CPU) are used as they are, so neither the pixel hash
+    nor the encoders run again, also in a worker process it is pickled to. Outputs of other weights or sizes
+    fall back to the cache.
+    """
+
+    def __init__(self, image, digest, version, features, features_size, latent, latent_size):
+        self.image = image
+        self.digest = digest
+        self.version = version
+        self.features = features
+        self.features_size = tuple(features_size)
+        self.latent = latent
+        self.latent_size = tuple(latent_size)
+
+    @property
+    def size(self):
+        return self.image.size
+
+    @property
+    def mode(self):
+        return self.image.mode
+
+
+def style_image_of(style_image):
+    """The PIL image of a PIL image or an `EncodedStyle`."""
+    return style_image.image if isinstance(style_image, EncodedStyle) else style_image
+
+
+def style_digest(style_image):
+    """The `image_digest` of a PIL image or an `EncodedStyle`."""
+    return style_image.digest if isinstance(style_image, EncodedStyle) else image_digest(style_image)
+
+
+def encode_style(args, pipe, style_image, latent_size):
+    """The `EncodedStyle` of a PIL style image: its `encode_style` outputs and its style latent at `latent_size`."""
+    digest = image_digest(style_image)
+    to_cpu = lambda t: t.cpu()
+    features = map_condition(to_cpu, encode_style_cached(args, pipe, style_image, digest=digest))
+    latent = style_latent_cached(args, pipe, style_image, latent_size, digest=digest).cpu()
+    return EncodedStyle(style_image, digest, model_version(args), features, args.style_image_size,
+                        latent, latent_size)
+
+
+def encode_style_cached(args, pipe, style_image, size=None, digest=None):
+    """The `encode_style` outputs (batch 1) of a PIL style image (or an `EncodedStyle`), from the cache
+    when it was seen before.
+
+    `digest` is the `image_digest` of `style_image`, when the caller already computed it.
+    """
+    size = tuple(size or args.style_image_size)
+    if isinstance(style_image, EncodedStyle):
+        if style_image.version == model_version(args) and style_image.features_size == size:
+            return map_condition(lambda t: t.to(pipe.model.device), style_image.features)
+        digest, style_image = style_image.digest, style_image.image
+    # The disk tier outlives the process, so the key also names the weights.
+    key = ("style", digest or image_digest(style_image), size, model_version(args))
+
+    def encode():
+        with torch.no_grad():
+            return pipe.model.encode_style(style_image_tensor(style_image, size).to(pipe.model.device))
+
+    features = get_style_cache(args).get_or_compute(key, encode)
+    return map_condition(lambda t: t.to(pipe.model.device), features)
+
+
+def style_latent_cached(args, pipe, style_image, size, digest=None):
+    """The style encoder feature map of a PIL style image or an `EncodedStyle` (the latent blended by
+    `blend_styles_latent`).
+
+    `digest` is the `image_digest` of `style_image`, when the caller already computed it.
+    """
+    size = tuple(size)
+    if isinstance(style_image, EncodedStyle):
+        if style_image.version == model_version(args) and style_image.latent_size == size:
+            return style_image.latent.to(pipe.model.device)
+        digest, style_image = style_image.digest, style_image.image
+    key = ("latent", digest or image_digest(style_image), size, model_version(args))
+
+    def encode():
+        with torch.no_grad():
+            return pipe.model.encode_style_latent(style_image_tensor(style_image, size).to(pipe.model.device))
+
+    return get_style_cache(args).get_or_compute(key, encode).to(pipe.model.device)
+
+
+def concat_style_features(features_list):
+    """Concatenate the batch-1 style features of several images into one batch."""
+    def _cat(*features):
+        if torch.is_tensor(features[0]):
+            return torch.cat(features)
+        return [_cat(*group) for group in zip(*features)]
+
+    return _cat(*features_list)
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def small_args():
+    """The sampling arguments of a small randomly initialized FontDiffuser (no checkpoint needed)."""
+    from sample import arg_parse
+
+    args = arg_parse(ignore_cli=True)
+    args.demo = True
+    args.unet_channels = (32, 64, 64, 64)
+    args.style_start_channel = 32
+    args.num_inference_steps = 2
+    args.seed = 0
+    return args
+
+
+@pytest.fixture(scope="session")
+def small_model(small_args):
+    from src import FontDiffuserModelDPM, build_unet, build_style_encoder, build_content_encoder
+
+    torch.manual_seed(0)
+    model = FontDiffuserModelDPM(
+        unet=build_unet(small_args),
+        style_encoder=build_style_encoder(small_args),
+        content_encoder=build_content_encoder(small_args))
+    return model.eval()
+
+
+@pytest.fixture(scope="session")
+def make_pipe():
+    """`make_pipe(args, model)`: the sampling pipeline of `sample.load_fontdiffuer_pipeline` around `model`."""
+    from src import FontDiffuserDPMPipeline, build_ddpm_scheduler
+
+    def make(args, model):
+        return FontDiffuserDPMPipeline(
+            model=model,
+            ddpm_train_scheduler=build_ddpm_scheduler(args=args),
+            model_type=args.model_type,
+            guidance_type=args.guidance_type,
+            guidance_scale=args.guidance_scale)
+
+    return make
+
+
+@pytest.fixture(scope="session")
+def small_pipe(small_args, small_model, make_pipe):
+    return make_pipe(small_args, small_model)
+
+
+@pytest.fixture(scope="session")
+def ttf_path():
+    """A TTF with Latin glyphs: the default font shipped with pygame."""
+    pygame = pytest.importorskip("pygame")
+    path = os.path.join(os.path.dirname(pygame.__file__), pygame.font.get_default_font())
+    if not os.path.exists(path):
+        pytest.skip("pygame ships no default font")
+    return path
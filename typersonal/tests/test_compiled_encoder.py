@@ -0,0 +1,42 @@
+import pickle
+
+import torch
+
+from src import CompiledEncoder
+from src.model import map_condition
+
+
+def flatten(outputs):
+    tensors = []
+    map_condition(tensors.append, outputs)
+    return tensors
+
+
+def test_compiled_encoders_match_eager_and_reload(small_model, tmp_path):
+    cache_dir = str(tmp_path)
+    content_images, style_images = torch.randn(2, 3, 96, 96), torch.randn(1, 3, 96, 96)
+    for encoder, name in ((small_model.content_encoder, "content_encoder"),
+                          (small_model.style_encoder, "style_encoder")):
+        compiled = CompiledEncoder(encoder, name, cache_dir=cache_dir, cache_key="key").compile([(2, 96, 96)])
+        # Restarted (or pickled to a worker): the traces are loaded from the cache
+        reloaded = pickle.loads(pickle.dumps(compiled))
+        with torch.no_grad():
+            expected = encoder(content_images)
+            for outputs in (compiled(content_images), reloaded(content_images)):
+                assert [tuple(t.shape) for t in flatten(outputs)] == [tuple(t.shape) for t in flatten(expected)]
+                for actual, reference in zip(flatten(outputs), flatten(expected)):
+                    assert torch.allclose(actual, reference, atol=1e-5)
+            assert reloaded(style_images) is None
+
+    # The model runs the trace for its shape and falls back to the eager encoder for the others
+    with torch.no_grad():
+        expected = small_model.encode_content(content_images)
+        small_model.compiled_content_encoder = CompiledEncoder(
+            small_model.content_encoder, "content_encoder", cache_dir=cache_dir, cache_key="key")
+        try:
+            small_model.compiled_content_encoder.compile([(2, 96, 96)])
+            for actual, reference in zip(small_model.encode_content(content_images), expected):
+                assert torch.allclose(actual, reference, atol=1e-5)
+            assert len(small_model.encode_content(style_images)) == len(expected)
+        finally:
+            small_model.compiled_content_encoder = None
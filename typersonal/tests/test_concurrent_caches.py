@@ -0,0 +1,72 @@
+import sys
+import threading
+import time
+
+import torch
+
+from src.dpm_solver.dpm_solver_pytorch import DPM_Solver, NoiseScheduleVP
+
+
+class SlowDict(dict):
+    """A dict that lets the other threads run between the size check and the eviction of a cache."""
+
+    def __len__(self):
+        size = super().__len__()
+        time.sleep(1e-3)
+        return size
+
+
+def run_threads(fn, num_threads=8, repeats=100):
+    """Run fn(thread, repeat) on `num_threads` threads at once, switching threads as often as possible."""
+    barrier = threading.Barrier(num_threads)
+    errors = []
+
+    def work(thread):
+        barrier.wait()
+        try:
+            for repeat in range(repeats):
+                fn(thread, repeat)
+        except Exception as e:
+            errors.append(e)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=work, args=(thread,)) for thread in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert not errors, errors
+
+
+def test_multistep_plans_are_shared_between_threads():
+    solver = DPM_Solver(lambda x, t: x, NoiseScheduleVP("discrete", betas=torch.linspace(1e-4, 0.02, 1000)))
+    solver.multistep_plans = SlowDict()
+    solver.max_multistep_plans = 2
+
+    def plan(thread, repeat):
+        steps = 2 + (thread + repeat) % 5
+        assert len(solver.multistep_plan(steps, 2, "time_uniform", 1., 1e-3, True, "dpmsolver", "cpu")) == steps + 1
+
+    run_threads(plan)
+    assert len(solver.multistep_plans) <= 2
+
+
+def test_time_embeddings_are_shared_between_threads(small_model):
+    unet = small_model.unet
+    cache, max_entries = unet.time_embedding_cache, unet.max_time_embedding_cache
+    unet.time_embedding_cache, unet.max_time_embedding_cache = SlowDict(), 2
+
+    def embed(thread, repeat):
+        timesteps = torch.full((2,), float((thread + repeat) % 7 * 100))
+        with torch.no_grad():
+            assert torch.equal(unet.timestep_embedding(timesteps), unet._embed_timesteps(timesteps))
+
+    try:
+        run_threads(embed)
+    finally:
+        assert len(unet.time_embedding_cache) <= 2
+        unet.time_embedding_cache, unet.max_time_embedding_cache = cache, max_entries
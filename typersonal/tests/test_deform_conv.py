@@ -0,0 +1,44 @@
+import pytest
+import torch
+from torchvision.ops import DeformConv2d
+
+from src.modules.deform_conv import GridSampleDeformConv2d, set_deform_conv_backend
+
+# float32 sums over in_channels * taps products, in another order than deform_conv2d
+TOLERANCE = dict(rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("kernel_size, stride, padding, dilation, bias", [
+    (3, 1, 1, 1, True),
+    (3, 2, 1, 1, False),
+    (3, 1, 2, 2, True),
+    (1, 1, 0, 1, True),
+])
+@pytest.mark.parametrize("offset_scale", [0.5, 4.0])
+def test_grid_sample_matches_torchvision(kernel_size, stride, padding, dilation, bias, offset_scale):
+    torch.manual_seed(0)
+    conv = DeformConv2d(6, 5, kernel_size, stride=stride, padding=padding, dilation=dilation, bias=bias).eval()
+    if bias:
+        torch.nn.init.normal_(conv.bias)
+    grid_sample_conv = set_deform_conv_backend(torch.nn.Sequential(conv), "grid_sample")[0]
+    assert isinstance(grid_sample_conv, GridSampleDeformConv2d)
+
+    input = torch.randn(2, 6, 9, 11)
+    out_height = (9 + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
+    out_width = (11 + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
+    # Offsets of up to 4 pixels move many taps off the 9 x 11 input (partly or completely)
+    offset = torch.randn(2, 2 * kernel_size * kernel_size, out_height, out_width) * offset_scale
+    with torch.no_grad():
+        expected = conv(input, offset)
+        torch.testing.assert_close(grid_sample_conv(input, offset), expected, **TOLERANCE)
+
+
+def test_grid_sample_matches_torchvision_at_integer_offsets_out_of_bounds():
+    torch.manual_seed(0)
+    conv = DeformConv2d(4, 3, 3, padding=1).eval()
+    grid_sample_conv = set_deform_conv_backend(torch.nn.Sequential(conv), "grid_sample")[0]
+    input = torch.randn(1, 4, 6, 6)
+    # Whole-pixel offsets land exactly on the border and beyond it, where the corners are zeros
+    offset = torch.randint(-8, 9, (1, 18, 6, 6)).float()
+    with torch.no_grad():
+        torch.testing.assert_close(grid_sample_conv(input, offset), conv(input, offset), **TOLERANCE)
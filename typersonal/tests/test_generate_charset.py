@@ -0,0 +1,55 @@
+import copy
+import io
+
+import pytest
+from PIL import Image
+
+from generate_charset import (GlyphArchive, prepare_archive_dir, run_config, completed_characters,
+                              iter_archive)
+
+
+@pytest.fixture
+def charset_args(small_args, tmp_path):
+    args = copy.copy(small_args)
+    args.ckpt_dir = str(tmp_path / "ckpt")
+    (tmp_path / "ckpt").mkdir()
+    for name in ("unet.pth", "style_encoder.pth", "content_encoder.pth"):
+        (tmp_path / "ckpt" / name).write_bytes(name.encode())
+    return args
+
+
+@pytest.mark.parametrize("name, value", [("algorithm_type", "dpmsolver"), ("skip_type", "logSNR"),
+                                         ("method", "singlestep"), ("guidance_scale", 3.0), ("seed", 1)])
+def test_resume_refuses_other_sampling_options(charset_args, tmp_path, name, value):
+    style_image = Image.new("RGB", (96, 96), "white")
+    archive_dir = str(tmp_path / "archive")
+    prepare_archive_dir(archive_dir, run_config(charset_args, style_image))
+    prepare_archive_dir(archive_dir, run_config(charset_args, style_image))
+
+    changed = copy.copy(charset_args)
+    setattr(changed, name, value)
+    with pytest.raises(SystemExit, match=name):
+        prepare_archive_dir(archive_dir, run_config(changed, style_image))
+
+
+def test_archive_finds_the_shard_of_each_character(tmp_path):
+    archive_dir = str(tmp_path)
+    images = {char: Image.new("RGB", (8, 8), color) for char, color in zip("abc", ("red", "green", "blue"))}
+    for shard, chars in ((0, "a"), (1, "bc")):
+        archive = GlyphArchive(archive_dir, shard)
+        for char in chars:
+            archive.append(char, images[char])
+        archive.close()
+
+    # Shard 0 (e.g. the gradio apps) skips and reads the characters of shard 1
+    archive = GlyphArchive(archive_dir, 0)
+    assert "b" in archive and archive.shard_of("b") == 1
+    assert archive.shard_of("d") is None
+    archive.append_missing("d")
+    assert [char for char in "abcde" if char not in archive] == ["e"]
+    assert Image.open(io.BytesIO(archive.read("c"))).getpixel((0, 0)) == (0, 0, 255)
+    assert archive.read("d") is None
+    archive.close()
+
+    assert completed_characters(archive_dir) == set("abcd")
+    assert sorted(char for char, _ in iter_archive(archive_dir)) == ["a", "b", "c"]
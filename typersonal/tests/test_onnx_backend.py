@@ -0,0 +1,72 @@
+import copy
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from src.onnx_backend import OnnxFontDiffuserModel, export_onnx
+from style_bank import BLEND_STYLE_SIZE
+import shared.core as core
+
+
+@pytest.fixture(scope="module")
+def onnx_args(small_args, small_model, tmp_path_factory):
+    onnx_dir = str(tmp_path_factory.mktemp("onnx"))
+    with torch.no_grad():
+        export_onnx(small_model, onnx_dir,
+                    content_size=small_args.content_image_size,
+                    style_size=small_args.style_image_size,
+                    content_encoder_downsample_size=small_args.content_encoder_downsample_size,
+                    latent_style_size=BLEND_STYLE_SIZE)
+    args = copy.copy(small_args)
+    args.onnx_dir = onnx_dir
+    return args
+
+
+@pytest.fixture(scope="module")
+def style_option(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("style_b")
+    glyph = np.full((96, 96, 3), 255, dtype=np.uint8)
+    glyph[20:76, 40:56] = 0
+    Image.fromarray(glyph).save(folder / f"{ord('A')}.png")
+    core.STYLE_DIRS["test"] = str(folder)
+    yield "test"
+    del core.STYLE_DIRS["test"]
+
+
+def style_image():
+    image = np.full((96, 96, 3), 255, dtype=np.uint8)
+    image[30:66, 10:86] = 0
+    return Image.fromarray(image)
+
+
+def test_onnx_style_latent_matches_torch(onnx_args, small_model):
+    onnx_model = OnnxFontDiffuserModel(onnx_args.onnx_dir)
+    for size in [onnx_args.style_image_size, BLEND_STYLE_SIZE]:
+        images = torch.rand(2, 3, *size) * 2 - 1
+        with torch.no_grad():
+            expected = small_model.encode_style_latent(images)
+        torch.testing.assert_close(onnx_model.encode_style_latent(images), expected, rtol=1e-4, atol=1e-4)
+
+
+def test_blend_runs_on_onnx_model(onnx_args, small_args, small_model, make_pipe, ttf_path, style_option):
+    torch_args = copy.copy(small_args)
+    torch_args.ttf_path = ttf_path
+    onnx_args = copy.copy(onnx_args)
+    onnx_args.ttf_path = ttf_path
+
+    images = []
+    for args, model in [(torch_args, small_model), (onnx_args, OnnxFontDiffuserModel(onnx_args.onnx_dir))]:
+        pipe = make_pipe(args, model)
+        torch.manual_seed(0)  # the blend noise comes from the global generator
+        core.encode_style_image(style_image(), args, pipe)  # POST /ai/styles
+        image = core.blend_styles_latent("A", style_image(), style_option, 0.5, 0, args, pipe)
+        assert image is not None and image.size == tuple(args.content_image_size)
+        images.append(np.asarray(image, dtype=np.int16))
+    # The two backends only differ by float rounding, which the random weights amplify on a few pixels
+    diff = np.abs(images[0] - images[1])
+    assert diff.mean() < 0.5 and diff.max() <= 32
@@ -0,0 +1,34 @@
+import copy
+
+import torch
+from torch.ao.nn.quantized import Conv2d as QuantizedConv2d
+
+from src.quantization import load_quantized, quantize_model, save_quantized
+from src.spectral_norm import has_spectral_norm
+
+
+def test_quantize_model_covers_the_encoders(small_model, tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    content_images = torch.rand(2, 3, 96, 96, generator=generator) * 2 - 1
+    style_images = torch.rand(2, 3, 96, 96, generator=generator) * 2 - 1
+
+    def calibrate(model):
+        model.encode_condition(content_images, style_images)
+
+    quantized = quantize_model(copy.deepcopy(small_model), calibrate)
+    for name in ["style_encoder", "content_encoder", "unet"]:
+        encoder = getattr(quantized, name)
+        assert not has_spectral_norm(encoder)
+        assert any(isinstance(module, QuantizedConv2d) for module in encoder.modules()), name
+
+    with torch.no_grad():
+        expected = small_model.encode_style_latent(style_images)
+        latent = quantized.encode_style_latent(style_images)
+    assert (latent - expected).norm() / expected.norm() < 0.2
+
+    path = str(tmp_path / "int8.pth")
+    save_quantized(quantized, path, "digest")
+    assert load_quantized(copy.deepcopy(small_model), path, "another digest") is None
+    reloaded = load_quantized(copy.deepcopy(small_model), path, "digest")
+    with torch.no_grad():
+        torch.testing.assert_close(reloaded.encode_style_latent(style_images), latent)
@@ -0,0 +1,69 @@
+import copy
+import os
+
+import pytest
+import torch
+import torch.nn as nn
+
+from freeze_sn import ENCODER_CKPTS, SERVING_CKPT, load_or_freeze_encoders, load_serving_encoders
+from src import build_content_encoder, build_style_encoder
+from src.checkpoint import build_on_meta
+from src.modules import content_encoder, style_encoder
+from src.spectral_norm import freeze_spectral_norm, has_spectral_norm
+from utils import checkpoint_digest
+
+
+@pytest.mark.parametrize("module", [style_encoder, content_encoder])
+def test_frozen_layers_match_the_spectral_norm_layers(module):
+    torch.manual_seed(0)
+    model = nn.Sequential(module.SNConv2d(4, 8, 3, padding=1), nn.Flatten(), module.SNLinear(8 * 6 * 6, 5)).eval()
+    x = torch.randn(3, 4, 6, 6)
+    with torch.no_grad():
+        expected = model(x)
+
+    max_error = freeze_spectral_norm(model)
+    assert type(model[0]) is nn.Conv2d and type(model[2]) is nn.Linear
+    assert not has_spectral_norm(model)
+    assert max_error <= 1e-5
+    with torch.no_grad():
+        torch.testing.assert_close(model(x), expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.fixture
+def ckpt_dir(tmp_path, small_model):
+    torch.save(small_model.style_encoder.state_dict(), tmp_path / "style_encoder.pth")
+    torch.save(small_model.content_encoder.state_dict(), tmp_path / "content_encoder.pth")
+    return str(tmp_path)
+
+
+def meta_encoders(args):
+    return build_on_meta(build_style_encoder, args=args), build_on_meta(build_content_encoder, args=args)
+
+
+def test_stale_serving_checkpoint_falls_back_to_freezing(ckpt_dir, small_args, small_model):
+    args = copy.copy(small_args)
+    args.ckpt_dir = ckpt_dir
+    path = os.path.join(ckpt_dir, SERVING_CKPT)
+    digest = checkpoint_digest(ckpt_dir, names=ENCODER_CKPTS)
+
+    assert load_serving_encoders(path, digest, *meta_encoders(small_args)) is None  # no serving checkpoint
+    load_or_freeze_encoders(args, *meta_encoders(small_args))
+    assert torch.load(path, weights_only=True)["checkpoint_digest"] == digest
+
+    # A serving checkpoint of other encoder weights is ignored, the encoders stay untouched
+    stale_style_encoder, stale_content_encoder = meta_encoders(small_args)
+    assert load_serving_encoders(path, "another digest", stale_style_encoder, stale_content_encoder) is None
+    assert has_spectral_norm(stale_style_encoder) and has_spectral_norm(stale_content_encoder)
+
+    # ... and rebuilt from the original checkpoint
+    cached = torch.load(path, weights_only=True)
+    cached["checkpoint_digest"] = "another digest"
+    torch.save(cached, path)
+    style_encoder, content_encoder = load_or_freeze_encoders(args, *meta_encoders(small_args))
+    assert torch.load(path, weights_only=True)["checkpoint_digest"] == digest
+    assert not has_spectral_norm(style_encoder) and not has_spectral_norm(content_encoder)
+
+    images = torch.rand(2, 3, *small_args.style_image_size) * 2 - 1
+    with torch.no_grad():
+        expected = small_model.style_encoder(images)[0]
+        torch.testing.assert_close(style_encoder(images)[0], expected, rtol=1e-4, atol=1e-4)
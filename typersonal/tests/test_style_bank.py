@@ -0,0 +1,44 @@
+import copy
+
+import pytest
+import torch
+from PIL import Image
+
+from style_bank import StyleBank, get_style_bank, lookup_style_latent, style_bank_dir
+from style_cache import style_image_tensor
+from utils import encoder_variant
+
+
+@pytest.fixture
+def bank_args(small_args, tmp_path):
+    args = copy.copy(small_args)
+    args.ckpt_dir = str(tmp_path / "ckpt")
+    (tmp_path / "ckpt").mkdir()
+    (tmp_path / "ckpt" / "style_encoder.pth").write_bytes(b"style_encoder.pth")
+    return args
+
+
+def test_style_bank_is_keyed_by_the_encoder_variant(bank_args, small_model, tmp_path):
+    style_folder = tmp_path / "style"
+    style_folder.mkdir()
+    images = {char: Image.new("RGB", (96, 96), color) for char, color in zip("AB", ("white", "black"))}
+    for char, image in images.items():
+        image.save(style_folder / f"{ord(char)}.png")
+
+    variant = encoder_variant(bank_args)
+    assert variant == "fp32"
+    StyleBank.build(small_model, str(style_folder), style_bank_dir(bank_args.ckpt_dir, str(style_folder),
+                                                                   variant=variant), variant=variant)
+    latent = lookup_style_latent(bank_args, str(style_folder), "B", "cpu")
+    with torch.no_grad():
+        expected = small_model.encode_style_latent(style_image_tensor(images["B"], (128, 128)))
+    assert torch.allclose(latent, expected, atol=1e-5)
+
+    # The encoders of the other variants give other latents, they encode the PNG instead
+    for name in ("int8", "freeze_sn"):
+        changed = copy.copy(bank_args)
+        setattr(changed, name, True)
+        assert encoder_variant(changed) != variant
+        assert get_style_bank(changed, str(style_folder)) is None
+    with pytest.raises(AssertionError, match="fp32"):
+        StyleBank(style_bank_dir(bank_args.ckpt_dir, str(style_folder), variant=variant), "frozen-sn")
@@ -0,0 +1,43 @@
+import copy
+import pickle
+
+import torch
+from PIL import Image
+
+import style_cache
+from sample import sampling_batch
+from src.model import map_condition
+from style_bank import BLEND_STYLE_SIZE
+from style_cache import encode_style, encode_style_cached, style_latent_cached
+
+
+def flatten(features):
+    tensors = []
+    map_condition(tensors.append, features)
+    return tensors
+
+
+def test_encoded_style_skips_the_hash_and_the_encoders(small_args, small_pipe, ttf_path, monkeypatch):
+    args = copy.copy(small_args)
+    args.ttf_path = ttf_path
+    args.seed = 1
+    image = Image.new("RGB", (96, 96), "white")
+    image.paste((0, 0, 0), (20, 20, 70, 70))
+    # Pickled as when it is sent to a worker process
+    style = pickle.loads(pickle.dumps(encode_style(args, small_pipe, image, BLEND_STYLE_SIZE)))
+    features = encode_style_cached(args, small_pipe, image)
+    latent = style_latent_cached(args, small_pipe, image, BLEND_STYLE_SIZE)
+    expected_images = sampling_batch(args, small_pipe, ["A", "B"], image)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The encoded style is used as it is.")
+
+    monkeypatch.setattr(style_cache, "image_digest", fail)
+    monkeypatch.setattr(small_pipe.model, "encode_style", fail)
+    monkeypatch.setattr(small_pipe.model, "encode_style_latent", fail)
+    for expected, actual in zip(flatten(features), flatten(encode_style_cached(args, small_pipe, style))):
+        assert torch.equal(expected, actual)
+    assert torch.equal(latent, style_latent_cached(args, small_pipe, style, BLEND_STYLE_SIZE))
+    assert style.size == image.size
+    images = sampling_batch(args, small_pipe, ["A", "B"], [style, style])
+    assert [image.tobytes() for image in images] == [image.tobytes() for image in expected_images]
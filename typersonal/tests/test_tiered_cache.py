@@ -0,0 +1,76 @@
+import os
+import pickle
+
+from tiered_cache import TieredLRUCache, merge_cache_stats
+
+
+class PickleCache(TieredLRUCache):
+    suffix = ".pkl"
+
+    def dump(self, value, path):
+        with open(path, "wb") as f:
+            pickle.dump(value, f)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def spilled_files(spill_dir):
+    return sorted(name for name in os.listdir(spill_dir) if name.endswith(".pkl"))
+
+
+def test_spill_keeps_the_newest_files(tmp_path, monkeypatch):
+    cache = PickleCache(max_entries=1, spill_dir=str(tmp_path), max_spill_entries=3)
+    def listdir(path):
+        raise AssertionError("The spill directory is only listed at startup.")
+
+    monkeypatch.setattr(os, "listdir", listdir)
+    for index in range(6):
+        cache.put(index, [index])
+    monkeypatch.undo()
+
+    # 0..4 were evicted from memory, only the last 3 of them stay on disk
+    assert len(spilled_files(tmp_path)) == 3
+    assert cache.get(1) is None
+    assert cache.get(2) == [2]
+    assert cache.disk_hits == 1
+
+
+def test_spill_index_survives_a_restart(tmp_path):
+    cache = PickleCache(max_entries=1, spill_dir=str(tmp_path), max_spill_entries=3)
+    for index in range(4):
+        cache.put(index, [index])
+    # 0, 1, 2 are on disk, oldest first
+    for age, index in enumerate([0, 1, 2]):
+        os.utime(cache._spill_path(index), ns=(age * 10**9, age * 10**9))
+
+    restarted = PickleCache(max_entries=1, spill_dir=str(tmp_path), max_spill_entries=3)
+    for index in range(10, 13):
+        restarted.put(index, [index])
+    expected = [2, 10, 11]
+    assert spilled_files(tmp_path) == sorted(os.path.basename(restarted._spill_path(index)) for index in expected)
+
+
+def test_writers_sharing_spill_dir_use_their_own_temporary_files(tmp_path):
+    other = PickleCache(max_entries=1, spill_dir=str(tmp_path))
+
+    class Interleaved(PickleCache):
+        def dump(self, value, path):
+            super().dump(value, path)
+            # Another process spills the same key before this one renames its file
+            other._spill("key", ["other"])
+
+    Interleaved(max_entries=1, spill_dir=str(tmp_path))._spill("key", ["first"])
+    assert os.listdir(tmp_path) == [os.path.basename(other._spill_path("key"))]
+    assert other.load(other._spill_path("key")) == ["first"]
+
+
+def test_merge_cache_stats():
+    caches = [PickleCache(max_entries=2), PickleCache(max_entries=2)]
+    caches[0].put("a", 1)
+    caches[0].get("a")
+    caches[1].get("a")
+    merged = merge_cache_stats([cache.stats() for cache in caches])
+    assert (merged["entries"], merged["max_entries"], merged["hits"], merged["misses"]) == (1, 4, 1, 1)
+    assert merged["hit_rate"] == 0.5
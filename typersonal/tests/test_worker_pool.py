@@ -0,0 +1,58 @@
+import pytest
+
+from shared.worker_pool import InferenceWorkerPool
+
+
+class FakeModel:
+    def share_memory(self):
+        return self
+
+
+class FakePipe:
+    model = FakeModel()
+
+
+def count_up(n, args, pipe, progress=None):
+    for step in range(1, n + 1):
+        if progress is not None:
+            progress((step, n))
+    if n < 0:
+        raise ValueError("negative")
+    return n * args
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = InferenceWorkerPool(10, FakePipe(), num_workers=1, cpus=[0])
+    yield pool
+    pool.close()
+
+
+def test_progress_is_reported_before_the_result(pool):
+    reports = []
+    assert pool.run(count_up, 3, progress=reports.append) == 30
+    assert reports == [(1, 3), (2, 3), (3, 3)]
+    assert pool.stats()["pending"] == 0
+
+
+def test_tasks_without_progress(pool):
+    assert pool.run(count_up, 2) == 20
+    with pytest.raises(RuntimeError, match="negative"):
+        pool.run(count_up, -1, progress=lambda value: None)
+
+
+def worker_pid(args, pipe):
+    import os
+    return os.getpid()
+
+
+def test_submit_to_each_runs_once_on_every_worker():
+    pool = InferenceWorkerPool(10, FakePipe(), num_workers=2, cpus=[0, 0])
+    try:
+        futures = pool.submit_to_each(worker_pid)
+        assert sorted(futures) == [0, 1]
+        pids = {future.result(timeout=60) for future in futures.values()}
+        assert pids == {worker.pid for worker in pool.workers}
+        assert pool.stats()["pending"] == 0
+    finally:
+        pool.close()
@@ -0,0 +1,175 @@
+"""
+A bounded, thread-safe LRU with hit/miss counters and an optional disk tier, shared by the inference caches
+(style_cache.py for the encoder outputs, result_cache.py for the generated glyphs).
+"""
+
+import os
+import abc
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class TieredLRUCache(abc.ABC):
+    """A thread-safe LRU with an optional disk tier.
+
+    Entries are evicted from memory when there are more than `max_entries` of them, or when their total
+    `sizeof` exceeds `max_bytes`. Evicted entries are written to `spill_dir` (if set) with `dump`, and
+    read back with `load` on a later miss. Subclasses define `dump`, `load`, `sizeof` and `suffix`.
+
+    Args:
+        max_entries: the number of entries kept in memory, 0 disables the cache.
+        max_bytes: the total size of the entries kept in memory, `None` for no limit.
+        spill_dir: where the entries evicted from memory are saved, `None` to drop them.
+        max_spill_entries: the number of files kept in `spill_dir`, the oldest are removed first.
+
+    The spilled files are indexed in memory, oldest first; `spill_dir` is only listed once, at startup.
+    """
+
+    suffix = ".bin"
+
+    def __init__(self, max_entries=64, max_bytes=None, spill_dir=None, max_spill_entries=1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_entries = max_spill_entries
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._spilled = OrderedDict()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            paths = [os.path.join(spill_dir, name) for name in os.listdir(spill_dir) if name.endswith(self.suffix)]
+            for path in sorted(paths, key=os.path.getmtime):
+                self._spilled[os.path.basename(path)] = None
+
+    @abc.abstractmethod
+    def dump(self, value, path):
+        """Write `value` to the file `path`."""
+
+    @abc.abstractmethod
+    def load(self, path):
+        """Read back a value written by `dump`."""
+
+    def sizeof(self, value):
+        return 0
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode()).hexdigest() + self.suffix)
+
+    def _spill(self, key, value):
+        path = self._spill_path(key)
+        name = os.path.basename(path)
+        with self._lock:
+            spilled = name in self._spilled
+        if not spilled:
+            if not os.path.exists(path):
+                # A temporary file of its own: other processes sharing spill_dir may spill the same key
+                fd, tmp_path = tempfile.mkstemp(dir=self.spill_dir, prefix=name + ".", suffix=".tmp")
+                os.close(fd)
+                try:
+                    self.dump(value, tmp_path)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+            with self._lock:
+                self._spilled[name] = None
+        with self._lock:
+            removed = []
+            while len(self._spilled) > self.max_spill_entries:
+                removed.append(self._spilled.popitem(last=False)[0])
+        for old_name in removed:
+            try:
+                os.remove(os.path.join(self.spill_dir, old_name))
+            except FileNotFoundError:
+                pass  # removed by another process sharing spill_dir
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        if self.spill_dir is not None:
+            path = self._spill_path(key)
+            if os.path.exists(path):
+                value = self.load(path)
+                with self._lock:
+                    self.disk_hits += 1
+                self.put(key, value)
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._sizes[key]
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._sizes[key] = size
+            self._total_bytes += size
+            evicted = []
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self._total_bytes > self.max_bytes and len(self._entries) > 1):
+                evicted_key, evicted_value = self._entries.popitem(last=False)
+                self._total_bytes -= self._sizes.pop(evicted_key)
+                evicted.append((evicted_key, evicted_value))
+                self.evictions += 1
+        if self.spill_dir is not None:
+            for evicted_key, evicted_value in evicted:
+                self._spill(evicted_key, evicted_value)
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+def merge_cache_stats(stats_list):
+    """The combined `stats` of the caches of several processes: the sums of the counters and sizes."""
+    merged = {"entries": 0, "max_entries": 0, "bytes": 0, "max_bytes": None,
+              "hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+    for stats in stats_list:
+        for name in ("entries", "max_entries", "bytes", "hits", "disk_hits", "misses", "evictions"):
+            merged[name] += stats[name]
+        if stats["max_bytes"] is not None:
+            merged["max_bytes"] = (merged["max_bytes"] or 0) + stats["max_bytes"]
+    lookups = merged["hits"] + merged["disk_hits"] + merged["misses"]
+    merged["hit_rate"] = (merged["hits"] + merged["disk_hits"]) / lookups if lookups else 0.0
+    return merged
@@ -1,7 +1,8 @@
 import os
 import cv2
 import yaml
-import copy
+import hashlib
+import functools
 import pygame
 import numpy as np
 from PIL import Image
@@ -19,6 +20,63 @@ def save_args_to_yaml(args, output_file):
         yaml.dump(args_dict, yaml_file, default_flow_style=False)
 
 
+def checkpoint_digest(ckpt_dir, names=("unet.pth", "style_encoder.pth", "content_encoder.pth")):
+    """The sha1 of the checkpoint files, to key the artifacts derived from a checkpoint.
+
+    A `.pth` that was converted to safetensors and removed is read from its `.safetensors` instead.
+    """
+    digest = hashlib.sha1()
+    for name in names:
+        path = os.path.join(ckpt_dir, name)
+        if not os.path.exists(path) and name.endswith(".pth"):
+            path = path[:-len(".pth")] + ".safetensors"
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _model_version(ckpt_dir, int8, onnx_dir):
+    if ckpt_dir is None and not onnx_dir:
+        return "untracked"
+    if onnx_dir:
+        return "onnx-" + checkpoint_digest(
+            onnx_dir, names=("unet.onnx", "style_encoder.onnx", "content_encoder.onnx", "unet_style_structure.onnx",
+                              "style_latent.onnx", "unet_latent.onnx"))[:11]
+    if int8:
+        from src.quantization import QUANTIZED_VERSION
+        return checkpoint_digest(ckpt_dir)[:16] + f"-int8v{QUANTIZED_VERSION}"
+    return checkpoint_digest(ckpt_dir)[:16]
+
+
+def model_version(args):
+    """A short id of the weights that `args` loads (the checkpoint digest plus the int8 / ONNX variants),
+    to key the cached results of the model. Computed once per process."""
+    return _model_version(args.ckpt_dir, getattr(args, "int8", False), getattr(args, "onnx_dir", None))
+
+
+def encoder_variant(args):
+    """The encoders that `args` runs: "fp32", "frozen-sn", "int8v<N>" or the ONNX model version.
+
+    Their outputs differ slightly, so the stored encoder outputs (style_bank.py, content_features.py) are
+    keyed by it and a store built for another variant is never mixed in.
+    """
+    if getattr(args, "onnx_dir", None):
+        return model_version(args)
+    if getattr(args, "int8", False):
+        from src.quantization import QUANTIZED_VERSION
+        return f"int8v{QUANTIZED_VERSION}"
+    return "frozen-sn" if getattr(args, "freeze_sn", False) else "fp32"
+
+
+def image_digest(image):
+    """The sha1 of the decoded pixels of a PIL image, to key the results derived from an uploaded image."""
+    digest = hashlib.sha1(image.tobytes())
+    digest.update(f"{image.mode}{image.size}".encode())
+    return digest.hexdigest()
+
+
 def save_single_image(save_dir, image):
 
     save_path = f"{save_dir}/out_single.png"
@@ -82,13 +140,17 @@ def normalize_mean_std(image):
     return image
 
 
+@functools.lru_cache(maxsize=None)
+def font_codepoints(font_path):
+    """The set of unicode code points in the cmap of a font, parsed once per font."""
+    codepoints = set()
+    for subtable in TTFont(font_path, lazy=True)['cmap'].tables:
+        codepoints.update(subtable.cmap.keys())
+    return frozenset(codepoints)
+
+
 def is_char_in_font(font_path, char):
-    TTFont_font = TTFont(font_path)
-    cmap = TTFont_font['cmap']
-    for subtable in cmap.tables:
-        if ord(char) in subtable.cmap:
-            return True
-    return False
+    return ord(char) in font_codepoints(font_path)
 
 
 def load_ttf(ttf_path, fsize=128):
@@ -105,10 +167,9 @@ def ttf2im(font, char, fsize=128):
     except:
         print("No glyph for char {}".format(char))
         return
-    bg = np.full((fsize, fsize), 255)
     imo = pygame.surfarray.pixels_alpha(surface).transpose(1, 0)
     imo = 255 - np.array(Image.fromarray(imo))
-    im = copy.deepcopy(bg)
+    im = np.full((fsize, fsize), 255, dtype=np.uint8)
     h, w = imo.shape[:2]
     if h > fsize:
         h, w = fsize, round(w*fsize/h)
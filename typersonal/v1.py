@@ -1,7 +1,7 @@
 import random
 import gradio as gr
 from sample import (arg_parse, 
-                    sampling,
+                    sampling_batch,
                     load_fontdiffuer_pipeline)
 
 def run_fontdiffuer(handwriting_image, sampling_step, guidance_scale, batch_size):
@@ -13,18 +13,15 @@ def run_fontdiffuer(handwriting_image, sampling_step, guidance_scale, batch_size
     args.batch_size = batch_size
     args.seed = random.randint(0, 10000)
     
-    output_images = []
-    for char in characters_to_generate:
-        args.content_character = char  # 設定當前要生成的字
-        out_image = sampling(
-            args=args,
-            pipe=pipe,
-            content_image=None,  # 🆕 這裡明確設定為 None，避免報錯
-            style_image=handwriting_image  # 風格圖片
-        )
-        output_images.append(out_image)
+    # 一次批次生成所有字，不再逐字呼叫 sampling
+    output_images = sampling_batch(
+        args=args,
+        pipe=pipe,
+        characters=list(characters_to_generate),
+        style_image=handwriting_image  # 風格圖片
+    )
     
-    return output_images  # 回傳 100 張字型圖片
+    return [image for image in output_images if image is not None]  # 回傳 100 張字型圖片
 
 
 if __name__ == '__main__':
@@ -1,19 +1,12 @@
 import random
-import os
 from PIL import Image
 import gradio as gr
-import numpy as np
-import torch
-import torchvision.transforms as T
-import cv2
 from sample import (
     arg_parse,
     sampling,
     load_fontdiffuer_pipeline
 )
 
-from src.dpm_solver.dpm_solver_pytorch import NoiseScheduleVP, model_wrapper, DPM_Solver
-
 PRIMARY = "#d95f20"  # 深橘
 SECONDARY = "#1f3c38"  # 深綠
 ACCENT = "#e6a23c"  # 金黃
@@ -27,130 +20,9 @@ STYLE_DIRS = {
     "可愛手繪": "cute_handdrawn"
 }
 
-cached_image = {}
 FIXED_GUIDANCE_SCALE = 7.5
 FIXED_BATCH_SIZE = 1
-
-def get_style_b_image(character, folder):
-    unicode_str = str(ord(character))
-    path = os.path.join(folder, f"{unicode_str}.png")
-    if os.path.exists(path):
-        return Image.open(path).convert("RGB")
-    return None
-
-def sampling_with_latent(args, pipe, content_image, style_latent, thickness=0.0):
-    with torch.no_grad():
-        content_image = content_image.to(pipe.model.device)
-        style_latent = style_latent.to(pipe.model.device)
-
-        def forward_with_latent(x, t):
-            content_feat, content_res = pipe.model.content_encoder(content_image)
-            content_res.append(content_feat)
-            style_feat = style_latent
-            style_hidden = style_feat.permute(0, 2, 3, 1).reshape(style_feat.shape[0], -1, style_feat.shape[1])
-            style_content_feat, style_content_res = pipe.model.content_encoder(content_image)
-            style_content_res.append(style_content_feat)
-            output = pipe.model.unet(
-                x, t,
-                [style_feat, content_res, style_hidden, style_content_res],
-                args.content_encoder_downsample_size
-            )[0]
-            return output
-
-        noise_schedule = NoiseScheduleVP(schedule='discrete', betas=pipe.train_scheduler_betas)
-        model_fn = model_wrapper(
-            model=forward_with_latent,
-            noise_schedule=noise_schedule,
-            model_type=pipe.model_type,
-            guidance_type=pipe.guidance_type,
-            condition=None,
-            unconditional_condition=None,
-            guidance_scale=pipe.guidance_scale
-        )
-        dpm_solver = DPM_Solver(
-            model_fn=model_fn,
-            noise_schedule=noise_schedule,
-            algorithm_type=args.algorithm_type,
-            correcting_x0_fn=args.correcting_x0_fn
-        )
-        x_T = torch.randn((1, 3, args.content_image_size[0], args.content_image_size[1])).to(pipe.model.device)
-        x_sample = dpm_solver.sample(
-            x=x_T,
-            steps=args.num_inference_steps,
-            order=args.order,
-            skip_type=args.skip_type,
-            method=args.method,
-        )
-        x_sample = (x_sample / 2 + 0.5).clamp(0, 1).cpu().permute(0, 2, 3, 1).numpy()
-        image = (x_sample[0] * 255).astype(np.uint8)
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        kernel = np.ones((3, 3), np.uint8)
-        if thickness < 0:
-            gray = cv2.dilate(gray, kernel, iterations=int(-thickness))
-        elif thickness > 0:
-            gray = cv2.erode(gray, kernel, iterations=int(thickness))
-        return Image.fromarray(cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB))
-
-def blend_styles_latent(character, image_a, style_option, alpha, thickness):
-    from utils import ttf2im, load_ttf, is_char_in_font
-    if not isinstance(image_a, Image.Image):
-        print(f"[錯誤] image_a 不是 PIL 圖像: {type(image_a)}")
-        return None
-
-    if not isinstance(character, str) or len(character) != 1:
-        print(f"[錯誤] character 不是單一中文字元: {character}")
-        return None
-    style_folder = STYLE_DIRS.get(style_option)
-    if not style_folder:
-        return None
-    image_b = get_style_b_image(character, style_folder)
-    if not image_a or not image_b:
-        return None
-
-    cache_key = (character, style_option, round(alpha, 2))
-    if cache_key in cached_image:
-        image = np.array(cached_image[cache_key])
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        kernel = np.ones((3, 3), np.uint8)
-        if thickness > 0:
-            gray = cv2.erode(gray, kernel, iterations=int(thickness))
-        elif thickness < 0:
-            gray = cv2.dilate(gray, kernel, iterations=int(-thickness))
-        return Image.fromarray(cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB))
-
-    tf = T.Compose([
-        T.Resize((128, 128)), T.ToTensor(), T.Normalize([0.5], [0.5])
-    ])
-    image_a_tensor = tf(image_a).unsqueeze(0).to(pipe.model.device)
-    image_b_tensor = tf(image_b).unsqueeze(0).to(pipe.model.device)
-
-    with torch.no_grad():
-        latent_a, _, _ = pipe.model.style_encoder(image_a_tensor)
-        latent_b, _, _ = pipe.model.style_encoder(image_b_tensor)
-    fused_latent = (1 - alpha) * latent_a + alpha * latent_b
-
-    if not is_char_in_font(font_path=args.ttf_path, char=character):
-        return None
-
-    font = load_ttf(ttf_path=args.ttf_path)
-    content_image = ttf2im(font=font, char=character)
-    content_tf = T.Compose([
-        T.Resize(args.content_image_size, interpolation=T.InterpolationMode.BILINEAR),
-        T.ToTensor(),
-        T.Normalize([0.5], [0.5])
-    ])
-    content_tensor = content_tf(content_image)[None, :].to(pipe.model.device)
-
-    image = sampling_with_latent(args, pipe, content_tensor, fused_latent, thickness=0)
-    cached_image[cache_key] = image
-    image_np = np.array(image)
-    gray = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
-    kernel = np.ones((3, 3), np.uint8)
-    if thickness > 0:
-        gray = cv2.erode(gray, kernel, iterations=int(thickness))
-    elif thickness < 0:
-        gray = cv2.dilate(gray, kernel, iterations=int(-thickness))
-    return Image.fromarray(cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB))
+BLEND_LATTICE_SIZE = 11  # alpha = 0, 0.1, ..., 1
 
 def generate_images(character, reference_image, sampling_step):
     args.character_input = True
@@ -171,7 +43,13 @@ def generate_images(character, reference_image, sampling_step):
     return style_a_image, character, style_a_image
 
 def update_blend(style_a_image, style_option, alpha, character, thickness):
-    return blend_styles_latent(character, style_a_image, style_option, alpha, thickness)
+    # 第一次拖動滑桿時一次批次生成整組 alpha lattice，之後的移動直接取快取或內插
+    from shared.core import blend_styles_lattice
+    if not isinstance(style_a_image, Image.Image):
+        print(f"[錯誤] image_a 不是 PIL 圖像: {type(style_a_image)}")
+        return None
+    return blend_styles_lattice(character, style_a_image, style_option, alpha, thickness,
+                                BLEND_LATTICE_SIZE, args, pipe)
 
 
 
@@ -1,51 +1,42 @@
-import random
 import gradio as gr
 import os
 import sys
 from sample import (arg_parse, 
-                    sampling,
                     load_fontdiffuer_pipeline)
+from generate_charset import (read_charset,
+                              run_config,
+                              prepare_archive_dir,
+                              GlyphArchive,
+                              generate_into_archive,
+                              export_archive)
 from PIL import Image
 from fontTools.ttLib import TTFont, newTable
 
 # 避免遞迴深度問題（適當提高遞迴限制）
 sys.setrecursionlimit(3000)
 
-def read_big5_characters(file_path):
-    """讀取 Big5 繁體字全集"""
-    with open(file_path, "r", encoding="utf-8") as f:
-        return [char.strip() for line in f for char in line]  # 確保是單一字元列表
-
 def run_fontdiffuer(handwriting_image, sampling_step, guidance_scale, batch_size):
     """使用手寫字風格生成完整 Big5 字型"""
-    characters_to_generate = read_big5_characters("big5_4808.txt")
+    # 讀取 Big5 繁體字全集
+    characters_to_generate = read_charset("big5_4808.txt")
     args.character_input = True  # 讓系統知道「只用風格圖片」，不需要 content_image
     args.sampling_step = sampling_step
+    args.num_inference_steps = int(sampling_step)
     args.guidance_scale = guidance_scale
+    pipe.guidance_scale = guidance_scale  # 取樣時用的是 pipe 的 guidance_scale
     args.batch_size = batch_size
-    args.seed = random.randint(0, 10000)
-    
-    output_images = []
-    output_folder = "generated_images"
-    os.makedirs(output_folder, exist_ok=True)
-    
-    for char in characters_to_generate:
-        if len(char) != 1:
-            continue  # 避免意外讀取到多個字元的錯誤
-        
-        args.content_character = char  # 設定當前要生成的字
-        out_image = sampling(
-            args=args,
-            pipe=pipe,
-            content_image=None,  # 明確設定為 None，避免報錯
-            style_image=handwriting_image  # 風格圖片
-        )
-        
-        image_path = os.path.join(output_folder, f"{ord(char)}.png")
-        out_image.save(image_path)
-        output_images.append(image_path)
-    
-    return output_images  # 回傳所有字型圖片
+    # seed 固定 (args.seed)，續跑時剩下的字才會與已完成的字用同樣的設定生成
+
+    # 寫入可續跑的封存檔：中斷後用同一張風格圖重新執行，會跳過已完成的字
+    archive_dir = "generated_charset"
+    prepare_archive_dir(archive_dir, run_config(args, handwriting_image, pipe), reset_on_mismatch=True)
+    archive = GlyphArchive(archive_dir)
+    try:
+        generate_into_archive(args, pipe, characters_to_generate, handwriting_image, archive)
+    finally:
+        archive.close()
+
+    return export_archive(archive_dir, "generated_images")  # 回傳所有字型圖片
 
 def create_ttf_from_images(image_folder, output_ttf):
     """將生成的字型圖片轉換為 TTF 字型檔案"""